@@ -0,0 +1,165 @@
+"""
+Bulk operations: apply one call to many items from a bounded thread pool.
+
+Maintenance calls (stop or destroy every instance, tear down every tenant
+network) used to run one item at a time. run_bulk runs them on 'workers'
+threads, starts no more than 'rate' calls per second (so the cloud's API
+isn't flooded) and never stops at the first failure:
+
+    summary = run_bulk('destroy', driver.destroy_instance, instances,
+                       progress=report)
+    summary.failed      # [BulkResult(item, error=...), ...]
+"""
+import threading
+import time
+from Queue import Queue
+
+from threepio import logger
+
+#Threads making calls at the same time
+DEFAULT_WORKERS = 8
+
+#Calls started per second (None: as fast as the workers go)
+DEFAULT_RATE = 10.0
+
+
+class RateLimiter(object):
+    """
+    Token bucket: acquire() blocks until a call may start.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens
+                                   + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class BulkResult(object):
+    """
+    What happened to one item: its result, or the exception it raised.
+    """
+    __slots__ = ('item', 'result', 'error')
+
+    def __init__(self, item, result=None, error=None):
+        self.item = item
+        self.result = result
+        self.error = error
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.success:
+            return "<BulkResult %s: OK>" % (self.item,)
+        return "<BulkResult %s: %r>" % (self.item, self.error)
+
+
+class BulkSummary(object):
+    """
+    Results of a bulk operation, in the order the items were given.
+    """
+
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.success]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.success]
+
+    def __len__(self):
+        return len(self.results)
+
+    def json(self):
+        return {'name': self.name,
+                'total': len(self.results),
+                'succeeded': len(self.succeeded),
+                'failed': [{'item': unicode(result.item),
+                            'error': unicode(result.error)}
+                           for result in self.failed]}
+
+    def __repr__(self):
+        return "<BulkSummary %s: %s succeeded, %s failed>"\
+            % (self.name, len(self.succeeded), len(self.failed))
+
+
+def run_bulk(name, operation, items, workers=DEFAULT_WORKERS,
+             rate=DEFAULT_RATE, progress=None):
+    """
+    Call operation(item) for every item and return a BulkSummary.
+
+    name - Used in logs and passed to progress
+    workers - Calls made at the same time
+    rate - Calls started per second (None: no limit)
+    progress - Optional, progress(name, done, total, result) is called
+    after each item (one call at a time)
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return BulkSummary(name, results)
+    limiter = RateLimiter(rate)
+    queue = Queue()
+    for task in enumerate(items):
+        queue.put(task)
+    lock = threading.Lock()
+    done = [0]
+
+    def work():
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+            (idx, item) = task
+            limiter.acquire()
+            try:
+                result = BulkResult(item, result=operation(item))
+            except Exception as error:
+                logger.exception("%s failed for %s" % (name, item))
+                result = BulkResult(item, error=error)
+            results[idx] = result
+            with lock:
+                done[0] += 1
+                if progress:
+                    try:
+                        progress(name, done[0], len(items), result)
+                    except Exception:
+                        logger.exception("%s progress callback failed"
+                                         % name)
+
+    threads = []
+    for _ in xrange(min(workers, len(items))):
+        queue.put(None)
+        thread = threading.Thread(target=work, name='bulk-%s' % name)
+        thread.daemon = True
+        threads.append(thread)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = BulkSummary(name, results)
+    logger.info("%s: %s succeeded, %s failed"
+                % (name, len(summary.succeeded), len(summary.failed)))
+    return summary
@@ -0,0 +1,166 @@
+"""
+Per-hypervisor capacity: how many instances of each size fit on each node.
+
+OSMeta.occupancy() divides the cloud's total free vCPUs, RAM and disk by a
+size, as if every node's free capacity could be pooled. A size that fits on
+no single node is still counted. CapacityMatrix works per node instead:
+
+    matrix = CapacityMatrix(meta._active_compute_nodes(), sizes)
+    matrix.remaining_by_size()    # {size.id: instances that still fit}
+    matrix.remaining_on_node(hostname)
+
+Free capacity honors the overcommit (allocation) ratios the scheduler uses.
+The matrix (nodes x sizes) is computed with NumPy when it is installed,
+and with plain Python otherwise.
+"""
+import sys
+
+from rtwo import settings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#Resources compared, as (hypervisor total, hypervisor used)
+RESOURCES = (('vcpus', 'vcpus_used'),
+             ('memory_mb', 'memory_mb_used'),
+             ('local_gb', 'local_gb_used'))
+
+
+def size_demand(size):
+    """
+    (vcpus, ram, disk) an instance of size uses on its hypervisor.
+    """
+    return (size.cpu or 0, size.ram or 0,
+            (size.disk or 0) + (size.ephemeral or 0))
+
+
+def node_capacity(node, ratios):
+    """
+    (vcpus, ram, disk) a hypervisor can allocate, and has allocated.
+    """
+    total = tuple(float(node.get(key) or 0) * ratio
+                  for ((key, _), ratio) in zip(RESOURCES, ratios))
+    used = tuple(float(node.get(used_key) or 0)
+                 for (_, used_key) in RESOURCES)
+    return (total, used)
+
+
+def instances_that_fit(free, demand):
+    """
+    How many instances needing 'demand' fit in 'free' (both 3-tuples).
+    Sizes that need nothing fit sys.maxint times.
+    """
+    fits = None
+    for (available, needed) in zip(free, demand):
+        if needed <= 0:
+            continue
+        count = int(max(available, 0) // needed)
+        fits = count if fits is None else min(fits, count)
+    return sys.maxint if fits is None else fits
+
+
+class CapacityMatrix(object):
+    """
+    Instances of each size that fit on each hypervisor.
+
+    nodes - {hostname: hypervisor} (See OSMeta._active_compute_nodes)
+    sizes - Sizes to fit
+    ratios - (cpu, ram, disk) allocation ratios, default from settings
+    """
+
+    def __init__(self, nodes, sizes, ratios=None):
+        self.hostnames = sorted(nodes)
+        self._rows = dict((hostname, row)
+                          for (row, hostname) in enumerate(self.hostnames))
+        self.sizes = list(sizes)
+        self.ratios = ratios or (settings.OPENSTACK_CPU_ALLOCATION_RATIO,
+                                 settings.OPENSTACK_RAM_ALLOCATION_RATIO,
+                                 settings.OPENSTACK_DISK_ALLOCATION_RATIO)
+        self._capacities = [node_capacity(nodes[hostname], self.ratios)
+                            for hostname in self.hostnames]
+        self._demands = [size_demand(size) for size in self.sizes]
+        #Matrices are computed on first use
+        self._matrices = {}
+
+    def _matrix(self, free):
+        """
+        The (nodes x sizes) matrix for all of each node's capacity, or
+        only what is still free.
+        """
+        matrix = self._matrices.get(free)
+        if matrix is None:
+            fits = self._numpy_fits if numpy else self._python_fits
+            matrix = self._matrices[free] = fits(free)
+        return matrix
+
+    def _python_fits(self, free):
+        matrix = []
+        for (node_total, node_used) in self._capacities:
+            if free:
+                node_total = [t - u for (t, u) in zip(node_total, node_used)]
+            matrix.append([instances_that_fit(node_total, demand)
+                           for demand in self._demands])
+        return matrix
+
+    def _numpy_fits(self, free):
+        capacity = numpy.array([total for (total, _) in self._capacities],
+                               dtype=float).reshape(-1, 3)
+        if free:
+            capacity -= numpy.array([used for (_, used) in self._capacities],
+                                    dtype=float).reshape(-1, 3)
+        numpy.maximum(capacity, 0, out=capacity)
+        demand = numpy.array(self._demands, dtype=float).reshape(-1, 3)
+        demand[demand < 0] = 0
+        matrix = numpy.full((len(capacity), len(demand)), numpy.inf)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for resource in xrange(3):
+                needed = demand[:, resource]
+                #Divide like instances_that_fit, multiplying by 1.0 / needed
+                #rounds exact fits down (49 * (1 / 49.) < 1)
+                fits = numpy.floor_divide(capacity[:, resource][:, None],
+                                          needed[None, :])
+                #Sizes that don't need a resource fit infinitely often
+                fits[:, needed <= 0] = numpy.inf
+                numpy.fmin(matrix, fits, out=matrix)
+        return numpy.minimum(matrix, sys.maxint, out=matrix)
+
+    def _by_size(self, matrix):
+        if numpy:
+            counts = numpy.minimum(matrix.sum(axis=0), sys.maxint)
+        else:
+            counts = [min(sum(column), sys.maxint)
+                      for column in zip(*matrix)] or [0] * len(self.sizes)
+        return dict((size.id, min(int(count), sys.maxint))
+                    for (size, count) in zip(self.sizes, counts))
+
+    def _on_node(self, matrix, hostname):
+        row = matrix[self._rows[hostname]]
+        return dict((size.id, min(int(count), sys.maxint))
+                    for (size, count) in zip(self.sizes, row))
+
+    def total_by_size(self):
+        """
+        {size.id: instances that fit on empty hypervisors}
+        """
+        return self._by_size(self._matrix(False))
+
+    def remaining_by_size(self):
+        """
+        {size.id: instances that fit in what is free now}
+        """
+        return self._by_size(self._matrix(True))
+
+    def total_on_node(self, hostname):
+        return self._on_node(self._matrix(False), hostname)
+
+    def remaining_on_node(self, hostname):
+        return self._on_node(self._matrix(True), hostname)
+
+    def remaining_by_node(self):
+        """
+        {hostname: {size.id: instances that fit in what is free now}}
+        """
+        return dict((hostname, self.remaining_on_node(hostname))
+                    for hostname in self.hostnames)
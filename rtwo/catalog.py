@@ -0,0 +1,281 @@
+"""
+Catalog caches for machines (images) and sizes (flavors).
+
+Each identifier (a provider, or a tenant for per-tenant image lists) gets
+its own entry: the raw libcloud objects, the models built from them, in
+order, and an id -> model index. Entries expire after a TTL, the least
+recently used identifiers are evicted once there are too many, and only
+one thread refreshes an entry while the others wait for its result.
+
+    catalog = get_catalog('machines')
+    entry = catalog.get(identifier, load)
+    machine = catalog.lookup(identifier, image_id)
+
+Calls that change images (or flavors) should invalidate the catalog:
+    invalidate_catalog('machines', item_id=image.id)
+
+Callers that pass 'restore' (building an entry from raw objects) get
+on-disk snapshots when CATALOG_SNAPSHOT_FILE is set (See catalog_snapshot).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from threepio import logger
+
+from rtwo.catalog_snapshot import get_catalog_snapshot
+from rtwo.drivers.single_flight import get_single_flight
+from rtwo.registry import get_shared
+
+#Seconds a catalog entry is used before it is loaded again
+DEFAULT_TTL = 600
+
+#Identifiers kept per catalog, the least recently used are evicted
+DEFAULT_MAX_ENTRIES = 1000
+
+
+class CatalogEntry(object):
+    """
+    raw - The libcloud objects, as listed (None: never listed, only
+          models added one at a time, See Catalog.add)
+    items - The models built from them (in the order callers want them)
+    index - id -> model
+    loaded_at - When it was listed (None: stale, load it again on use)
+    """
+    __slots__ = ('raw', 'items', 'index', 'loaded_at')
+
+    def __init__(self, raw, items, index, loaded_at=None):
+        self.raw = raw
+        self.items = items
+        self.index = index
+        self.loaded_at = loaded_at
+
+
+class Catalog(object):
+    """
+    A TTL/LRU cache of CatalogEntries keyed by identifier.
+    """
+
+    def __init__(self, name, ttl=DEFAULT_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        #identifier -> TTL, for identifiers that don't use the default
+        self.ttls = {}
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+        self.invalidations = 0
+        self.restores = 0
+
+    def set_ttl(self, identifier, ttl):
+        self.ttls[identifier] = ttl
+
+    def _is_fresh(self, identifier, entry):
+        if entry.loaded_at is None:
+            return False
+        ttl = self.ttls.get(identifier, self.ttl)
+        return ttl is None or time.time() - entry.loaded_at < ttl
+
+    def _touch(self, identifier):
+        """
+        Mark identifier as most recently used.
+        NOTE: Must be called while holding the lock.
+        """
+        self._entries[identifier] = self._entries.pop(identifier)
+
+    def _put(self, identifier, entry):
+        """
+        NOTE: Must be called while holding the lock.
+        """
+        self._entries.pop(identifier, None)
+        self._entries[identifier] = entry
+        while len(self._entries) > self.max_entries:
+            (evicted, _) = self._entries.popitem(last=False)
+            self.evictions += 1
+            logger.debug("Evicted %s from the %s catalog"
+                         % (evicted, self.name))
+
+    def entry(self, identifier):
+        """
+        Return identifier's entry (fresh or stale), None if there is none.
+        """
+        with self._lock:
+            return self._entries.get(identifier)
+
+    def get(self, identifier, load, restore=None, driver=None):
+        """
+        Return the CatalogEntry for identifier. If it is missing or has
+        expired 'load()' is called to build a new one (once, no matter how
+        many threads ask for it at the same time).
+
+        restore - Optional, restore(raw) builds an entry from the raw
+        objects load() listed. Entries are then kept in the catalog
+        snapshot, and missing ones are read from it (and loaded again in
+        the background). 'driver' is the libcloud driver the snapshot's
+        objects are restored for.
+        """
+        with self._lock:
+            entry = self._entries.get(identifier)
+            if entry and self._is_fresh(identifier, entry):
+                self._touch(identifier)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        if (not entry or entry.raw is None) and restore\
+                and get_catalog_snapshot():
+            entry = get_single_flight().do(
+                ('catalog-snapshot', self, identifier),
+                lambda: self._restore(identifier, load, restore, driver))
+            if entry:
+                return entry
+        return get_single_flight().do(
+            ('catalog', self, identifier),
+            lambda: self._load(identifier, load, restore))
+
+    def _load(self, identifier, load, restore=None):
+        entry = load()
+        if entry.loaded_at is None:
+            entry.loaded_at = time.time()
+        with self._lock:
+            self._put(identifier, entry)
+            self.loads += 1
+        logger.debug("Cached %s %s for identifier:%s"
+                     % (len(entry.items), self.name, identifier))
+        snapshot = get_catalog_snapshot() if restore else None
+        if snapshot:
+            snapshot.write(self.name, identifier, entry.raw,
+                           entry.loaded_at)
+        return entry
+
+    def _restore(self, identifier, load, restore, driver=None):
+        """
+        Read identifier's entry from the snapshot, and load it again in a
+        background thread. Returns None when there is nothing to read.
+        """
+        with self._lock:
+            added = self._entries.get(identifier)
+        if added and added.raw is not None:
+            #Restored (or loaded) while we waited
+            return added
+        saved = get_catalog_snapshot().read(self.name, identifier, driver)
+        if not saved:
+            return None
+        (saved_at, raw) = saved
+        entry = restore(raw)
+        #Used until the background load replaces it
+        entry.loaded_at = time.time()
+        with self._lock:
+            added = self._entries.get(identifier)
+            if added:
+                #Keep models added since the snapshot was written
+                for (item_id, item) in added.index.items():
+                    entry.index.setdefault(item_id, item)
+            self._put(identifier, entry)
+            self.restores += 1
+        logger.debug("Restored %s %s for identifier:%s from the snapshot"
+                     % (len(entry.items), self.name, identifier))
+        thread = threading.Thread(
+            target=self._revalidate, args=(identifier, load, restore),
+            name='catalog-%s-revalidate' % self.name)
+        thread.daemon = True
+        thread.start()
+        return entry
+
+    def _revalidate(self, identifier, load, restore):
+        try:
+            get_single_flight().do(
+                ('catalog', self, identifier),
+                lambda: self._load(identifier, load, restore))
+        except Exception:
+            logger.exception("Could not revalidate the %s of %s"
+                             % (self.name, identifier))
+
+    def store(self, identifier, entry):
+        """
+        Replace the entry for identifier.
+        """
+        with self._lock:
+            self._put(identifier, entry)
+
+    def lookup(self, identifier, item_id):
+        """
+        Return the model cached for item_id, or None. Never loads anything,
+        and stale entries are still used.
+        """
+        with self._lock:
+            entry = self._entries.get(identifier)
+        if not entry:
+            return None
+        return entry.index.get(item_id)
+
+    def add(self, identifier, item_id, item):
+        """
+        Add a single model to identifier's index (e.g. a new image).
+        A new entry is stale and never listed, so the next get() restores
+        the snapshot or lists everything.
+        """
+        with self._lock:
+            entry = self._entries.get(identifier)
+            if not entry:
+                entry = CatalogEntry(None, [], {})
+                self._put(identifier, entry)
+            #Readers only get() from the index, a single set is safe
+            entry.index[item_id] = item
+
+    def invalidate(self, identifier=None):
+        """
+        Load identifier (or every identifier) again on next use.
+        Cached models are still handed out by lookup() until then.
+        """
+        with self._lock:
+            if identifier is None:
+                entries = self._entries.values()
+            else:
+                entries = filter(None, [self._entries.get(identifier)])
+            for entry in entries:
+                entry.loaded_at = None
+            self.invalidations += 1
+
+    def invalidate_item(self, item_id):
+        """
+        Load every identifier whose entry holds item_id again on next use
+        (e.g. an image that changed). Other identifiers are left alone.
+        """
+        with self._lock:
+            for entry in self._entries.values():
+                if item_id in entry.index:
+                    entry.loaded_at = None
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'loads': self.loads, 'restores': self.restores,
+                    'invalidations': self.invalidations}
+
+
+def get_catalog(name):
+    return get_shared(('catalog', name), lambda: Catalog(name))
+
+
+def invalidate_catalog(name, identifier=None, item_id=None):
+    """
+    Hook for calls that change what a catalog holds (e.g. creating or
+    deleting an image, changing its metadata). With item_id only the
+    identifiers holding that item are invalidated.
+    """
+    catalog = get_catalog(name)
+    if item_id is not None:
+        catalog.invalidate_item(item_id)
+    else:
+        catalog.invalidate(identifier)
@@ -0,0 +1,238 @@
+"""
+On-disk snapshots of the machine and size catalogs.
+
+A new worker used to list images and flavors again for every identifier it
+saw, after every deploy or restart. Set CATALOG_SNAPSHOT_FILE to a local
+path and every catalog load is also written to that (SQLite) file. The next
+worker to start reads its entries from there when they are first asked for,
+and lists them again from the cloud in the background.
+"""
+import json
+import threading
+import time
+from datetime import datetime
+
+from libcloud.compute.base import NodeImage, NodeSize
+from libcloud.compute.drivers.openstack import OpenStackNodeSize
+from libcloud.utils.iso8601 import parse_date
+
+from threepio import logger
+
+from rtwo import settings
+from rtwo.drivers.compact import CompactExtra
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+#Snapshots older than this (in seconds) are ignored
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog_snapshot (
+    name TEXT NOT NULL,
+    identifier TEXT NOT NULL,
+    saved_at REAL NOT NULL,
+    records TEXT NOT NULL,
+    PRIMARY KEY (name, identifier)
+)"""
+
+
+_DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    #Anything else in 'extra' is kept as a string
+    return unicode(value)
+
+
+def _object_hook(obj):
+    if obj.keys() != ['__datetime__']:
+        return obj
+    value = obj['__datetime__']
+    if len(value) > 19 and value[-6] in '+-':
+        #Timezone aware
+        return parse_date(value)
+    for datetime_format in _DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, datetime_format)
+        except ValueError:
+            pass
+    return value
+
+
+def _plain_extra(obj, api_key=None):
+    """
+    obj.extra without its raw payload. (Compact extras are copied without
+    fetching it)
+    """
+    extra = dict(getattr(obj, 'extra', None) or {})
+    extra.pop(api_key, None)
+    return extra
+
+
+def dump_raw(raw):
+    """
+    Return libcloud NodeImages/NodeSizes as JSON-able records. The API
+    payload they were built from is kept too, when they have it.
+    """
+    records = []
+    for obj in raw:
+        if isinstance(obj, NodeSize):
+            records.append({
+                'type': 'size', 'id': obj.id, 'name': obj.name,
+                'ram': obj.ram, 'disk': obj.disk,
+                'bandwidth': obj.bandwidth, 'price': obj.price,
+                'vcpus': getattr(obj, 'vcpus', None),
+                'api': getattr(obj, '_api', None),
+                'extra': _plain_extra(obj)})
+        elif isinstance(obj, NodeImage):
+            records.append({
+                'type': 'image', 'id': obj.id, 'name': obj.name,
+                'api': dict.get(obj.extra or {}, 'api'),
+                'extra': _plain_extra(obj, 'api')})
+        else:
+            raise TypeError("Can't snapshot %r" % obj)
+    return records
+
+
+def _restore_size(record, driver):
+    if record['vcpus'] is not None:
+        size = OpenStackNodeSize(
+            record['id'], record['name'], record['ram'], record['disk'],
+            record['bandwidth'], record['price'], driver,
+            vcpus=record['vcpus'])
+        size.extra = record['extra']
+    else:
+        size = NodeSize(
+            record['id'], record['name'], record['ram'], record['disk'],
+            record['bandwidth'], record['price'], driver,
+            extra=record['extra'])
+    if record.get('api') is not None:
+        size._api = record['api']
+    return size
+
+
+def _restore_image(record, driver):
+    extra = record['extra']
+    if record.get('api') is not None:
+        extra['api'] = record['api']
+    elif hasattr(driver, '_payload_fetcher'):
+        #Written by a compact driver, fetch the payload if it is asked for
+        extra = CompactExtra(extra, 'api', driver._payload_fetcher(
+            '/images/%s' % record['id'], 'image'))
+    return NodeImage(record['id'], record['name'], driver, extra=extra)
+
+
+def restore_raw(records, driver=None):
+    """
+    Rebuild the libcloud objects written by dump_raw. With the libcloud
+    driver that listed them, records that kept their API payload are built
+    by the driver again (_to_size, _to_image), just like a new listing.
+    """
+    raw = []
+    for record in records:
+        to_model = None
+        if driver is not None and record.get('api') is not None:
+            to_model = getattr(driver, '_to_%s' % record['type'], None)
+        if to_model:
+            raw.append(to_model(record['api']))
+        elif record['type'] == 'size':
+            raw.append(_restore_size(record, driver))
+        else:
+            raw.append(_restore_image(record, driver))
+    return raw
+
+
+class CatalogSnapshot(object):
+    """
+    The raw objects of catalog entries, keyed by (catalog name, identifier).
+    Every operation opens its own connection, so any thread (or process)
+    can use the file. Errors are logged, a snapshot never breaks a listing.
+    """
+
+    def __init__(self, path, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._created = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5)
+        with self._lock:
+            if not self._created:
+                connection.execute(_SCHEMA)
+                connection.commit()
+                self._created = True
+        return connection
+
+    def read(self, name, identifier, driver=None):
+        """
+        Return (saved_at, raw) for identifier, None if there is no
+        usable snapshot. 'driver' is the libcloud driver the raw objects
+        are restored for (See restore_raw).
+        """
+        try:
+            connection = self._connect()
+            try:
+                row = connection.execute(
+                    "SELECT saved_at, records FROM catalog_snapshot"
+                    " WHERE name = ? AND identifier = ?",
+                    (name, unicode(identifier))).fetchone()
+            finally:
+                connection.close()
+            if not row:
+                return None
+            (saved_at, records) = row
+            if self.max_age and time.time() - saved_at > self.max_age:
+                return None
+            return (saved_at, restore_raw(
+                json.loads(records, object_hook=_object_hook), driver))
+        except Exception:
+            logger.exception("Could not read the %s snapshot of %s from %s"
+                             % (name, identifier, self.path))
+            return None
+
+    def write(self, name, identifier, raw, saved_at=None):
+        try:
+            records = json.dumps(dump_raw(raw), default=_default)
+            connection = self._connect()
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO catalog_snapshot"
+                    " (name, identifier, saved_at, records)"
+                    " VALUES (?, ?, ?, ?)",
+                    (name, unicode(identifier), saved_at or time.time(),
+                     records))
+                connection.commit()
+            finally:
+                connection.close()
+        except Exception:
+            logger.exception("Could not write the %s snapshot of %s to %s"
+                             % (name, identifier, self.path))
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def get_catalog_snapshot():
+    """
+    Return the CatalogSnapshot for settings.CATALOG_SNAPSHOT_FILE,
+    None when snapshots are off.
+    """
+    global _snapshot
+    path = settings.CATALOG_SNAPSHOT_FILE
+    if not path:
+        return None
+    if not sqlite3:
+        logger.warn("CATALOG_SNAPSHOT_FILE is set, but sqlite3 is not"
+                    " available. Catalog snapshots are off.")
+        return None
+    with _snapshot_lock:
+        if not _snapshot or _snapshot.path != path:
+            _snapshot = CatalogSnapshot(path)
+        return _snapshot
@@ -17,6 +17,7 @@ from threepio import logger
 
 from rtwo import settings
 from rtwo.drivers.common import LoggedScriptDeployment
+from rtwo.drivers.single_flight import coalesced
 
 from rtwo.exceptions import MissingArgsException, ServiceException
 
@@ -30,6 +31,10 @@ from rtwo.identity import OSIdentity
 
 from rtwo.mixins.driver import APIFilterMixin, MetaMixin,\
     InstanceActionMixin
+from rtwo.driver_pool import cloud_key
+from rtwo.occupancy import instance_event
+
+from rtwo.sync import InstanceSync
 
 
 class BaseDriver():
@@ -217,6 +222,14 @@ class EshDriver(LibcloudDriver, MetaMixin):
            and isinstance(identity, self.identityCls)):
             raise ServiceException('Wrong Provider or Identity')
 
+    def _coalesce_key(self):
+        """
+        Calls are only shared between drivers with the same provider and
+        credentials (See rtwo.drivers.single_flight)
+        """
+        return (self.provider.identifier,
+                repr(sorted(self.identity.credentials.items())))
+
     def list_all_volumes(self, *args, **kwargs):
         """
         Return the InstanceClass representation of a libcloud node
@@ -235,6 +248,9 @@ class EshDriver(LibcloudDriver, MetaMixin):
         """
         Return the InstanceClass representation of a libcloud node
         """
+        instance = self._lookup_instance(instance_id, all_tenants=True)
+        if instance is not NotImplemented:
+            return instance
         instances = self.list_all_instances()
         instance = [inst for inst in instances if inst.id == instance_id]
         if not instance:
@@ -248,21 +264,24 @@ class EshDriver(LibcloudDriver, MetaMixin):
         return self.provider.instanceCls.get_instances(
             super(EshDriver, self).list_instances(), self.provider)
 
+    @coalesced(share=list)
     def list_machines(self, *args, **kwargs):
         """
         Return the MachineClass representation of a libcloud NodeImage
         """
         return self.provider.machineCls.get_cached_machines(
             self.provider.identifier,
-            super(EshDriver, self).list_machines, *args, **kwargs)
+            super(EshDriver, self).list_machines, *args,
+            lc_driver=self._connection, **kwargs)
 
+    @coalesced(share=list)
     def list_sizes(self, *args, **kwargs):
         """
         Return the SizeClass representation of a libcloud NodeSize
         """
         return self.provider.sizeCls.get_sizes(
             self.provider,
-            super(EshDriver, self).list_sizes)
+            super(EshDriver, self).list_sizes, self._connection)
 
     def list_locations(self, *args, **kwargs):
         return super(EshDriver, self).list_locations()
@@ -391,7 +410,9 @@ class OSDriver(EshDriver, InstanceActionMixin):
         self._connection._ex_force_service_region =\
         self._connection.connection.service_region =\
             provider.options.get('region_name')
+        self._instance_sync = None
 
+    @coalesced(share=list)
     def list_machines(self, *args, **kwargs):
         """
         This openstack specific implementation caches machine lists
@@ -399,16 +420,100 @@ class OSDriver(EshDriver, InstanceActionMixin):
 
         Return the MachineClass representation of a libcloud NodeImage
         """
+        return self.provider.machineCls.get_cached_machines(
+            self._machine_identifier(),
+            super(EshDriver,self).list_machines, *args,
+            lc_driver=self._connection, **kwargs)
+
+    def _machine_identifier(self):
         #TODO: I don't like this implementation.. -Steve
         # Currently there is no 'override' if i dont want to use ex-tenant-name
         identifier = self.identity.credentials.get('ex_tenant_name')
         if not identifier:
             logger.debug("Could not find tenant_name, "
                          "falling back to provider identifier")
-            identifier = self.provider.identitifier
-        return self.provider.machineCls.get_cached_machines(
-            identifier,
-            super(EshDriver,self).list_machines, *args, **kwargs)
+            identifier = self.provider.identifier
+        return identifier
+
+    def _lookup_volume(self, alias):
+        lc_volume = self._connection.ex_find_volume(alias)
+        if not lc_volume:
+            return None
+        #An admin can GET any volume, list_volumes() only has our own
+        tenant_id = lc_volume.extra.get('tenantId')
+        if tenant_id and tenant_id != self._connection._get_tenant_id():
+            return None
+        return self.provider.volumeCls(lc_volume)
+
+    def _lookup_size(self, alias):
+        #The size index, when sizes have been listed
+        size = self.provider.sizeCls.lookup_size(alias, self.provider)
+        if size:
+            return size
+        lc_size = self._connection.ex_find_size(alias)
+        if not lc_size:
+            return None
+        return self.provider.sizeCls.get_size(lc_size, self.provider)
+
+    def _lookup_instance(self, alias, all_tenants=False):
+        node = self._connection.ex_find_node(alias)
+        if not node:
+            return None
+        #An admin can GET any server, list_instances() only has our own
+        if not all_tenants and node.extra.get('tenantId')\
+                != self._connection._get_tenant_id():
+            return None
+        return self.provider.instanceCls(node, self.provider)
+
+    def _lookup_machine(self, alias):
+        #The machine index, when machines have been listed
+        identifier = self._machine_identifier()
+        machine = self.provider.machineCls.lookup_cached_machine(
+            alias, identifier)
+        if machine:
+            return machine
+        #No tenant check: nova's image view has no owner, and glance lists
+        #an admin every tenant's private images too, so list_machines()
+        #has anything an admin can GET
+        lc_image = self._connection.ex_find_image(alias)
+        if not lc_image:
+            return None
+        return self.provider.machineCls.get_cached_machine(
+            lc_image, identifier)
+
+    def iter_all_instances(self, page_size=None, **kwargs):
+        """
+        Yield the InstanceClass representation of every node in every
+        tenant, while the rest of the listing is still being paged in.
+        """
+        for node in self._connection.iter_all_instances(page_size):
+            yield self.provider.instanceCls(node, self.provider)
+
+    def iter_all_volumes(self, page_size=None, **kwargs):
+        """
+        Yield the VolumeClass representation of every volume in every
+        tenant, while the rest of the listing is still being paged in.
+        """
+        for volume in self._connection.iter_all_volumes(page_size):
+            yield self.provider.volumeCls(volume)
+
+    @property
+    def instance_sync(self):
+        """
+        The InstanceSync table for this driver (created on first use).
+        """
+        if not self._instance_sync:
+            self._instance_sync = InstanceSync(self)
+        return self._instance_sync
+
+    def sync_instances(self, full=False):
+        """
+        Update this driver's table of instances (instance_sync.instances)
+        using only the servers changed since the last sync.
+
+        Return a dict of 'added', 'changed' and 'deleted' instances.
+        """
+        return self.instance_sync.sync(full=full)
 
 
     def deploy_init_to(self, *args, **kwargs):
@@ -556,20 +661,53 @@ class OSDriver(EshDriver, InstanceActionMixin):
             return False
         return True
 
+    def _instance_event(self, event, args, kwargs, result=None):
+        """
+        Tell occupancy trackers (See rtwo.occupancy) what happened to the
+        instance (or node) the call was made with.
+        """
+        instance = args[0] if args else kwargs.get('node')
+        if result and instance is not None:
+            instance_event(self._cloud(), event, instance)
+        return result
+
+    def _cloud(self):
+        """
+        The cloud this driver talks to (See driver_pool.cloud_key)
+        """
+        return cloud_key(type(self.provider), self.provider.options,
+                         self.identity.credentials)
+
+    def create_instance(self, *args, **kwargs):
+        instance = super(OSDriver, self).create_instance(*args, **kwargs)
+        if instance:
+            instance_event(self._cloud(), 'created', instance)
+        return instance
+
     def destroy_instance(self, *args, **kwargs):
-        return self._connection.destroy_node(*args, **kwargs)
+        return self._instance_event(
+            'destroyed', args, kwargs,
+            self._connection.destroy_node(*args, **kwargs))
 
     def start_instance(self, *args, **kwargs):
-        return self._connection.ex_start_node(*args, **kwargs)
+        return self._instance_event(
+            'started', args, kwargs,
+            self._connection.ex_start_node(*args, **kwargs))
 
     def stop_instance(self, *args, **kwargs):
-        return self._connection.ex_stop_node(*args, **kwargs)
+        return self._instance_event(
+            'stopped', args, kwargs,
+            self._connection.ex_stop_node(*args, **kwargs))
 
     def suspend_instance(self, *args, **kwargs):
-        return self._connection.ex_suspend_node(*args, **kwargs)
+        return self._instance_event(
+            'suspended', args, kwargs,
+            self._connection.ex_suspend_node(*args, **kwargs))
 
     def resume_instance(self, *args, **kwargs):
-        return self._connection.ex_resume_node(*args, **kwargs)
+        return self._instance_event(
+            'resumed', args, kwargs,
+            self._connection.ex_resume_node(*args, **kwargs))
 
     def resize_instance(self, *args, **kwargs):
         return self._connection.ex_resize(*args, **kwargs)
@@ -0,0 +1,125 @@
+"""
+Admin drivers shared by every Meta in the process.
+
+Meta.create_meta runs for every user driver that calls driver.meta(), and
+each Meta used to build its own admin provider, identity and driver (and
+log in to the cloud again). Admin drivers are now kept here, keyed by the
+provider's options and the admin credentials, and every Meta borrows the
+one that matches:
+
+    cloud = cloud_key(OSProvider, provider.options, identity.credentials)
+    driver = get_admin_driver_pool().get(
+        admin_driver_key(cloud, key, secret, tenant), create)
+
+A driver keeps its connection (and Keystone token) between Metas.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from threepio import logger
+
+from rtwo.drivers.single_flight import get_single_flight
+from rtwo.registry import get_shared
+
+#Admin drivers kept, the least recently used are dropped
+DEFAULT_MAX_DRIVERS = 32
+
+#Provider options that belong to an identity, not to the cloud
+CREDENTIAL_OPTIONS = ('key', 'secret', 'ex_tenant_name', 'ex_project_name')
+
+
+def _freeze(value):
+    """
+    A hashable copy of value (dicts and lists of provider options).
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for (key, item) in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def cloud_key(provider_cls, options, credentials=None):
+    """
+    Return what identifies a cloud: the provider's location and options
+    (auth URL, region, ...), without the credentials of whoever made the
+    driver. Every user of a cloud gets the same key.
+    """
+    credentials = credentials or {}
+    options = dict((name, value) for (name, value) in (options or {}).items()
+                   if name not in CREDENTIAL_OPTIONS
+                   and name not in credentials)
+    return (provider_cls.location, _freeze(options))
+
+
+def admin_driver_key(cloud, key, secret, tenant=None):
+    """
+    Return the pool key for an admin driver of cloud (See cloud_key).
+    The secret is only kept as a hash.
+    """
+    secret_hash = hashlib.sha256(
+        (u"%s|%s" % (key, secret or '')).encode('utf-8')).hexdigest()
+    return (cloud, key, tenant, secret_hash)
+
+
+class AdminDriverPool(object):
+    """
+    An LRU of admin drivers. Each one is created once, no matter how many
+    threads ask for it at the same time.
+    """
+
+    def __init__(self, max_drivers=DEFAULT_MAX_DRIVERS):
+        self.max_drivers = max_drivers
+        self._lock = threading.Lock()
+        self._drivers = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, create):
+        """
+        Return the driver for key, calling create() to build it if
+        there is none.
+        """
+        with self._lock:
+            driver = self._drivers.pop(key, None)
+            if driver is not None:
+                self._drivers[key] = driver
+                self.hits += 1
+                return driver
+            self.misses += 1
+        return get_single_flight().do(('admin-driver', self, key),
+                                      lambda: self._create(key, create))
+
+    def _create(self, key, create):
+        driver = create()
+        with self._lock:
+            self._drivers.pop(key, None)
+            self._drivers[key] = driver
+            while len(self._drivers) > self.max_drivers:
+                self._drivers.popitem(last=False)
+                self.evictions += 1
+        logger.debug("Created admin driver %s" % driver)
+        return driver
+
+    def invalidate(self, key=None):
+        """
+        Drop key's driver (or every driver), e.g. after the admin
+        credentials changed. Metas that borrowed it keep using it.
+        """
+        with self._lock:
+            if key is None:
+                self._drivers = OrderedDict()
+            else:
+                self._drivers.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'drivers': len(self._drivers), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+def get_admin_driver_pool():
+    return get_shared('admin_driver_pool', AdminDriverPool)
@@ -3,7 +3,6 @@ Extension of libcloud's Eucalyptus Node Driver.
 """
 import re, copy, string
 import base64, hmac, time
-from datetime import datetime
 
 from hashlib import sha256
 
@@ -17,6 +16,8 @@ from libcloud.utils.py3 import urlquote, b
 
 from threepio import logger
 
+from rtwo.drivers.common import parse_timestamp
+
 class Esh_EC2NodeDriver(EC2NodeDriver):
     """
     Amazon EC2 Node Driver
@@ -33,11 +34,8 @@ class Esh_EC2NodeDriver(EC2NodeDriver):
                 if value:
                     attachment_set[key] = value
         if attachment_set.get('attachTime', None):
-            if '.' in attachment_set['attachTime']:
-                attach_date = datetime.strptime(attachment_set['attachTime'], '%Y-%m-%dT%H:%M:%S.%fZ')
-            else:
-                attach_date = datetime.strptime(attachment_set['attachTime'], '%Y-%m-%dT%H:%M:%SZ')
-            attachment_set['attachTime'] = attach_date
+            attachment_set['attachTime'] = parse_timestamp(
+                attachment_set['attachTime'])
         return attachment_set
 
     def _to_volumes(self, element):
@@ -55,8 +53,7 @@ class Esh_EC2NodeDriver(EC2NodeDriver):
                                 name=name,
                                 size=int(volume['size']),
                                 driver=self)
-        svolume.extra = {'createTime': datetime.strptime(volume['createTime'],
-                                                         '%Y-%m-%dT%H:%M:%S.%fZ'),
+        svolume.extra = {'createTime': parse_timestamp(volume['createTime']),
                          'status': volume['status'],
                          'attachmentSet': self._get_attachment_set(element_as)}
         return svolume
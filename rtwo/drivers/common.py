@@ -2,6 +2,8 @@
 Common functions used by all Openstack managers.
 """
 import copy
+import re
+from datetime import datetime, timedelta
 
 import glanceclient
 from keystoneclient.exceptions import AuthorizationFailure
@@ -15,6 +17,8 @@ from libcloud.compute.deployment import ScriptDeployment
 from threepio import logger
 
 from rtwo import settings
+from rtwo.drivers.token_cache import get_token_cache, catalog_url
+from rtwo.drivers.instrumentation import get_instrumentation
 
 
 class LoggedScriptDeployment(ScriptDeployment):
@@ -43,9 +47,68 @@ class LoggedScriptDeployment(ScriptDeployment):
         return node
 
 
+#YYYY-MM-DDTHH:MM:SS[.ffffff][Z|+HH:MM|-HHMM]
+_ISO8601 = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)'
+    r'(?:\.(\d{1,6})\d*)?(Z|([+-])(\d\d):?(\d\d))?$')
+
+#Listings repeat the same timestamps (attachments, batches of volumes)
+_parsed_timestamps = {}
+MAX_PARSED_TIMESTAMPS = 10000
+
+
+def parse_timestamp(timestamp):
+    """
+    Parse the ISO 8601 times the OpenStack, Eucalyptus and EC2 APIs return
+    ('2013-06-24T11:20:13.000000', '2013-06-24T11:20:13Z',
+    '2013-06-24T11:20:13.123Z', ...) to a naive datetime in UTC, like
+    datetime.strptime would. Raises ValueError for anything else.
+    """
+    parsed = _parsed_timestamps.get(timestamp)
+    if parsed:
+        return parsed
+    match = _ISO8601.match(timestamp)
+    if not match:
+        raise ValueError("Not an ISO 8601 timestamp: %r" % timestamp)
+    (year, month, day, hour, minute, second, fraction,
+     zone, sign, zone_hours, zone_minutes) = match.groups()
+    parsed = datetime(int(year), int(month), int(day), int(hour),
+                      int(minute), int(second),
+                      int(fraction.ljust(6, '0')) if fraction else 0)
+    if sign:
+        offset = timedelta(hours=int(zone_hours), minutes=int(zone_minutes))
+        parsed = parsed - offset if sign == '+' else parsed + offset
+    if len(_parsed_timestamps) >= MAX_PARSED_TIMESTAMPS:
+        _parsed_timestamps.clear()
+    _parsed_timestamps[timestamp] = parsed
+    return parsed
+
+
+def _cached_access(auth_url=None, username=None, password=None,
+                   tenant_name=None, region_name=None, **kwargs):
+    """
+    Return the Keystone 'access' dict shared by every client logged in
+    with these credentials, or None if the client must log in itself.
+    """
+    if not (auth_url and username):
+        return None
+    return get_token_cache().get(auth_url, username, password,
+                                 tenant_name, region_name)
+
+
 def _connect_to_swift(*args, **kwargs):
     """
     """
+    if kwargs.get('auth_version') == 2 and not kwargs.get('preauthtoken'):
+        region_name = (kwargs.get('os_options') or {}).get('region_name')
+        access = _cached_access(kwargs.get('authurl'), kwargs.get('user'),
+                                kwargs.get('key'), kwargs.get('tenant_name'),
+                                region_name)
+        swift_url = access and catalog_url(access, 'object-store',
+                                           region_name)
+        if swift_url:
+            kwargs.update(preauthurl=swift_url,
+                          preauthtoken=access['token']['id'])
     swift = swift_client.Connection(*args, **kwargs)
     return swift
 
@@ -53,7 +116,20 @@ def _connect_to_swift(*args, **kwargs):
 def _connect_to_neutron(*args, **kwargs):
     """
     """
+    access = None
+    if not kwargs.get('token'):
+        access = _cached_access(**kwargs)
+    neutron_url = access and catalog_url(access, 'network',
+                                         kwargs.get('region_name'))
+    if neutron_url:
+        kwargs.update(token=access['token']['id'], endpoint_url=neutron_url)
     neutron = neutron_client.Client(*args, **kwargs)
+    if neutron_url:
+        #Normally set while logging in (See NetworkManager.get_credentials)
+        neutron.httpclient.auth_tenant_id =\
+            access['token'].get('tenant', {}).get('id')
+        neutron.httpclient.auth_user_id = access.get('user', {}).get('id')
+    get_instrumentation().instrument_client(neutron.httpclient, 'network')
     neutron.format = 'json'
     return neutron
 
@@ -63,20 +139,45 @@ def _connect_to_keystone(*args, **kwargs):
     """
     try:
         version = kwargs.get('version', 'v2.0')
+        keystone = None
         if version == 'v2.0':
             from keystoneclient.v2_0 import client as ks_client
+            keystone = _keystone_from_cache(ks_client, *args, **kwargs)
         else:
             from keystoneclient.v3 import client as ks_client
-        keystone = ks_client.Client(*args, **kwargs)
+        if not keystone:
+            keystone = ks_client.Client(*args, **kwargs)
+            if version == 'v2.0' and keystone.auth_ref:
+                get_token_cache().store(
+                    keystone.auth_ref, kwargs.get('auth_url'),
+                    kwargs.get('username'), kwargs.get('password'),
+                    kwargs.get('tenant_name'), kwargs.get('region_name'))
     except AuthorizationFailure as e:
         raise Exception("Authorization Failure: Bad keystone secrets or "
                         "firewall causing a timeout.")
     if version != 'v2.0':
         keystone.management_url = keystone.management_url.replace('v2.0', 'v3')
         keystone.version = 'v3'
+    get_instrumentation().instrument_client(keystone, 'identity')
     return keystone
 
 
+def _keystone_from_cache(ks_client, *args, **kwargs):
+    """
+    Build a keystone client around a cached token, skipping the login.
+    Returns None if there is no usable token in the cache.
+    """
+    if kwargs.get('token') or kwargs.get('auth_ref'):
+        return None
+    access = _cached_access(**kwargs)
+    if not access or not catalog_url(access, 'identity',
+                                     kwargs.get('region_name'),
+                                     endpoint_type='adminURL'):
+        return None
+    access['version'] = 'v2.0'
+    return ks_client.Client(*args, auth_ref=access, **kwargs)
+
+
 def _connect_to_glance(keystone, version='1', *args, **kwargs):
     """
     NOTE: We use v1 because moving up to v2 results in a LOSS OF
@@ -96,6 +197,12 @@ def _connect_to_nova(*args, **kwargs):
     kwargs = copy.deepcopy(kwargs)
     version = kwargs.get('version', '1.1')
     region_name = kwargs.get('region_name')
+    if not kwargs.get('auth_token'):
+        access = _cached_access(**kwargs)
+        nova_url = access and catalog_url(access, 'compute', region_name)
+        if nova_url:
+            kwargs.update(auth_token=access['token']['id'],
+                          bypass_url=nova_url)
     nova = nova_client.Client(version,
                               kwargs.pop('username'),
                               kwargs.pop('password'),
@@ -104,6 +211,7 @@ def _connect_to_nova(*args, **kwargs):
                               kwargs.pop('region_name'),
                               *args, no_cache=True, **kwargs)
     nova.client.region_name = region_name
+    get_instrumentation().instrument_client(nova.client, 'compute')
     return nova
 
 
@@ -0,0 +1,47 @@
+"""
+Compact models: drop the raw API payloads libcloud objects carry around.
+
+Nodes, images and volumes built by OpenStack_Esh_NodeDriver keep the whole
+API dict they were built from (extra['object'], extra['api']). On all-tenant
+listings that is most of the memory an instance uses. With
+'COMPACT_MODELS = True' in settings the driver leaves the payload out, and
+fetches it again only if something asks for it.
+"""
+import copy
+
+
+class CompactExtra(dict):
+    """
+    An 'extra' dict without its raw payload (normally found under 'key').
+    Reading extra[key] (or extra.get(key)) calls 'fetch' to get it back,
+    the result is kept from then on.
+    """
+    __slots__ = ('_key', '_fetch')
+
+    def __init__(self, extra, key, fetch):
+        dict.__init__(self, extra)
+        self.pop(key, None)
+        self._key = key
+        self._fetch = fetch
+
+    def __missing__(self, key):
+        if key != self._key:
+            raise KeyError(key)
+        #Two threads may both fetch it, only the first result is kept
+        return self.setdefault(key, self._fetch())
+
+    def get(self, key, default=None):
+        if key == self._key:
+            return self[key]
+        return dict.get(self, key, default)
+
+    def __copy__(self):
+        return CompactExtra(self, self._key, self._fetch)
+
+    def __deepcopy__(self, memo):
+        return CompactExtra(copy.deepcopy(dict(self), memo), self._key,
+                            self._fetch)
+
+    def __reduce__(self):
+        #The fetch function can't be pickled, pickle the plain dict instead
+        return (dict, (dict(self),))
@@ -0,0 +1,163 @@
+"""
+Process-wide pool of keep-alive HTTP(S) connections.
+
+Libcloud opens a brand new httplib connection (and TLS handshake) for every
+request. OpenStack_Esh_Connection checks connections out of this pool instead,
+so that every driver in the process shares the same warm sockets.
+"""
+import threading
+import time
+
+from rtwo.exceptions import ConnectionFailure
+from rtwo.registry import get_shared
+
+#Maximum number of connections (active + idle) held open for one host:port
+DEFAULT_MAX_PER_HOST = 10
+#Idle connections older than this (in seconds) are closed instead of reused
+DEFAULT_IDLE_TIMEOUT = 60
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive connections keyed by (connection class, host, port).
+
+    At most 'max_per_host' connections are open for a single key, callers
+    that go over the limit wait (up to 'wait_timeout' seconds) for a
+    connection to be released.
+    """
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, wait_timeout=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Condition(threading.Lock())
+        #key -> [(last_used, connection), ...] (Most recent last)
+        self._idle = {}
+        #key -> number of checked-out connections
+        self._active = {}
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def _key(self, conn_cls, host, port):
+        return (conn_cls, host, int(port))
+
+    def _open_count(self, key):
+        return self._active.get(key, 0) + len(self._idle.get(key, []))
+
+    def _prune(self, key, now):
+        """
+        Close idle connections that have outlived idle_timeout.
+        NOTE: Must be called while holding the lock.
+        """
+        idle = self._idle.get(key)
+        if not idle:
+            return
+        fresh = []
+        for (last_used, conn) in idle:
+            if now - last_used > self.idle_timeout:
+                self._close(conn)
+            else:
+                fresh.append((last_used, conn))
+        self._idle[key] = fresh
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.discarded += 1
+
+    def checkout(self, conn_cls, host, port, **conn_kwargs):
+        """
+        Return a connection to host:port, re-using an idle one when possible.
+        The caller MUST hand it back with 'release' when finished.
+        """
+        key = self._key(conn_cls, host, port)
+        wait_timeout = self.wait_timeout or conn_kwargs.get('timeout')
+        deadline = time.time() + wait_timeout if wait_timeout else None
+        with self._lock:
+            while True:
+                now = time.time()
+                self._prune(key, now)
+                idle = self._idle.get(key)
+                if idle:
+                    (_, conn) = idle.pop()
+                    self._active[key] = self._active.get(key, 0) + 1
+                    self.reused += 1
+                    conn._rtwo_pool_reused = True
+                    return conn
+                if self._open_count(key) < self.max_per_host:
+                    self._active[key] = self._active.get(key, 0) + 1
+                    break
+                if deadline and now >= deadline:
+                    raise ConnectionFailure(
+                        "Connection pool for %s:%s exhausted (%s open)"
+                        % (host, port, self.max_per_host))
+                self._lock.wait(deadline - now if deadline else None)
+        #Open the new connection outside of the lock.
+        try:
+            conn = conn_cls(host=host, port=int(port), **conn_kwargs)
+        except Exception:
+            with self._lock:
+                self._active[key] -= 1
+                self._lock.notify()
+            raise
+        conn._rtwo_pool_key = key
+        conn._rtwo_pool_reused = False
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        """
+        Return a connection to the pool. When 'discard' is True (or the pool
+        is full) the connection is closed instead of kept alive.
+        """
+        key = getattr(conn, '_rtwo_pool_key', None)
+        if key is None:
+            return
+        with self._lock:
+            self._active[key] = max(self._active.get(key, 0) - 1, 0)
+            if discard or self._open_count(key) >= self.max_per_host:
+                self._close(conn)
+            else:
+                self._idle.setdefault(key, []).append((time.time(), conn))
+            self._lock.notify()
+
+    def clear(self):
+        """
+        Close every idle connection held by the pool.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for (_, conn) in idle:
+                    self._close(conn)
+            self._idle = {}
+            self._lock.notify_all()
+
+    def stats(self):
+        """
+        Return a dict of pool metrics, including a per host:port breakdown.
+        """
+        with self._lock:
+            hosts = {}
+            for key in set(self._active.keys() + self._idle.keys()):
+                (_, host, port) = key
+                host_stats = hosts.setdefault("%s:%s" % (host, port),
+                                              {'active': 0, 'idle': 0})
+                host_stats['active'] += self._active.get(key, 0)
+                host_stats['idle'] += len(self._idle.get(key, []))
+            return {
+                'active': sum(h['active'] for h in hosts.values()),
+                'idle': sum(h['idle'] for h in hosts.values()),
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'hosts': hosts,
+            }
+
+
+def get_connection_pool():
+    return get_shared('connection_pool', ConnectionPool)
@@ -3,7 +3,6 @@ Extension of libcloud's Eucalyptus Node Driver.
 """
 import re
 import string
-from datetime import datetime
 
 from libcloud.utils.xml import fixxpath, findall, findtext, findattr
 from libcloud.compute.base import NodeSize, StorageVolume, NodeImage
@@ -11,6 +10,8 @@ from libcloud.compute.drivers.ec2 import EucNodeDriver, NAMESPACE
 
 from threepio import logger
 
+from rtwo.drivers.common import parse_timestamp
+
 
 class Eucalyptus_Esh_NodeDriver(EucNodeDriver):
     """
@@ -147,13 +148,8 @@ class Eucalyptus_Esh_NodeDriver(EucNodeDriver):
                 if value:
                     attachment_set[key] = value
         if attachment_set.get('attachTime', None):
-            if '.' in attachment_set['attachTime']:
-                attach_date = datetime.strptime(attachment_set['attachTime'],
-                                                '%Y-%m-%dT%H:%M:%S.%fZ')
-            else:
-                attach_date = datetime.strptime(attachment_set['attachTime'],
-                                                '%Y-%m-%dT%H:%M:%SZ')
-            attachment_set['attachTime'] = attach_date
+            attachment_set['attachTime'] = parse_timestamp(
+                attachment_set['attachTime'])
         return attachment_set
 
     def _to_volume(self, element, name=None):
@@ -170,12 +166,7 @@ class Eucalyptus_Esh_NodeDriver(EucNodeDriver):
                                 name=name,
                                 size=int(volume['size']),
                                 driver=self)
-        try:
-            created_time = datetime.strptime(volume['createTime'],
-                                             '%Y-%m-%dT%H:%M:%S.%fZ')
-        except ValueError:  # Wrong Format, try again..
-            created_time = datetime.strptime(volume['createTime'],
-                                             '%Y-%m-%dT%H:%M:%SZ')
+        created_time = parse_timestamp(volume['createTime'])
 
         svolume.extra = {
             'createTime': created_time,
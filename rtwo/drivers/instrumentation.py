@@ -0,0 +1,223 @@
+"""
+Per-request instrumentation for calls made to the OpenStack APIs.
+
+OpenStack_Esh_Connection.request and the neutron/keystone/nova clients built
+in rtwo.drivers.common report a RequestEvent for every call they make. Hooks
+registered with 'get_instrumentation().add_hook(hook)' receive every event,
+RequestHistogram is a hook that keeps latency histograms in memory:
+
+    histogram = RequestHistogram()
+    get_instrumentation().add_hook(histogram)
+    ...
+    print histogram.to_prometheus()
+"""
+import re
+import threading
+import time
+from urlparse import urlparse
+
+from threepio import logger
+
+from rtwo.registry import get_shared
+
+#Path segments that identify a single resource (uuids, ids, tenant ids, ...)
+_ID_SEGMENT = re.compile(
+    r'^([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+    r'[0-9a-fA-F]{12}|[0-9a-fA-F]{32}|\d+)$')
+
+#Upper bounds (in seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def normalize_path(url):
+    """
+    Turn a request url in to a template that is shared by every call to the
+    same API, e.g. '/servers/<uuid>/action?x=y' -> '/servers/{id}/action'
+    """
+    path = urlparse(url).path if '://' in url else url.split('?')[0]
+    segments = []
+    for segment in path.split('/'):
+        if segment.endswith('.json'):
+            segment = segment[:-len('.json')]
+        segments.append('{id}' if _ID_SEGMENT.match(segment) else segment)
+    return '/'.join(segments) or '/'
+
+
+class RequestEvent(object):
+    """
+    A single (possibly retried) call to an OpenStack API.
+
+    service - Catalog type of the API ('compute', 'volume', 'network', ...)
+    method/path - HTTP method and the normalized path template
+    status - HTTP status of the final response (None if there wasn't one)
+    duration - Seconds spent on the call, including retries
+    attempts - Number of times the request was sent
+    response_size - Bytes in the final response body
+    error - Name of the exception raised, None on success
+    """
+
+    def __init__(self, service, method, path, status=None, duration=0,
+                 attempts=1, response_size=0, error=None):
+        self.service = service
+        self.method = method
+        self.path = path
+        self.status = status
+        self.duration = duration
+        self.attempts = attempts
+        self.response_size = response_size
+        self.error = error
+
+    def __repr__(self):
+        return "<RequestEvent %s %s %s status=%s %.3fs attempts=%s>"\
+            % (self.service, self.method, self.path, self.status,
+               self.duration, self.attempts)
+
+
+class Instrumentation(object):
+    """
+    Passes RequestEvents along to every registered hook.
+    A hook that raises is logged, and never breaks the request.
+    """
+
+    def __init__(self):
+        self.hooks = []
+
+    def add_hook(self, hook):
+        if hook not in self.hooks:
+            self.hooks = self.hooks + [hook]
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks = [h for h in self.hooks if h is not hook]
+
+    def emit(self, event):
+        for hook in self.hooks:
+            try:
+                hook(event)
+            except Exception:
+                logger.exception("Instrumentation hook %s failed on %s"
+                                 % (hook, event))
+
+    def instrument_client(self, http_client, service):
+        """
+        Wrap the 'request(url, method, **kwargs)' method shared by the
+        neutron, keystone and nova clients so their calls are reported too.
+        """
+        client_request = http_client.request
+
+        def request(url, method, **kwargs):
+            if not self.hooks:
+                return client_request(url, method, **kwargs)
+            started = time.time()
+            event = RequestEvent(service, method, normalize_path(url))
+            try:
+                (resp, body) = client_request(url, method, **kwargs)
+            except Exception, e:
+                event.error = e.__class__.__name__
+                event.status = getattr(e, 'http_status', None)\
+                    or getattr(e, 'status_code', None)
+                raise
+            else:
+                event.status = getattr(resp, 'status_code', None)
+                event.response_size = len(getattr(resp, 'content', None)
+                                          or '')
+                return (resp, body)
+            finally:
+                event.duration = time.time() - started
+                self.emit(event)
+        http_client.request = request
+        return http_client
+
+
+class RequestHistogram(object):
+    """
+    Hook that aggregates RequestEvents in memory, grouped by
+    (service, method, path, status).
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def __call__(self, event):
+        key = (event.service, event.method, event.path, event.status)
+        with self._lock:
+            series = self._series.get(key)
+            if not series:
+                series = self._series[key] = {
+                    'count': 0, 'sum': 0.0, 'retries': 0, 'errors': 0,
+                    'response_bytes': 0,
+                    'buckets': [0] * len(self.buckets)}
+            series['count'] += 1
+            series['sum'] += event.duration
+            series['retries'] += max(event.attempts - 1, 0)
+            series['response_bytes'] += event.response_size or 0
+            if event.error:
+                series['errors'] += 1
+            for (idx, upper_bound) in enumerate(self.buckets):
+                if event.duration <= upper_bound:
+                    series['buckets'][idx] += 1
+
+    def reset(self):
+        with self._lock:
+            self._series = {}
+
+    def to_dict(self):
+        """
+        Return {service: {'METHOD /path': {status: series}}}
+        where each series holds count, sum, retries, errors, response_bytes
+        and (cumulative) buckets keyed by their upper bound.
+        """
+        result = {}
+        with self._lock:
+            for ((service, method, path, status), series) in\
+                    self._series.items():
+                series = dict(series)
+                series['buckets'] = dict(zip(self.buckets,
+                                             series['buckets']))
+                result.setdefault(service, {}).setdefault(
+                    "%s %s" % (method, path), {})[status] = series
+        return result
+
+    def to_prometheus(self, prefix='rtwo_openstack_request'):
+        """
+        Render the histograms in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP %s_seconds Time spent on OpenStack API calls." % prefix,
+            "# TYPE %s_seconds histogram" % prefix]
+        counters = []
+        with self._lock:
+            series_list = sorted(
+                (key, dict(series, buckets=list(series['buckets'])))
+                for (key, series) in self._series.items())
+        for ((service, method, path, status), series) in series_list:
+            labels = 'service="%s",method="%s",path="%s",status="%s"'\
+                % (service, method, path.replace('"', '\\"'),
+                   status if status is not None else '')
+            for (upper_bound, count) in zip(self.buckets,
+                                            series['buckets']):
+                lines.append('%s_seconds_bucket{%s,le="%s"} %s'
+                             % (prefix, labels, upper_bound, count))
+            lines.append('%s_seconds_bucket{%s,le="+Inf"} %s'
+                         % (prefix, labels, series['count']))
+            lines.append('%s_seconds_sum{%s} %s'
+                         % (prefix, labels, series['sum']))
+            lines.append('%s_seconds_count{%s} %s'
+                         % (prefix, labels, series['count']))
+            counters.append((labels, series))
+        for (name, help_text) in (
+                ('retries', 'Requests sent again after a failure.'),
+                ('errors', 'Calls that raised an exception.'),
+                ('response_bytes', 'Bytes received in response bodies.')):
+            lines.append("# HELP %s_%s_total %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+            for (labels, series) in counters:
+                lines.append('%s_%s_total{%s} %s'
+                             % (prefix, name, labels, series[name]))
+        return "\n".join(lines) + "\n"
+
+
+def get_instrumentation():
+    return get_shared('instrumentation', Instrumentation)
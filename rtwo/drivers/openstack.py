@@ -2,14 +2,15 @@
 Extension of libcloud's OpenStack Node Driver.
 """
 import binascii
+import calendar
 import copy
-import random
 import json
 import os
 import socket
 import sys
+import threading
 import time
-from datetime import datetime
+import zlib
 
 from threepio import logger
 
@@ -19,86 +20,415 @@ from libcloud.compute.types import Provider, NodeState, DeploymentError,\
     LibcloudError
 from libcloud.compute.base import StorageVolume, VolumeSnapshot,\
     NODE_ONLINE_WAIT_TIMEOUT, SSH_CONNECT_TIMEOUT,\
-    NodeAuthPassword, NodeDriver
+    NodeAuthPassword, NodeDriver, Node
 from libcloud.compute.deployment import MultiStepDeployment, ScriptDeployment
 from libcloud.compute.drivers.openstack import \
         OpenStack_1_1_NodeDriver,\
-        OpenStack_1_1_Connection
+        OpenStack_1_1_Connection,\
+        OpenStack_1_1_Response
+from libcloud.common.openstack import OpenStackServiceCatalog
+from libcloud.common.types import MalformedResponseError
+from libcloud.utils.iso8601 import parse_date
+from libcloud.utils.networking import is_public_subnet
 from libcloud.utils.py3 import httplib
 try:
     from lxml import etree as ET
 except ImportError:
     from xml.etree import ElementTree as ET
+#Decode large listings with the fastest JSON library available
+try:
+    import ujson as fast_json
+except ImportError:
+    try:
+        import simplejson as fast_json
+    except ImportError:
+        fast_json = json
 
 from neutronclient.common.exceptions import NeutronClientException
 
 from rfive.fabricSSH import FabricSSHClient
 
-from rtwo.exceptions import NonZeroDeploymentException, ConnectionFailure
+from rtwo import settings
+from rtwo.catalog import invalidate_catalog
+from rtwo.exceptions import NonZeroDeploymentException, ConnectionFailure,\
+    OverLimitException, NotFoundException
+from rtwo.drivers.common import parse_timestamp
+from rtwo.drivers.compact import CompactExtra
+from rtwo.drivers.connection_pool import get_connection_pool
+from rtwo.drivers.token_cache import get_token_cache
+from rtwo.drivers.instrumentation import get_instrumentation,\
+    RequestEvent, normalize_path
+from rtwo.drivers.single_flight import get_single_flight
+from rtwo.drivers.retry import RetryPolicy, OVER_LIMIT_STATUSES,\
+    parse_retry_after
 from rtwo.drivers.openstack_network import NetworkManager
 from rtwo.drivers.openstack_user import UserManager
-import functools
 
-def swap_service_catalog(service_type=None, name=None):
+#Compressed bytes read from the socket at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def read_response_body(response):
     """
-    Use this temporary decorator to take advantage of the full service catalog
-    offered by OpenStack.
-    TODO:Remove this when JMatts decorator is merged in!
+    Read an httplib response, decompressing a gzip/deflate body as it
+    arrives instead of buffering it and running it through GzipFile.
     """
-    def decorator(method):
-        def service_catalog_switch(*args, **kwargs):
-            """
-            Switch service_catalog endpoints, then switch back!
-            """
-            driver = args[0]
-            lc_conn = driver.connection
-            if not lc_conn.service_catalog:
-                lc_conn.get_service_catalog() # Make a request.
-            if lc_conn._ex_force_base_url:
-                old_endpoint = lc_conn._ex_force_base_url
-            else:
-                old_endpoint = lc_conn.get_endpoint()
-            try:
-                new_service = lc_conn.service_catalog.get_endpoint(
-                    service_type=service_type, name=name,
-                    region=lc_conn.service_region)
-                if getattr(new_service, "url"):
-                    lc_conn._ex_force_base_url = new_service.url
-                else:
-                    lc_conn._ex_force_base_url = new_service["url"]
-                return method(*args, **kwargs)
-            finally:
-                lc_conn._ex_force_base_url = old_endpoint
-        return service_catalog_switch
-    return decorator
+    encoding = (response.getheader('content-encoding') or '').lower()
+    if encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding in ('zlib', 'deflate'):
+        decompressor = zlib.decompressobj()
+    else:
+        return response.read().strip()
+    chunks = []
+    while True:
+        chunk = response.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunks.append(decompressor.decompress(chunk))
+    chunks.append(decompressor.flush())
+    #Stripped like a plain body, so both parse (and look empty) the same
+    return ''.join(chunks).strip()
+
+
+class OpenStack_Esh_Response(OpenStack_1_1_Response):
+
+    def __init__(self, response, connection):
+        #libcloud skips its own (buffered) decompression when the body is
+        #handed over as '_original_data' (See LoggingConnection)
+        if not getattr(response, '_original_data', None):
+            response._original_data = read_response_body(response)
+        super(OpenStack_Esh_Response, self).__init__(response, connection)
+
+    def _decompress_response(self, body, headers):
+        #Already decompressed by read_response_body
+        return body
+
+    def parse_body(self):
+        """
+        Decode JSON bodies with fast_json (ujson/simplejson if installed)
+        """
+        if self.status == httplib.NO_CONTENT or not self.body\
+                or not self.has_content_type('application/json'):
+            return super(OpenStack_Esh_Response, self).parse_body()
+        try:
+            return fast_json.loads(self.body)
+        except ValueError:
+            raise MalformedResponseError('Failed to parse JSON',
+                                         body=self.body,
+                                         driver=self.node_driver)
+
+    def _retry_after(self):
+        """
+        Seconds to wait, from the Retry-After header or the 'retryAfter'
+        value nova includes in its overLimit body.
+        """
+        retry_after = parse_retry_after(self.headers.get('retry-after'))
+        if retry_after is not None:
+            return retry_after
+        try:
+            fault = self.parse_body().values()[0]
+            return parse_retry_after(fault.get('retryAfter'))
+        except Exception:
+            return None
+
+    def parse_error(self):
+        """
+        Raise OverLimitException for 413/429 so the retry policy can
+        honor Retry-After, and NotFoundException for a 404 during a
+        lookup (See OpenStack_Esh_Connection.find).
+        """
+        if int(self.status) in OVER_LIMIT_STATUSES:
+            raise OverLimitException(
+                "%s %s %s" % (self.status, self.error, self.body),
+                retry_after=self._retry_after())
+        error = super(OpenStack_Esh_Response, self).parse_error()
+        if int(self.status) == httplib.NOT_FOUND\
+                and getattr(self.connection._local, 'finding', False):
+            raise NotFoundException(error)
+        return error
+
+
+def _copy_response(response):
+    """
+    Callers that shared a coalesced GET each get their own parsed object,
+    many _to_* builders modify the dicts they are given.
+    """
+    response = copy.copy(response)
+    response.object = copy.deepcopy(response.object)
+    return response
+
 
 class OpenStack_Esh_Connection(OpenStack_1_1_Connection):
+    responseCls = OpenStack_Esh_Response
+
+    #Keep-alive HTTP(S) connections shared by every driver in the process
+    connection_pool = get_connection_pool()
+
+    #Decides which failed requests are tried again (See rtwo.drivers.retry)
+    retry_policy = RetryPolicy()
+
+    #Keystone tokens shared by every driver and manager (See token_cache)
+    token_cache = get_token_cache()
+
+    #Hooks called with a RequestEvent after every request
+    instrumentation = get_instrumentation()
+
+    #Identical GETs in flight at the same time share one response
+    single_flight = get_single_flight()
+    coalesce_gets = True
+
     #Ripped from OpenStackBaseConnection.__init__()
     def __init__(self, *args, **kwargs):
+        #httplib connections are checked out per-thread (See 'connection')
+        self._local = threading.local()
+        retry_policy = kwargs.pop('retry_policy', None)
+        if retry_policy:
+            self.retry_policy = retry_policy
         timeout = kwargs.pop('timeout',None)
         if not timeout:
             timeout=8 # Default 8 Second timeouts
         super(OpenStack_Esh_Connection, self).__init__(
             *args, timeout=timeout, **kwargs)
 
-    def request(self, action, params=None,
-                data='', headers=None, method='GET', attempts=3):
-        current_attempt = 0
-        while current_attempt < attempts:
+    def _get_http_connection(self):
+        return getattr(self._local, 'connection', None)
+
+    def _set_http_connection(self, connection):
+        self._local.connection = connection
+
+    connection = property(_get_http_connection, _set_http_connection)
+
+    def connect(self, host=None, port=None, base_url=None):
+        """
+        Check out a keep-alive connection from the shared pool,
+        instead of opening a new one for every request.
+        (See libcloud.common.base.Connection.connect)
+        """
+        self._release_connection()
+        secure = self.secure
+        if getattr(self, 'base_url', None) and base_url is None:
+            base_url = self.base_url
+        if base_url is not None:
+            (host, port, secure, _) = self._tuple_from_url(base_url)
+        else:
+            host = host or self.host
+            port = port or self.port
+        #The retry policy may shorten the timeout to fit its deadline
+        timeout = getattr(self._local, 'timeout', None) or self.timeout
+        conn_kwargs = {}
+        if timeout:
+            conn_kwargs['timeout'] = timeout
+        if self.proxy_url:
+            conn_kwargs['proxy_url'] = self.proxy_url
+        connection = self.connection_pool.checkout(
+            self.conn_classes[secure], host, port, **conn_kwargs)
+        if timeout and getattr(connection, '_rtwo_pool_reused', False):
+            connection.timeout = timeout
+            if getattr(connection, 'sock', None):
+                connection.sock.settimeout(timeout)
+        self.connection = connection
+
+    def _release_connection(self, discard=False):
+        """
+        Hand the current thread's connection back to the pool.
+        """
+        connection = self.connection
+        if connection is None:
+            return
+        self.connection = None
+        self.connection_pool.release(connection, discard=discard)
+
+    def pool_stats(self):
+        """
+        Active/idle connection counts for the shared connection pool.
+        """
+        return self.connection_pool.stats()
+
+    def _get_service_region(self):
+        """
+        The region libcloud picks endpoints from. Tokens are cached per
+        region, so everyone sharing them (See get_user_manager) uses this.
+        """
+        return self._ex_force_service_region or self.service_region
+
+    def _token_identity(self):
+        return {'auth_url': self._get_auth_url(),
+                'username': self.user_id,
+                'password': self.key,
+                'tenant_name': self._ex_tenant_name,
+                'region_name': self._get_service_region()}
+
+    def _load_access(self, osa, access):
+        """
+        Use a cached Keystone 'access' dict instead of logging in.
+        """
+        osa.auth_token = access['token']['id']
+        osa.auth_token_expires = parse_date(access['token']['expires'])
+        osa.urls = access.get('serviceCatalog', [])
+        osa.auth_user_info = access.get('user', {})
+        self.auth_token = osa.auth_token
+        self.auth_token_expires = osa.auth_token_expires
+        self.auth_user_info = osa.auth_user_info
+        self.service_catalog = OpenStackServiceCatalog(
+            service_catalog=osa.urls, auth_version=self._auth_version)
+
+    def _dump_access(self, osa):
+        """
+        Libcloud keeps the pieces of Keystone's 'access' dict, put it back
+        together so that the OpenStack clients can use it too.
+        """
+        token = {'id': osa.auth_token,
+                 'expires': osa.auth_token_expires.isoformat()}
+        for service in osa.urls:
+            for endpoint in service.get('endpoints', []):
+                if endpoint.get('tenantId'):
+                    token['tenant'] = {'id': endpoint['tenantId'],
+                                       'name': self._ex_tenant_name}
+                    break
+            if 'tenant' in token:
+                break
+        return {'token': token,
+                'serviceCatalog': osa.urls,
+                'user': osa.auth_user_info}
+
+    def _populate_hosts_and_request_paths(self):
+        """
+        Check the shared token cache before libcloud logs in to Keystone,
+        and share the token with everyone else when it does.
+        """
+        if self._ex_force_auth_token\
+                or not (self._auth_version or '').startswith('2.0'):
+            return super(OpenStack_Esh_Connection,
+                         self)._populate_hosts_and_request_paths()
+        osa = self.get_auth_class()
+        identity = self._token_identity()
+        if not osa.is_token_valid() or not self.token_cache.is_fresh(
+                calendar.timegm(osa.auth_token_expires.utctimetuple())):
+            access = self.token_cache.get(**identity)
+            if access:
+                self._load_access(osa, access)
+            else:
+                #Refresh the token before it expires in the middle of a call
+                osa.auth_token = None
+        previous_token = osa.auth_token
+        super(OpenStack_Esh_Connection,
+              self)._populate_hosts_and_request_paths()
+        if osa.auth_token != previous_token:
+            self.token_cache.store(self._dump_access(osa), **identity)
+
+    def _pooled_request(self, **request_kwargs):
+        """
+        Make a single request on a pooled connection, then return the
+        connection to the pool. If a re-used connection was closed by the
+        server while idle, the request is tried once more on a new one,
+        unless its method isn't safe to retry (See RetryPolicy).
+        """
+        stale_retry = request_kwargs.get('method', 'GET').upper()\
+            in self.retry_policy.retry_methods
+        while True:
             try:
-                current_attempt += 1
                 response = super(OpenStack_1_1_Connection, self).request(
+                    **request_kwargs)
+            except (httplib.HTTPException, socket.error):
+                reused = getattr(self.connection, '_rtwo_pool_reused', False)
+                self._release_connection(discard=True)
+                if reused and stale_retry:
+                    stale_retry = False
+                    continue
+                raise
+            except Exception:
+                #The response was read in full, the connection is still good.
+                self._release_connection()
+                raise
+            self._release_connection()
+            return response
+
+    def request(self, action, params=None,
+                data='', headers=None, method='GET', attempts=None):
+        """
+        Make a request, retrying failures as allowed by self.retry_policy.
+        attempts - Override the policy's max_attempts for this call
+        """
+        if self.coalesce_gets and method == 'GET' and not data:
+            key = self._coalesce_key(action, params, headers)
+            return self.single_flight.do(
+                key,
+                lambda: self._request(action, params, data, headers,
+                                      method, attempts),
+                share=_copy_response)
+        return self._request(action, params, data, headers, method, attempts)
+
+    def find(self, action):
+        """
+        GET a single resource, None if it doesn't exist (404).
+        Not coalesced, so only this call turns a 404 in to None.
+        """
+        self._local.finding = True
+        try:
+            return self._request(action, None, '', None, 'GET', None)
+        except NotFoundException:
+            return None
+        finally:
+            self._local.finding = False
+
+    def _coalesce_key(self, action, params, headers):
+        return (self._get_auth_url(), self.user_id, self.key,
+                self._ex_tenant_name,
+                self._get_service_region(),
+                self._ex_force_service_type or self.service_type,
+                self._ex_force_base_url,
+                action, tuple(sorted((params or {}).items())),
+                tuple(sorted((headers or {}).items())))
+
+    def _request(self, action, params, data, headers, method, attempts):
+        retry = self.retry_policy.begin(method, max_attempts=attempts)
+        if not self.instrumentation.hooks:
+            return self._retry_request(retry, action, params, data,
+                                       headers, method)
+        service = self._ex_force_service_type or self.service_type
+        event = RequestEvent(service, method, normalize_path(action))
+        started = time.time()
+        try:
+            response = self._retry_request(retry, action, params, data,
+                                           headers, method)
+        except Exception, e:
+            event.error = e.__class__.__name__
+            event.status = getattr(e, 'http_code', None)
+            raise
+        else:
+            event.status = response.status
+            event.response_size = len(response.body or '')
+            return response
+        finally:
+            event.duration = time.time() - started
+            event.attempts = retry.attempt
+            self.instrumentation.emit(event)
+
+    def _retry_request(self, retry, action, params, data, headers, method):
+        while True:
+            self._local.timeout = retry.next_attempt(self.timeout)
+            try:
+                response = self._pooled_request(
                         action=action,
                         params=params, data=data,
                         method=method, headers=headers)
                 return response
+            except OverLimitException, e:
+                sleep_time = retry.backoff(e)
+                if sleep_time is None:
+                    raise
+                logger.warn("Request %s %s was rate limited. Retry #%s/%s"
+                            % (method, action, retry.attempt,
+                               retry.max_attempts))
             except (httplib.HTTPException, socket.error,
                     socket.gaierror, httplib.BadStatusLine), e:
                 _hostname = "%s:%s" % (self.host,self.port)
                 logger.error("Request %s %s%s failed with error: %s - %s. Retry #%s/%s"
                         % (method, _hostname, action, e.__class__.__name__, e.args,
-                           current_attempt, attempts))
-                if current_attempt >= attempts:
+                           retry.attempt, retry.max_attempts))
+                sleep_time = retry.backoff(e)
+                if sleep_time is None:
                     logger.error("Final attempt failed! Request diagnostics:"
                             "base_url=%s action=%s, params=%s, data=%s,"
                             "method=%s, headers=%s"
@@ -108,12 +438,54 @@ class OpenStack_Esh_Connection(OpenStack_1_1_Connection):
                           "Final connection attempt exhausted:"\
                           " %s - %s" % (_hostname, e),\
                           sys.exc_info()[2]
-                #DON'T FORGET TO WAIT BEFORE YOU RETRY! (4sec, 8sec)
-                sleep_time = random.randint(0,2 ** current_attempt)
-                time.sleep(sleep_time)
-                logger.error("Waited %s seconds. Attempting again." % sleep_time)
-            except Exception, e:
-                raise
+            finally:
+                self._local.timeout = None
+            #DON'T FORGET TO WAIT BEFORE YOU RETRY!
+            time.sleep(sleep_time)
+            logger.error("Waited %.2f seconds. Attempting again." % sleep_time)
+
+class OpenStack_Esh_ServiceConnection(OpenStack_Esh_Connection):
+    """
+    Connection to another service in the catalog (volume, identity, ...)
+    Authentication is shared with the driver's (compute) connection, and the
+    endpoint is resolved once per token instead of once per call.
+    """
+
+    def __init__(self, parent_conn, service_type, service_name=None):
+        self.parent_conn = parent_conn
+        self._endpoint_token = None
+        super(OpenStack_Esh_ServiceConnection, self).__init__(
+            parent_conn.user_id, parent_conn.key,
+            secure=parent_conn.secure,
+            timeout=parent_conn.timeout,
+            retry_policy=parent_conn.retry_policy,
+            ex_force_auth_url=parent_conn._ex_force_auth_url,
+            ex_force_auth_version=parent_conn._auth_version,
+            ex_tenant_name=parent_conn._ex_tenant_name,
+            ex_force_service_type=service_type,
+            ex_force_service_name=service_name)
+
+    def get_auth_class(self):
+        return self.parent_conn.get_auth_class()
+
+    def _populate_hosts_and_request_paths(self):
+        """
+        Let the parent connection (re-)authenticate, then point this
+        connection at our service's endpoint.
+        """
+        parent = self.parent_conn
+        parent._populate_hosts_and_request_paths()
+        if self._endpoint_token and self._endpoint_token == parent.auth_token:
+            return
+        self.auth_token = parent.auth_token
+        self.auth_token_expires = parent.auth_token_expires
+        self.auth_user_info = parent.auth_user_info
+        self.service_catalog = parent.service_catalog
+        self.service_region = parent.service_region
+        self._ex_force_service_region = parent._ex_force_service_region
+        self._set_up_connection_info(url=self.get_endpoint())
+        self._endpoint_token = parent.auth_token
+
 
 class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
     """
@@ -121,6 +493,12 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
     """
     connectionCls = OpenStack_Esh_Connection
 
+    #Servers/volumes requested per page by iter_all_instances/volumes
+    ALL_TENANTS_PAGE_SIZE = 200
+
+    #Addresses without an 'OS-EXT-IPS:type' on these networks are public
+    PUBLIC_NETWORK_LABELS = ('public', 'internet')
+
     features = {
         "_to_volume": ["Convert native object to StorageVolume"],
         "_to_size": ["Add cpu info to extra, duplicate of vcpu"],
@@ -160,9 +538,41 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
         "ex_delete_security_group_rule": ["Remove rule from a group"],
         "ex_list_security_group_rules": ["List all rules for a group"],
         "ex_get_limits": ["Get Rate and Absolute API limits"],
+        "iter_all_instances": ["Page through instances from all tenants"],
+        "iter_all_volumes": ["Page through volumes from all tenants"],
         "ex_os_services": ["Manage services (os-services)"]
     }
 
+    def __init__(self, *args, **kwargs):
+        super(OpenStack_Esh_NodeDriver, self).__init__(*args, **kwargs)
+        #service_type -> OpenStack_Esh_ServiceConnection
+        self._service_connections = {}
+        #manager class -> (credentials, token expiration, manager)
+        self._managers = {}
+        #Leave raw API payloads out of nodes, images and volumes
+        self.compact_payloads = settings.COMPACT_MODELS
+
+    def _service_connection(self, service_type, service_name=None):
+        """
+        Return the connection for service_type, creating it on first use.
+        """
+        connection = self._service_connections.get(service_type)
+        if not connection:
+            connection = OpenStack_Esh_ServiceConnection(
+                self.connection, service_type, service_name)
+            connection.driver = self
+            connection = self._service_connections.setdefault(
+                service_type, connection)
+        return connection
+
+    @property
+    def volume_connection(self):
+        return self._service_connection("volume", "cinder")
+
+    @property
+    def identity_connection(self):
+        return self._service_connection("identity", "keystone")
+
     """
     Object builders -- Convert the native dict in to a Libcloud object
     """
@@ -206,7 +616,7 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
             api_volume = self._cinder_volume_args(api_volume)
         volume = super(OpenStack_Esh_NodeDriver, self)._to_volume(api_volume)
 
-        created_time = datetime.strptime(api_volume['createdAt'], '%Y-%m-%dT%H:%M:%S.%f')
+        created_time = parse_timestamp(api_volume['createdAt'])
         volume.extra.update({
             'id': api_volume['id'],
             'object': api_volume,
@@ -218,15 +628,44 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
             'snapshotId': api_volume['snapshotId'],
             'createTime': created_time,
         })
+        if cinder:
+            #Only cinder says whose volume it is (and only to an admin)
+            volume.extra['tenantId'] = api_volume.get(
+                'os-vol-tenant-attr:tenant_id')
+        if self.compact_payloads and cinder:
+            #Fetched again from cinder, so 'object' keeps the same keys
+            volume.extra = CompactExtra(
+                volume.extra, 'object',
+                self._payload_fetcher('/volumes/%s' % volume.id, 'volume',
+                                      self.volume_connection,
+                                      self._cinder_volume_args))
+        elif self.compact_payloads:
+            volume.extra = CompactExtra(
+                volume.extra, 'object',
+                self._payload_fetcher('/os-volumes/%s' % volume.id, 'volume'))
         return volume
 
+    def _payload_fetcher(self, action, key, connection=None, convert=None):
+        """
+        Return a function that requests the raw payload of one object
+        again, for compact nodes, images and volumes.
+        connection - Default: the compute connection
+        convert - Optional, applied to the payload
+        """
+        def fetch():
+            payload = (connection or self.connection).request(action)\
+                .object[key]
+            return convert(payload) if convert else payload
+        return fetch
+
     def _to_size(self, api_size):
         """
         Extends Openstack_1_1_NodeDriver._to_size,
         adds support for cpu
         """
         size = super(OpenStack_Esh_NodeDriver, self)._to_size(api_size)
-        size._api = api_size
+        if not self.compact_payloads:
+            size._api = api_size
         size.extra = {
             'cpu': api_size['vcpus'],
             'ephemeral': api_size.get('OS-FLV-EXT-DATA:ephemeral', 0),
@@ -242,7 +681,12 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
         #logger.debug(api_machine)
         image = super(OpenStack_Esh_NodeDriver, self)._to_image(api_machine)
         image.extra['state'] = api_machine['status'].lower()
-        image.extra['api'] = api_machine
+        if self.compact_payloads:
+            image.extra = CompactExtra(
+                image.extra, 'api',
+                self._payload_fetcher('/images/%s' % image.id, 'image'))
+        else:
+            image.extra['api'] = api_machine
         return image
 
     def neutron_set_ips(self, node, floating_ips):
@@ -272,7 +716,102 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
         return networks
 
     def _to_nodes(self, el):
-        return [self._to_node(api_node) for api_node in el['servers']]
+        return [self._to_node_fast(api_node) for api_node in el['servers']]
+
+    def ex_to_instances(self, api_nodes, provider):
+        """
+        Convert server dicts (from /servers/detail) straight to
+        provider.instanceCls, using _to_node_fast.
+        """
+        return provider.instanceCls.get_instances(
+            [self._to_node_fast(api_node) for api_node in api_nodes],
+            provider)
+
+    def _is_public_ip(self, addr):
+        try:
+            return is_public_subnet(addr)
+        except Exception:
+            #IPv6
+            return False
+
+    def _to_node_fast(self, api_node):
+        """
+        Build the same node as _to_node(api_node) in one pass over the
+        server dict, without the super()._to_node, _set_ips and
+        extra.update round trips. (Used for listings)
+        """
+        #OpenStack_1_1_NodeDriver._to_node: the address type decides (in
+        #libcloud 0.17 for IPv4 too), then the network label, then the subnet
+        public_ips, private_ips, other_ips = [], [], []
+        for (label, ip_addrs) in api_node['addresses'].items():
+            for ip in ip_addrs:
+                addr = ip['addr']
+                ip_type = ip.get('OS-EXT-IPS:type')
+                if ip_type == 'floating':
+                    public_ips.append(addr)
+                    continue
+                other_ips.append(addr)
+                if ip_type != 'fixed' and (
+                        label in self.PUBLIC_NETWORK_LABELS
+                        or self._is_public_ip(addr)):
+                    public_ips.append(addr)
+                else:
+                    private_ips.append(addr)
+        #_set_ips: floating addresses are public (they already are),
+        #everything else is private too
+        for addr in other_ips:
+            if addr not in private_ips:
+                private_ips.append(addr)
+        metadata = api_node['metadata']
+        if private_ips and not public_ips and 'public-ip' in metadata:
+            public_ips = [metadata['public-ip']]
+        image = api_node.get('image')
+        status = api_node['status']
+        node = Node(
+            id=api_node['id'],
+            name=api_node['name'],
+            state=self.NODE_STATE_MAP.get(status, NodeState.UNKNOWN),
+            public_ips=public_ips,
+            private_ips=private_ips,
+            driver=self,
+            extra={
+                'hostId': api_node['hostId'],
+                'access_ip': api_node.get('accessIPv4'),
+                'tenantId': api_node.get('tenant_id') or api_node['tenantId'],
+                'imageId': image.get('id') if image else None,
+                'flavorId': api_node['flavor']['id'],
+                'uri': next(link['href'] for link in api_node['links']
+                            if link['rel'] == 'self'),
+                'metadata': metadata,
+                'password': api_node.get('adminPass'),
+                'created': api_node['created'],
+                'updated': api_node['updated'],
+                'key_name': api_node.get('key_name'),
+                'disk_config': api_node.get('OS-DCF:diskConfig'),
+                'config_drive': api_node.get('config_drive', False),
+                'availability_zone': api_node.get(
+                    'OS-EXT-AZ:availability_zone'),
+                'addresses': api_node['addresses'],
+                'status': status.lower(),
+                'fault': api_node.get('fault', {}),
+                'task': api_node.get('OS-EXT-STS:task_state'),
+                'power': api_node.get('OS-EXT-STS:power_state'),
+                'object': api_node
+            })
+        if self.compact_payloads:
+            self._compact_node(node, api_node)
+        return node
+
+    def _compact_node(self, node, api_node):
+        #Keep what OSInstance needs to find its boot volume, and what
+        #OSMeta needs to find its compute node
+        node.extra['volumes_attached'] = api_node.get(
+            'os-extended-volumes:volumes_attached')
+        node.extra['hypervisor_hostname'] = api_node.get(
+            'OS-EXT-SRV-ATTR:hypervisor_hostname')
+        node.extra = CompactExtra(
+            node.extra, 'object',
+            self._payload_fetcher('/servers/%s' % node.id, 'server'))
 
     def _to_node(self, api_node, floating_ips=[]):
         """
@@ -319,6 +858,8 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
             'power': api_node.get('OS-EXT-STS:power_state'),
             'object': api_node
         })
+        if self.compact_payloads:
+            self._compact_node(node, api_node)
         return node
 
     def _copy_connection(self, **update_args):
@@ -354,9 +895,8 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
     #        ex_force_service_type='identity',
     #        ex_force_service_name='keystone')
 
-    @swap_service_catalog(service_type="identity", name="keystone")
     def _keystone_list_tenants(self):
-        tenant_resp = self.connection.request('/tenants').object
+        tenant_resp = self.identity_connection.request('/tenants').object
         all_tenants = tenant_resp['tenants']
         return all_tenants
 
@@ -891,16 +1431,111 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
             method='GET')
         return self._to_nodes(server_resp.object)
 
-    @swap_service_catalog(service_type="volume", name="cinder")
     def ex_list_all_volumes(self):
-        lc_conn = self.connection
+        lc_conn = self.volume_connection
         server_resp = lc_conn.request(
             '/volumes/detail?all_tenants=1',
             method='GET')
         return self._to_volumes(server_resp.object, cinder=True)
 
+    def ex_volume_index(self, all_tenants=False, project_id=None):
+        """
+        Return {volume_id: volume} built from a single volume listing,
+        of this tenant's volumes (or every tenant's volumes).
+        project_id - Only that tenant's volumes, which may not be ours
+        (an admin listing another tenant's instances)
+        """
+        if all_tenants:
+            volumes = self.ex_list_all_volumes()
+        #Nodes listed by this driver have authenticated it, don't log in
+        #just to compare tenants
+        elif project_id and self.connection.request_path\
+                and project_id != self._get_tenant_id():
+            volumes = [self._to_volume(api_volume, cinder=True)
+                       for api_volume in self._iter_pages(
+                           self.volume_connection, '/volumes/detail',
+                           'volumes', params={'project_id': project_id})]
+        else:
+            volumes = self.list_volumes()
+        return dict((volume.id, volume) for volume in volumes)
+
+    def _find_resource(self, action, key, to_model, connection=None):
+        """
+        GET a single resource, None if it doesn't exist.
+        """
+        response = (connection or self.connection).find(action)
+        if response is None:
+            return None
+        return to_model(response.object[key])
+
+    def ex_find_node(self, node_id):
+        return self._find_resource('/servers/%s' % node_id, 'server',
+                                   self._to_node_fast)
+
+    def ex_find_volume(self, volume_id):
+        #From cinder, which has the volume's tenant (See _lookup_volume)
+        return self._find_resource(
+            '/volumes/%s' % volume_id, 'volume',
+            lambda api_volume: self._to_volume(api_volume, cinder=True),
+            self.volume_connection)
+
+    def ex_find_size(self, size_id):
+        return self._find_resource('/flavors/%s' % size_id, 'flavor',
+                                   self._to_size)
+
+    def ex_find_image(self, image_id):
+        return self._find_resource('/images/%s' % image_id, 'image',
+                                   self._to_image)
+
+    def iter_all_instances(self, page_size=None, changes_since=None):
+        """
+        Yield every instance from all tenants of a user, one page (of
+        page_size servers) in memory at a time.
+
+        changes_since - Only yield servers updated at (or after) this
+        ISO 8601 time. NOTE: This includes servers that were deleted.
+        """
+        params = {'changes-since': changes_since} if changes_since else None
+        for api_node in self._iter_pages(self.connection, '/servers/detail',
+                                         'servers', page_size, params):
+            yield self._to_node_fast(api_node)
+
+    def iter_all_volumes(self, page_size=None):
+        """
+        Yield every volume from all tenants of a user, one page (of
+        page_size volumes) in memory at a time.
+        """
+        for api_volume in self._iter_pages(self.volume_connection,
+                                           '/volumes/detail', 'volumes',
+                                           page_size):
+            yield self._to_volume(api_volume, cinder=True)
+
+    def _iter_pages(self, lc_conn, action, key, page_size=None, params=None):
+        """
+        Page through an all_tenants listing using limit/marker.
+        """
+        page_size = page_size or self.ALL_TENANTS_PAGE_SIZE
+        marker = None
+        #Ids already yielded, in case the API ignores 'marker'
+        seen = set()
+        while True:
+            page_params = dict(params or {}, all_tenants=1, limit=page_size)
+            if marker:
+                page_params['marker'] = marker
+            items = lc_conn.request(action, params=page_params,
+                                    method='GET').object.get(key, [])
+            new_items = [item for item in items if item['id'] not in seen]
+            for item in new_items:
+                seen.add(item['id'])
+                yield item
+            #A short page is the last page. A long page means the API
+            #ignored 'limit' and sent everything at once. A page with
+            #nothing new means it ignored 'marker'.
+            if len(items) != page_size or not new_items:
+                return
+            marker = items[-1]['id']
+
 
-    @swap_service_catalog(service_type="volume", name="cinder")
     def ex_update_volume(self, volume, **volume_updates):
         """
         Updates the editable attributes of a volume,
@@ -921,36 +1556,34 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
             volume_updates['display_description'] = \
                     volume_updates.pop('displayDescription')
 
-        server_resp = self.connection.request(
+        server_resp = self.volume_connection.request(
                 '/volumes/%s' % volume.id,
                 method='PUT', data={'volume':volume_updates},
                 )
         return self._to_volume(server_resp.object['volume'], cinder=True)
 
-    @swap_service_catalog(service_type="volume", name="cinder")
     def ex_update_volume_metadata(self, volume, metadata):
         """
         Volume Metadata update
         metadata == dict of key/value metadata to be associated
         """
         data_dict = {'metadata': metadata}
-        server_resp = self.connection.request('/volumes/%s/metadata' % volume.id,
-                                              method='PUT',
-                                              data=data_dict)
+        server_resp = self.volume_connection.request(
+                '/volumes/%s/metadata' % volume.id,
+                method='PUT',
+                data=data_dict)
         try:
             return (server_resp.status == 200, server_resp.object['metadata'])
         except Exception, e:
             logger.exception("Exception occured updating volume")
             return (False, None)
 
-    @swap_service_catalog(service_type="volume", name="cinder")
     def ex_delete_volume_metadata_key(self, volume, metadata_key):
         """
         """
-        data_dict = {'metadata': metadata}
-        server_resp = self.connection.request(
+        server_resp = self.volume_connection.request(
                 '/volumes/%s/metadata/%s' % (volume.id, metadata_key),
-                                              method='DELETE')
+                method='DELETE')
         try:
             return server_resp.status == 200
         except Exception, e:
@@ -1293,10 +1926,38 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
         return ip_list
 
     def get_user_manager(self):
-        return UserManager.lc_driver_init(self)
+        return self._cached_manager(UserManager)
 
     def get_network_manager(self):
-        return NetworkManager.lc_driver_init(self)
+        return self._cached_manager(NetworkManager)
+
+    def _manager_credentials(self):
+        return (self.key, self.secret, self._ex_tenant_name,
+                self._ex_force_auth_url,
+                self.connection._get_service_region())
+
+    def _cached_manager(self, manager_cls):
+        """
+        Return this driver's manager_cls, building it on first use, and again
+        when the credentials change or the token it was built with expires.
+        """
+        credentials = self._manager_credentials()
+        cached = self._managers.get(manager_cls)
+        if cached:
+            (manager_credentials, expires, manager) = cached
+            if manager_credentials == credentials and (
+                    expires is None
+                    or self.connection.token_cache.is_fresh(expires)):
+                return manager
+        #Authenticate the driver first, the manager's clients are then built
+        #around the driver's (cached) token instead of logging in again.
+        self.connection._populate_hosts_and_request_paths()
+        expires = self.connection.auth_token_expires
+        if expires:
+            expires = calendar.timegm(expires.utctimetuple())
+        manager = manager_cls.lc_driver_init(self)
+        self._managers[manager_cls] = (credentials, expires, manager)
+        return manager
 
     def neutron_disassociate_ip(self, node, *args, **kwargs):
         """
@@ -1333,7 +1994,7 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
         instead we use neutronclient directly..
         Hopefully Openstack provides a better option soon.
         """
-        network_manager = NetworkManager.lc_driver_init(self)
+        network_manager = self.get_network_manager()
         ports = network_manager.find_server_ports(node.id)
         for p in ports:
             network_manager.delete_port(p)
@@ -1397,6 +2058,25 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
             method='DELETE')
         return resp.status == httplib.NO_CONTENT
 
+    def create_image(self, node, name, metadata=None):
+        """
+        Create an image of node, our tenant's cached machines are listed
+        again after.
+        """
+        image = super(OpenStack_Esh_NodeDriver, self).create_image(
+            node, name, metadata=metadata)
+        #Machines are cached per tenant name (See OSDriver.list_machines)
+        invalidate_catalog('machines', self._ex_tenant_name)
+        return image
+
+    def delete_image(self, image):
+        """
+        Delete image, cached machines that include it are listed again after.
+        """
+        deleted = super(OpenStack_Esh_NodeDriver, self).delete_image(image)
+        invalidate_catalog('machines', item_id=image.id)
+        return deleted
+
     def ex_get_image_metadata(self, image, key):
         """
         Get an Image's metadata.
@@ -1444,10 +2124,12 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
 
         @rtype: C{dict}
         """
-        return self.connection.request(
+        metadata = self.connection.request(
             '/images/%s/metadata' % (image.id,), method='POST',
             data={'metadata': metadata}
         ).object['metadata']
+        invalidate_catalog('machines', item_id=image.id)
+        return metadata
 
     def ex_replace_image_metadata(self, image, metadata):
         """
@@ -1462,10 +2144,12 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
         @rtype: C{dict}
         """
         self._json_safe_meta_values(metadata)
-        return self.connection.request(
+        metadata = self.connection.request(
             '/images/%s/metadata' % (image.id,), method='PUT',
             data={'metadata': metadata}
         ).object['metadata']
+        invalidate_catalog('machines', item_id=image.id)
+        return metadata
 
     def ex_delete_image_metadata(self, image, key):
         """
@@ -1482,6 +2166,7 @@ class OpenStack_Esh_NodeDriver(OpenStack_1_1_NodeDriver):
         resp = self.connection.request(
             '/images/%s/metadata/%s' % (image.id, key,),
             method='DELETE')
+        invalidate_catalog('machines', item_id=image.id)
         return resp.status == httplib.NO_CONTENT
 
     #Server Shelve Actions
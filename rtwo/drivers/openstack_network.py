@@ -299,7 +299,7 @@ class NetworkManager(object):
             'tenant_name': lc_driver._ex_tenant_name,
             #Libcloud requires /v2.0/tokens -- OS clients do not.
             'auth_url': lc_driver._ex_force_auth_url.replace('/tokens',''),
-            'region_name': lc_driver._ex_force_service_region}
+            'region_name': lc_driver.connection._get_service_region()}
         lc_driver_args.update(kwargs)
         manager = NetworkManager(*args, **lc_driver_args)
         return manager
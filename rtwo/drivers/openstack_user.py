@@ -29,7 +29,7 @@ class UserManager():
             'password': lc_driver.secret,
             'tenant_name': lc_driver._ex_tenant_name,
             'auth_url': lc_driver._ex_force_auth_url.replace('/tokens',''),
-            'region_name': lc_driver._ex_force_service_region
+            'region_name': lc_driver.connection._get_service_region()
         }
         lc_driver_args.update(kwargs)
         manager = UserManager(*args, **lc_driver_args)
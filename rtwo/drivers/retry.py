@@ -0,0 +1,131 @@
+"""
+Retry policies for OpenStack_Esh_Connection.request
+
+A RetryPolicy decides whether a failed request is tried again, and how long to
+wait before it is. Every call gets an overall deadline, so a slow API can not
+hold a worker hostage for longer than 'deadline' seconds.
+"""
+import random
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+from rtwo.exceptions import OverLimitException
+
+#Requests that can be sent twice without creating something twice.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+#Status codes OpenStack uses to say 'slow down'
+OVER_LIMIT_STATUSES = (413, 429)
+
+
+def parse_retry_after(value):
+    """
+    Convert a Retry-After value (delta-seconds or an HTTP-date) to seconds.
+    Returns None if the value can not be understood.
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    parsed_date = parsedate_tz(str(value))
+    if not parsed_date:
+        return None
+    return max(mktime_tz(parsed_date) - time.time(), 0)
+
+
+class RetryPolicy(object):
+    """
+    Retry idempotent requests that failed at the connection level, and any
+    request rejected as over-limit, using decorrelated jitter between tries.
+
+    max_attempts - Total number of tries (1 disables retries)
+    deadline - Seconds a call (all attempts + waiting) may take, None for no limit
+    base_delay/max_delay - Bounds (in seconds) for the jittered wait
+    retry_methods - HTTP methods that are safe to retry after a connection error
+    """
+
+    def __init__(self, max_attempts=3, deadline=20, base_delay=0.5,
+                 max_delay=8, retry_methods=IDEMPOTENT_METHODS):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_methods = retry_methods
+
+    def begin(self, method, max_attempts=None):
+        """
+        Start tracking a single call.
+        """
+        return RetryState(self, method, max_attempts or self.max_attempts)
+
+    def is_retryable(self, method, error):
+        """
+        Over-limit responses were never acted on by the API, so they are safe
+        to retry for any method. Connection errors are only retried for
+        idempotent methods, a POST may have already been processed.
+        """
+        if isinstance(error, OverLimitException):
+            return True
+        return method.upper() in self.retry_methods
+
+    def next_delay(self, previous_delay):
+        """
+        Decorrelated jitter: sleep = min(max, random(base, previous * 3))
+        """
+        return min(self.max_delay,
+                   random.uniform(self.base_delay, previous_delay * 3))
+
+
+class RetryState(object):
+    """
+    Bookkeeping for the attempts of a single call.
+    """
+
+    def __init__(self, policy, method, max_attempts):
+        self.policy = policy
+        self.method = method
+        self.max_attempts = max_attempts
+        self.attempt = 0
+        self.started = time.time()
+        self.delay = policy.base_delay
+
+    def remaining(self):
+        """
+        Seconds left before the deadline (None if the policy has no deadline)
+        """
+        if self.policy.deadline is None:
+            return None
+        return self.policy.deadline - (time.time() - self.started)
+
+    def next_attempt(self, timeout=None):
+        """
+        Count a new attempt and return the socket timeout it should use,
+        never more than the time left before the deadline.
+        """
+        self.attempt += 1
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        remaining = max(remaining, 0.1)
+        return min(timeout, remaining) if timeout else remaining
+
+    def backoff(self, error):
+        """
+        Return the number of seconds to wait before trying again,
+        or None if the call should give up and raise 'error'.
+        """
+        if self.attempt >= self.max_attempts:
+            return None
+        if not self.policy.is_retryable(self.method, error):
+            return None
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after is not None:
+            delay = retry_after
+        else:
+            delay = self.delay = self.policy.next_delay(self.delay)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        return delay
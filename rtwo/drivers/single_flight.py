@@ -0,0 +1,107 @@
+"""
+Single-flight request coalescing.
+
+When many threads ask for the same thing at the same time (a dashboard
+loading sizes, machines and hypervisor statistics for one identity) only the
+first caller does the work. Everyone else who asks while that call is in
+flight waits for it, and shares its result (or its exception).
+"""
+import functools
+import sys
+import threading
+
+from rtwo.registry import get_shared
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        #The share function of every follower, and what each one gets
+        self.shares = []
+        self.shared = []
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls that share a key.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        #key -> _Call in flight
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, share=None):
+        """
+        Return fn(), unless a call with the same key is already in flight,
+        then wait for that call and return share(result) instead.
+        'share' should copy anything the caller could mutate. Copies are
+        made before the leader's caller gets the result (and may change it).
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+                slot = len(call.shares)
+                call.shares.append(share)
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.shared[slot]
+        try:
+            call.result = fn()
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if not call.error:
+                try:
+                    call.shared = [share(call.result) if share
+                                   else call.result
+                                   for share in call.shares]
+                except:
+                    call.error = sys.exc_info()
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._calls),
+                    'leaders': self.leaders,
+                    'coalesced': self.coalesced}
+
+
+def get_single_flight():
+    return get_shared('single_flight', SingleFlight)
+
+
+def coalesced(share=None):
+    """
+    Decorator for EshDriver methods: concurrent calls with the same driver
+    identity and arguments share a single call.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = (method, self._coalesce_key(), args,
+                   tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                #Unhashable arguments, can't tell if calls are identical
+                return method(self, *args, **kwargs)
+            return get_single_flight().do(
+                key, lambda: method(self, *args, **kwargs), share=share)
+        return wrapper
+    return decorator
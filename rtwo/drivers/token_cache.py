@@ -0,0 +1,235 @@
+"""
+Keystone token cache shared by drivers, managers and worker processes.
+
+Libcloud connections, UserManager (keystone, nova, swift) and NetworkManager
+each logged in to Keystone on their own. Tokens are now cached per identity
+(auth_url, username, tenant, region) and handed out until shortly before
+they expire. Set OPENSTACK_TOKEN_CACHE_FILE (e.g. a file in /dev/shm) to share
+one token per identity between every worker process on the host.
+"""
+import calendar
+import copy
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+from libcloud.utils.iso8601 import parse_date
+
+from threepio import logger
+
+from rtwo import settings
+from rtwo.registry import get_shared
+
+#Tokens expiring within this many seconds are refreshed instead of re-used
+DEFAULT_REFRESH_MARGIN = 300
+
+
+def normalize_auth_url(auth_url):
+    """
+    Libcloud wants '.../v2.0/tokens', the OpenStack clients want '.../v2.0'.
+    Both should find the same token.
+    """
+    auth_url = (auth_url or '').rstrip('/')
+    if auth_url.endswith('/tokens'):
+        auth_url = auth_url[:-len('/tokens')]
+    return auth_url
+
+
+def token_expiration(access):
+    """
+    Return the time (in seconds since the epoch) the token in a
+    Keystone v2 'access' dict expires.
+    """
+    expires = parse_date(access['token']['expires'])
+    return calendar.timegm(expires.utctimetuple())
+
+
+def catalog_url(access, service_type, region_name=None,
+                endpoint_type='publicURL'):
+    """
+    Find the endpoint for 'service_type' in an 'access' dict's catalog.
+    Returns None when the catalog has no such endpoint.
+    """
+    for service in access.get('serviceCatalog', []):
+        if service.get('type') != service_type:
+            continue
+        for endpoint in service.get('endpoints', []):
+            if region_name and endpoint.get('region') != region_name:
+                continue
+            if endpoint.get(endpoint_type):
+                return endpoint[endpoint_type]
+    return None
+
+
+class TokenCache(object):
+    """
+    Keystone v2 'access' dicts (token, catalog and user) keyed by identity.
+
+    Entries remember a hash of the password they were issued for, so the
+    wrong password will never be handed a cached token. When 'path' is set
+    the cache is mirrored to that file (under fcntl locks), so that other
+    processes can re-use the tokens we get, and we can re-use theirs.
+    """
+
+    def __init__(self, path=None, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        #key -> {'access': {...}, 'expires': epoch, 'secret': sha256}
+        self._tokens = {}
+        self._file_mtime = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _key(self, auth_url, username, tenant_name, region_name=None):
+        return "|".join([normalize_auth_url(auth_url), username or '',
+                         tenant_name or '', region_name or ''])
+
+    def _secret(self, key, password):
+        value = u"%s|%s" % (key, password or '')
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    def is_fresh(self, expires):
+        """
+        True if a token expiring at 'expires' (seconds since the epoch)
+        should still be used, False if it is time to get a new one.
+        """
+        return expires - time.time() > self.refresh_margin
+
+    def get(self, auth_url, username, password, tenant_name,
+            region_name=None):
+        """
+        Return a copy of the cached 'access' dict for this identity,
+        or None if there is no fresh token for it.
+        """
+        key = self._key(auth_url, username, tenant_name, region_name)
+        with self._lock:
+            self._read_file()
+            entry = self._tokens.get(key)
+            if not entry or not self.is_fresh(entry['expires'])\
+                    or entry['secret'] != self._secret(key, password):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copy.deepcopy(entry['access'])
+
+    def store(self, access, auth_url, username, password, tenant_name,
+              region_name=None):
+        """
+        Cache the 'access' dict returned by Keystone for this identity.
+        """
+        key = self._key(auth_url, username, tenant_name, region_name)
+        try:
+            entry = {'access': copy.deepcopy(dict(access)),
+                     'expires': token_expiration(access),
+                     'secret': self._secret(key, password)}
+        except (KeyError, TypeError, ValueError), e:
+            logger.warn("Could not cache token for %s: %s" % (username, e))
+            return
+        with self._lock:
+            self._tokens[key] = entry
+            self.stores += 1
+            self._write_file({key: entry})
+
+    def invalidate(self, auth_url, username, tenant_name, region_name=None):
+        """
+        Forget the token for this identity (e.g. after it was revoked).
+        """
+        key = self._key(auth_url, username, tenant_name, region_name)
+        with self._lock:
+            self._tokens.pop(key, None)
+            self._write_file({key: None})
+
+    def clear(self):
+        """
+        Forget every token held in memory. (The file is left alone)
+        """
+        with self._lock:
+            self._tokens = {}
+            self._file_mtime = None
+
+    def stats(self):
+        with self._lock:
+            return {'tokens': len(self._tokens), 'hits': self.hits,
+                    'misses': self.misses, 'stores': self.stores}
+
+    def _open_file(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        return os.fdopen(fd, 'r+')
+
+    def _load_entries(self, cache_file):
+        cache_file.seek(0)
+        contents = cache_file.read()
+        if not contents:
+            return {}
+        try:
+            return json.loads(contents)
+        except ValueError:
+            logger.warn("Ignoring corrupt token cache %s" % self.path)
+            return {}
+
+    def _read_file(self):
+        """
+        Merge tokens written by other processes since our last look.
+        NOTE: Must be called while holding the lock.
+        """
+        if not self.path:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._file_mtime:
+                return
+            with self._open_file() as cache_file:
+                fcntl.flock(cache_file, fcntl.LOCK_SH)
+                entries = self._load_entries(cache_file)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                logger.warn("Could not read token cache %s: %s"
+                            % (self.path, e))
+            return
+        self._file_mtime = mtime
+        self._merge(entries)
+
+    def _merge(self, entries):
+        for (key, entry) in entries.items():
+            current = self._tokens.get(key)
+            if not current or entry['expires'] > current['expires']:
+                self._tokens[key] = entry
+
+    def _write_file(self, changes):
+        """
+        Apply 'changes' (key -> entry, None to delete) to the cache file,
+        dropping any tokens that have expired.
+        NOTE: Must be called while holding the lock.
+        """
+        if not self.path:
+            return
+        try:
+            with self._open_file() as cache_file:
+                fcntl.flock(cache_file, fcntl.LOCK_EX)
+                entries = self._load_entries(cache_file)
+                entries.update(changes)
+                now = time.time()
+                entries = dict((key, entry)
+                               for (key, entry) in entries.items()
+                               if entry and entry['expires'] > now)
+                cache_file.seek(0)
+                cache_file.truncate()
+                json.dump(entries, cache_file)
+                cache_file.flush()
+            #We have seen everything in the file now, keep it
+            self._merge(entries)
+            self._file_mtime = os.stat(self.path).st_mtime
+        except (IOError, OSError), e:
+            logger.warn("Could not write token cache %s: %s"
+                        % (self.path, e))
+
+
+def get_token_cache():
+    return get_shared('token_cache', lambda: TokenCache(
+        path=settings.OPENSTACK_TOKEN_CACHE_FILE))
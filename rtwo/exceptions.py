@@ -17,3 +17,20 @@ class ConnectionFailure(ServiceException):
 
 class MissingArgsException(ServiceException):
     pass
+
+
+class NotFoundException(ServiceException):
+    """
+    The API has no such resource (404).
+    """
+    pass
+
+
+class OverLimitException(ServiceException):
+    """
+    The API refused the request (413/429) because a rate limit was hit.
+    retry_after is the number of seconds the API asked us to wait (or None).
+    """
+    def __init__(self, message, retry_after=None):
+        super(OverLimitException, self).__init__(message)
+        self.retry_after = retry_after
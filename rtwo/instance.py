@@ -2,19 +2,80 @@
 Atmosphere service instance.
 
 """
+import threading
+
 from threepio import logger
 
-from rtwo.provider import AWSProvider, EucaProvider, OSProvider
+from rtwo import settings
+from rtwo.provider import AWSProvider, EucaProvider, OSProvider,\
+    provider_attribute
 from rtwo.volume import OSVolume, Volume, MockVolume
 from rtwo.machine import OSMachine, Machine, MockMachine
 from rtwo.size import Size, MockSize
 
+#Placeholder for lazy attributes that haven't been computed yet
+_UNSET = object()
+
+
+class lazy_attribute(object):
+    """
+    Attribute computed by the decorated method the first time it is read.
+    The result (or anything assigned to it) is kept in '_<name>'.
+    """
+
+    def __init__(self, method):
+        self.method = method
+        self.cache_name = '_%s' % method.__name__
+        self.__doc__ = method.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = getattr(obj, self.cache_name, _UNSET)
+        if value is _UNSET:
+            value = self.method(obj)
+            setattr(obj, self.cache_name, value)
+        return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.cache_name, value)
+
+
+class BootVolumeIndex(object):
+    """
+    The volumes a listing of nodes may have booted from. They are fetched
+    with one volume listing the first time any of them is needed, instead
+    of one request per node.
+    """
+
+    def __init__(self, driver, all_tenants=False, project_id=None):
+        self.driver = driver
+        self.all_tenants = all_tenants
+        self.project_id = project_id
+        self._volumes = None
+        self._lock = threading.Lock()
+
+    def get(self, volume_id):
+        with self._lock:
+            if self._volumes is None:
+                try:
+                    self._volumes = self.driver.ex_volume_index(
+                        all_tenants=self.all_tenants,
+                        project_id=self.project_id)
+                except Exception:
+                    logger.exception("Could not list volumes, looking up "
+                                     "boot volumes one at a time.")
+                    self._volumes = {}
+        return self._volumes.get(volume_id)
+
 
 class Instance(object):
+    #Slotted (no __dict__) only with settings.COMPACT_MODELS
+    if settings.COMPACT_MODELS:
+        __slots__ = ('_node', 'id', 'alias', 'name', 'extra', '_provider',
+                     'owner', '_ip', '_source')
 
-    owner = None
-    provider = None
-    source = None
+    provider = provider_attribute(None)
     machine = NotImplementedError(
             "This field is deprecated. Use 'source' instead")
     size = None
@@ -50,8 +111,17 @@ class Instance(object):
         self.name = node.name
         self.extra = node.extra
         self.provider = provider
-        self.ip = self.get_public_ip()
-        self.source = self._get_source_for_instance(node)
+
+    @lazy_attribute
+    def ip(self):
+        return self.get_public_ip()
+
+    @lazy_attribute
+    def source(self):
+        """
+        Resolved on first use, listing instances shouldn't pay for it.
+        """
+        return self._get_source_for_instance(self._node)
 
     @classmethod
     def get_instances(cls, nodes, provider):
@@ -73,6 +143,11 @@ class Instance(object):
         raise NotImplementedError()
 
     def reset(self):
+        #Lazy attributes need the node, resolve them before it's dropped
+        for cls in type(self).__mro__:
+            for (name, attr) in vars(cls).items():
+                if isinstance(attr, lazy_attribute):
+                    getattr(self, name)
         self._node = None
 
     def __unicode__(self):
@@ -112,8 +187,10 @@ class Instance(object):
 
 
 class AWSInstance(Instance):
+    if settings.COMPACT_MODELS:
+        __slots__ = ('size',)
 
-    provider = AWSProvider
+    provider = provider_attribute(AWSProvider)
 
     def __init__(self, node, provider):
         Instance.__init__(self, node, provider)
@@ -121,8 +198,9 @@ class AWSInstance(Instance):
         self.size = node.extra.get('instance_type')
         if not self.size:
             self.size = node.extra['instancetype']
-        if Size.sizes.get((provider.identifier, self.size)):
-            self.size = Size.sizes[(provider.identifier, self.size)]
+        size = Size.lookup_size(self.size, provider)
+        if size:
+            self.size = size
 
     def get_public_ip(self):
         if self.extra \
@@ -131,8 +209,9 @@ class AWSInstance(Instance):
 
 
 class EucaInstance(AWSInstance):
+    __slots__ = ()
 
-    provider = EucaProvider
+    provider = provider_attribute(EucaProvider)
 
     def get_public_ip(self):
         if self.extra:
@@ -149,20 +228,52 @@ class EucaInstance(AWSInstance):
 
 
 class OSInstance(Instance):
+    if settings.COMPACT_MODELS:
+        __slots__ = ('_size', '_volumes')
 
-    provider = OSProvider
+    provider = provider_attribute(OSProvider)
 
-    def __init__(self, node, provider):
+    def __init__(self, node, provider, volumes=None):
         Instance.__init__(self, node, provider)
+        #BootVolumeIndex shared by the instances of one listing
+        self._volumes = volumes
 
         #Unfortunately we can't get the tenant_name..
         self.owner = node.extra.get('tenantId')
+
+    @lazy_attribute
+    def size(self):
         #New in 0.2.11 - use MockSize and expect user to lookup size.id if they want more than a MockSize!
-        if not self.size:
-            self.size = self._get_flavor_for_instance(node)
+        return self._get_flavor_for_instance(self._node)
+
+    @classmethod
+    def get_instances(cls, nodes, provider):
+        nodes = list(nodes)
+        volumes = cls._get_boot_volume_index(nodes)
+        return [cls.provider.instanceCls(node, provider, volumes=volumes)
+                for node in nodes]
+
+    @classmethod
+    def _get_boot_volume_index(cls, nodes):
+        """
+        Return a BootVolumeIndex when more than one node may have booted
+        from a volume, None when looking them up one by one is cheaper.
+        """
+        booted = [node for node in nodes
+                  if 'bootable_volume' in node.extra.get('metadata', {})]
+        if len(booted) < 2:
+            return None
+        tenants = set(node.extra.get('tenantId') for node in booted)
+        if len(tenants) > 1:
+            return BootVolumeIndex(booted[0].driver, all_tenants=True)
+        return BootVolumeIndex(booted[0].driver, project_id=tenants.pop())
 
     def _check_for_volumes(self, node):
-        booted_volume = node.extra['object'].get('os-extended-volumes:volumes_attached')
+        if 'volumes_attached' in node.extra:
+            #Compact nodes keep this, re-fetching the 'object' is a request
+            booted_volume = node.extra['volumes_attached']
+        else:
+            booted_volume = node.extra['object'].get('os-extended-volumes:volumes_attached')
         if type(booted_volume) == list and booted_volume:
             return booted_volume[0].get('id')
         elif booted_volume:
@@ -192,12 +303,16 @@ class OSInstance(Instance):
         Given a node and a volume_id, return 'volume' if the node
         is 'running' the volume, otherwise return None 
         """
-        volume = node.driver.ex_get_volume(volume_id)
+        volume = self._volumes.get(volume_id) if self._volumes else None
+        if not volume:
+            #Not in this listing (e.g. another tenant's volume), ask for it
+            volume = node.driver.ex_get_volume(volume_id)
         if not volume:
             logger.warn("[BADDATA] Volume %s listed in 'attached_volumes' but did not"
                         " return a volume" % volume_id)
             return None
-        attachment_data = volume.extra['attachments'][0]
+        attachments = volume.extra.get('attachments')
+        attachment_data = attachments[0] if attachments else None
         if not attachment_data:
             logger.warn("[BADDATA] Volume %s listed in 'attached_volumes' but did not"
                         " return attachment data." % volume_id)
@@ -253,7 +368,7 @@ class OSInstance(Instance):
         return status
 
     def get_public_ip(self):
-        if hasattr(self, "ip"):
-            return self.ip
+        if getattr(self, "_ip", _UNSET) is not _UNSET:
+            return self._ip
         if self._node and self._node.public_ips:
             return self._node.public_ips[0]
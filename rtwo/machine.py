@@ -4,15 +4,24 @@ Atmosphere service machine.
 """
 from abc import ABCMeta
 
-from rtwo.provider import AWSProvider, EucaProvider, OSProvider
+from rtwo import settings
+from rtwo.catalog import CatalogEntry, get_catalog
+from rtwo.provider import AWSProvider, EucaProvider, OSProvider,\
+    provider_attribute
 
 from threepio import logger
 
 class BaseMachine(object):
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
 
 class MockMachine(BaseMachine):
+    #Slotted (no __dict__) only with settings.COMPACT_MODELS
+    if settings.COMPACT_MODELS:
+        __slots__ = ('id', 'alias', 'name', '_image', '_provider')
+
+    provider = provider_attribute(None)
 
     def __init__(self, image_id, provider):
         self.id = image_id
@@ -29,12 +38,13 @@ class MockMachine(BaseMachine):
 
 
 class Machine(BaseMachine):
+    if settings.COMPACT_MODELS:
+        __slots__ = ('_image', 'id', 'alias', 'name')
 
     provider = None
 
-    machines = {}
-
-    lc_images = None
+    #Machines (and the images they came from) per identifier
+    catalog = get_catalog('machines')
 
     def __init__(self, lc_image):
         self._image = lc_image
@@ -50,53 +60,36 @@ class Machine(BaseMachine):
 
     @classmethod
     def invalidate_provider_cache(cls, provider):
-        cls.machines[provider.identifier] = {}
+        cls.catalog.invalidate(provider.identifier)
 
     @classmethod
     def invalidate_machine_cache(cls, provider, machine):
         """
-        DO NOT USE THIS METHOD
-        Removing a machine from the cache will have no affect on calls to
-        driver.list_machines(), to clear the cache you must use
-        invalidate_provider_cache
+        Removing a single machine isn't supported, the provider's machines
+        are listed again instead.
         """
         return cls.invalidate_provider_cache(provider)
-        alias = machine.id
-        provider_cache = cls.machines.get(provider.identifier, {})
-        provider_cache[alias] = None
-        cls.machines[provider.identifier] = provider_cache
+
+    @classmethod
+    def invalidate_cache(cls, identifier=None):
+        """
+        List machines again for identifier (default: every identifier).
+        Call this after images are created, deleted or changed.
+        """
+        cls.catalog.invalidate(identifier)
 
     @classmethod
     def add_to_cache(cls, provider, machine, identifier):
-        alias = machine.id
-        machine_dict = cls.machines.get(identifier, {})
-        machine_dict[alias] = machine
-        cls.machines[identifier] = machine_dict
+        cls.catalog.add(identifier, machine.id, machine)
 
     @classmethod
     def lookup_cached_machine(cls, alias, identifier):
-        provider_machines = cls.machines.get(identifier)
-        if not provider_machines:
-            #logger.info("Created new machine dict for provider %s" % identifier)
-            provider_machines = {}
-        machine = provider_machines.get(alias)
-        if machine:
-            #logger.info("Found machine for provider:%s - %s" %
-            #    (identifier, machine))
-            return machine
-        return None
+        return cls.catalog.lookup(identifier, alias)
 
     @classmethod
     def get_cached_machine(cls, lc_image, identifier):
-        alias = lc_image.id
-        provider_machines = cls.machines.get(identifier)
-        if not provider_machines:
-            #logger.info("Created new machine dict for provider %s" % identifier)
-            provider_machines = {}
-        machine = provider_machines.get(alias)
+        machine = cls.lookup_cached_machine(lc_image.id, identifier)
         if machine:
-            #logger.info("Found machine for provider:%s - %s" %
-            #    (identifier, machine))
             return machine
         return cls.create_machine(cls.provider, lc_image, identifier)
 
@@ -106,26 +99,30 @@ class Machine(BaseMachine):
         Identifier - Used to identify the specific provider being used:
         ex: "iPlant Eucalyptus", "Openstack 1", "Openstack 2"
         If using only one provider, this variable can be set to any value.
+        lc_driver - Optional (keyword), the libcloud driver behind
+        lc_list_images_method (Machines restored from a snapshot use it)
         """
-        provider_machines = cls.machines.get(identifier)
-        if not provider_machines:
-            logger.debug("Cache miss for identifier - %s" % identifier)
-        if not provider_machines or not cls.lc_images:
-            #Add new provider to the cache
-            cls.lc_images = lc_list_images_method(*args, **kwargs)
-            logger.debug("Caching %s machines for identifier:%s" %
-                         (len(cls.lc_images), identifier))
-        return [cls.get_cached_machine(lc_image, identifier) for lc_image in cls.lc_images]
-
-    def reset(self):
-        Machine.reset()
-        self.machines = {}
-        self.lc_images = None
-
-    @classmethod  # order matters... /sigh
+        lc_driver = kwargs.pop('lc_driver', None)
+        def build(lc_images):
+            #Machines already cached are kept (with the image just listed)
+            machines = []
+            for lc_image in lc_images:
+                machine = cls.get_cached_machine(lc_image, identifier)
+                machine._image = lc_image
+                machine.name = lc_image.name
+                machines.append(machine)
+            return CatalogEntry(
+                lc_images, machines,
+                dict((machine.id, machine) for machine in machines))
+
+        def load():
+            return build(lc_list_images_method(*args, **kwargs))
+        return list(cls.catalog.get(identifier, load, restore=build,
+                                    driver=lc_driver).items)
+
+    @classmethod
     def reset(cls):
-        cls.machines = {}
-        cls.lc_images = None
+        cls.catalog.clear()
 
     def __unicode__(self):
         return str(self)
@@ -147,15 +144,18 @@ class Machine(BaseMachine):
 
 
 class AWSMachine(Machine):
+    __slots__ = ()
 
     provider = AWSProvider
 
 
 class EucaMachine(Machine):
+    __slots__ = ()
 
     provider = EucaProvider
 
 
 class OSMachine(Machine):
+    __slots__ = ()
 
     provider = OSProvider
@@ -10,6 +10,12 @@ import urlparse
 from threepio import logger
 
 from rtwo import settings
+from rtwo.bulk import DEFAULT_RATE, DEFAULT_WORKERS, run_bulk
+from rtwo.capacity import CapacityMatrix, instances_that_fit, node_capacity,\
+    size_demand
+from rtwo.driver_pool import admin_driver_key, cloud_key,\
+    get_admin_driver_pool
+from rtwo.occupancy import get_occupancy_tracker
 
 from rtwo.provider import AWSProvider, EucaProvider, OSProvider,\
     OSValhallaProvider
@@ -37,6 +43,9 @@ class Meta(BaseMeta):
         self.provider_options = driver.provider.options
         self.identity = driver.identity
         self.driver = driver
+        #The same for every user of the cloud (See driver_pool)
+        self.cloud = cloud_key(type(self.provider), self.provider_options,
+                               self.identity.credentials)
         if not admin_driver:
             self.admin_driver = self.create_admin_driver({})
         else:
@@ -82,6 +91,15 @@ class Meta(BaseMeta):
     def create_admin_driver(self, creds=None):
         raise NotImplementedError
 
+    def _borrow_admin_driver(self, create, key, secret, tenant=None):
+        """
+        Return the admin driver shared by every Meta with the same provider
+        options and credentials (See driver_pool). create() builds it when
+        there is none yet.
+        """
+        pool_key = admin_driver_key(self.cloud, key, secret, tenant)
+        return get_admin_driver_pool().get(pool_key, create)
+
     def all_instances(self):
         return self.provider.instanceCls.get_instances(
             self.admin_driver._connection.ex_list_all_instances(),
@@ -119,13 +137,16 @@ class AWSMeta(Meta):
     def create_admin_driver(self, creds=None):
         if not hasattr(settings, 'AWS_KEY'):
             return self.driver
-        logger.debug(self.provider)
-        logger.debug(type(self.provider))
-        identity = AWSIdentity(self.provider,
-                               settings.AWS_KEY,
-                               settings.AWS_SECRET)
-        driver = AWSDriver(self.provider, identity)
-        return driver
+
+        def create():
+            logger.debug(self.provider)
+            logger.debug(type(self.provider))
+            identity = AWSIdentity(self.provider,
+                                   settings.AWS_KEY,
+                                   settings.AWS_SECRET)
+            return AWSDriver(self.provider, identity)
+        return self._borrow_admin_driver(create, settings.AWS_KEY,
+                                         settings.AWS_SECRET)
 
     def all_instances(self):
         return self.admin_driver.list_instances()
@@ -139,9 +160,11 @@ class EucaMeta(Meta):
         key, secret = self._split_creds(creds,
                                         settings.EUCA_ADMIN_KEY,
                                         settings.EUCA_ADMIN_SECRET)
-        identity = EucaIdentity(self.provider, key, secret)
-        driver = EucaDriver(self.provider, identity)
-        return driver
+
+        def create():
+            identity = EucaIdentity(self.provider, key, secret)
+            return EucaDriver(self.provider, identity)
+        return self._borrow_admin_driver(create, key, secret)
 
     def occupancy(self):
         return self.admin_driver.list_sizes()
@@ -155,21 +178,23 @@ class OSMeta(Meta):
     provider = OSProvider
 
     def create_admin_driver(self, creds=None):
-        admin_provider = OSProvider()
         provider_creds = self.provider_options
         key, secret, tenant =\
             self._split_creds(creds,
                               settings.OPENSTACK_ADMIN_KEY,
                               settings.OPENSTACK_ADMIN_SECRET,
                               settings.OPENSTACK_ADMIN_TENANT)
-        admin_identity = OSIdentity(admin_provider,
-                                    key,
-                                    secret,
-                                    ex_tenant_name=tenant)
-        admin_driver = OSDriver(admin_provider,
-                                admin_identity,
-                                **provider_creds)
-        return admin_driver
+
+        def create():
+            admin_provider = OSProvider()
+            admin_identity = OSIdentity(admin_provider,
+                                        key,
+                                        secret,
+                                        ex_tenant_name=tenant)
+            return OSDriver(admin_provider,
+                            admin_identity,
+                            **provider_creds)
+        return self._borrow_admin_driver(create, key, secret, tenant)
 
     def total_remaining(self, max_, total, used, size):
         """
@@ -219,29 +244,39 @@ class OSMeta(Meta):
         return self.total_remaining(max_by_disk, disk_total,
                                     disk_used, size._size.disk)
 
-    def _calculate_overcommits(self, sizes, remove_totals):
-        instances = self.admin_driver.list_all_instances()
-        size_map = {size.id:size for size in sizes}
-        for instance in instances:
-            if instance.extra['status'] in ['suspended','shutoff']:
-                #oc == OverCommited
-                oc_size = size_map.get(instance.size.id)
-                if not oc_size:
-                    logger.warn("Size %s NOT found in list of sizes. Cannot"
-                                " remove instance %s from calculation"
-                                % (instance.size.id, instance.id))
-                    continue
-                remove_totals['cpu'] = remove_totals['cpu'] + oc_size.cpu
-                remove_totals['ram'] = remove_totals['ram'] + oc_size.ram
-                remove_totals['disk'] = remove_totals['disk'] + oc_size.disk
-        return remove_totals
-
+    def _allocation_ratios(self):
+        return (settings.OPENSTACK_CPU_ALLOCATION_RATIO,
+                settings.OPENSTACK_RAM_ALLOCATION_RATIO,
+                settings.OPENSTACK_DISK_ALLOCATION_RATIO)
 
     def _instance_capacity_on_node(self, size, node):
-        pass
+        """
+        Instances of size that fit in what is free on node (a hypervisor).
+        """
+        (total, used) = node_capacity(node, self._allocation_ratios())
+        free = [t - u for (t, u) in zip(total, used)]
+        return instances_that_fit(free, size_demand(size))
 
-    def _instance_capacity_vcpus(self):
-        pass
+    def _instance_capacity_vcpus(self, nodes=None):
+        """
+        {hostname: vCPUs still free (after overcommit)} of active nodes.
+        """
+        if nodes is None:
+            nodes = self._active_compute_nodes()
+        cpu_ratio = settings.OPENSTACK_CPU_ALLOCATION_RATIO
+        return dict((hostname, max(node['vcpus'] * cpu_ratio
+                                   - node['vcpus_used'], 0))
+                    for (hostname, node) in nodes.items())
+
+    def capacity(self, sizes=None):
+        """
+        Return a CapacityMatrix: instances of each size that fit on
+        each active compute node.
+        """
+        if sizes is None:
+            sizes = self.admin_driver.list_sizes()
+        return CapacityMatrix(self._active_compute_nodes(), sizes,
+                              self._allocation_ratios())
 
     def _sum_active_compute_nodes(self):
         acs = self._active_compute_nodes()
@@ -262,21 +297,17 @@ class OSMeta(Meta):
         return nodes
 
     def _get_node(self, nodes, instance):
-        hostname = instance\
-            .extra["object"]\
-            .get("OS-EXT-SRV-ATTR:hypervisor_hostname")
+        if "hypervisor_hostname" in instance.extra:
+            #Compact nodes keep this, re-fetching the 'object' is a request
+            hostname = instance.extra["hypervisor_hostname"]
+        else:
+            hostname = instance\
+                .extra["object"]\
+                .get("OS-EXT-SRV-ATTR:hypervisor_hostname")
         if hostname:
             hostname = self._scrub_hostname(hostname)
         return nodes.get(hostname)
 
-    def _get_size(self, sizes, instance):
-        size_id = instance.size.id
-        size = [s for s in sizes if s.id == size_id]
-        if size and len(size) == 1:
-            return size[0]
-        else:
-            return None
-
     def _scrub_hostname(self, hostname):
         if not hostname:
             return None
@@ -323,6 +354,13 @@ class OSMeta(Meta):
 #             stats["mem"]/(1.0*max_mem)))
 
 
+    @property
+    def occupancy_tracker(self):
+        """
+        The OccupancyTracker of this meta's cloud (created on first use).
+        """
+        return get_occupancy_tracker(self)
+
     def new_occupancy(self, overcommited=True):
         """
         Calculate occupancy using an admin account.
@@ -331,20 +369,21 @@ class OSMeta(Meta):
         calculate a better occupancy than _ex_hypervisor_statistics.
         Our statistics only look at instance states that use resources
         on the compute node.
+
+        The data is kept up to date by occupancy_tracker, instead of
+        listed on every call.
         """
-        sizes = self.admin_driver.list_sizes()
-        nodes = self._active_compute_nodes()
-        occupancy = {}
-        for i in self.all_instances():
-            node = self._get_node(nodes, i)
-            size = self._get_size(sizes, i)
-            self._add_occupancy(occupancy, node, size, i)
-        return occupancy
-
-    def occupancy(self, overcommited=False):
+        return self.occupancy_tracker.occupancy(overcommited)
+
+    def occupancy(self, overcommited=False, per_node=False):
         """
         Add Occupancy data to NodeSize.extra
+
+        per_node - Count the instances that fit on each compute node
+        (See capacity) instead of dividing the cloud's totals.
         """
+        if per_node:
+            return self._per_node_occupancy()
         occ = self.admin_driver._connection\
                                .ex_hypervisor_statistics()
         remove_totals = {
@@ -354,7 +393,7 @@ class OSMeta(Meta):
             }
         sizes = self.admin_driver.list_sizes()
         if not overcommited:
-            self._calculate_overcommits(sizes, remove_totals)
+            remove_totals = self.occupancy_tracker.inactive_totals()
 
         for size in sizes:
             total_cpu, remaining_cpu = self._cpu_stats(size,
@@ -383,6 +422,16 @@ class OSMeta(Meta):
                                        'remaining': remaining}
         return sizes
 
+    def _per_node_occupancy(self):
+        sizes = self.admin_driver.list_sizes()
+        matrix = self.capacity(sizes)
+        total = matrix.total_by_size()
+        remaining = matrix.remaining_by_size()
+        for size in sizes:
+            size.extra['occupancy'] = {'total': total[size.id],
+                                       'remaining': remaining[size.id]}
+        return sizes
+
     def add_metadata_deployed(self, machine):
         """
         Add {"deployed": "True"} key and value to the machine's metadata.
@@ -404,48 +453,81 @@ class OSMeta(Meta):
             self.admin_driver._connection.ex_delete_image_metadata(machine,
                                                                    "deployed")
 
-    def stop_all_instances(self, destroy=False):
+    def stop_all_instances(self, destroy=False, workers=DEFAULT_WORKERS,
+                           rate=DEFAULT_RATE, progress=None):
         """
         Stop all instances and delete tenant networks for all users.
 
         To destroy instances instead of stopping them use the destroy
         keyword (destroy=True).
+
+        Instances (and then networks) are handled by 'workers' threads,
+        starting at most 'rate' calls per second (See rtwo.bulk).
+        progress(name, done, total, result) is called after each one.
+
+        Returns {'instances': BulkSummary, 'networks': BulkSummary}
+        ('networks' only when destroying).
         """
-        for instance in self.all_instances():
-            if destroy:
-                self.admin_driver.destroy_instance(instance)
-                logger.debug('Destroyed instance %s' % instance)
-            else:
-                if instance.get_status() == 'active':
-                    self.admin_driver.stop_instance(instance)
-                    logger.debug('Stopped instance %s' % instance)
-        os_driver = OSAccountDriver()
         if destroy:
-            for username in os_driver.list_usergroup_names():
-                tenant_name = username
-                os_driver.network_manager.delete_tenant_network(username,
-                                                                tenant_name)
-        return True
-
-    def destroy_all_instances(self):
+            summaries = {'instances': run_bulk(
+                'destroy_instances', self._destroy_instance,
+                self.all_instances(), workers, rate, progress)}
+            summaries['networks'] = self._delete_tenant_networks(
+                workers, rate, progress)
+            return summaries
+        instances = [instance for instance in self.all_instances()
+                     if instance.get_status() == 'active']
+        return {'instances': run_bulk(
+            'stop_instances', self._stop_instance, instances,
+            workers, rate, progress)}
+
+    def destroy_all_instances(self, workers=DEFAULT_WORKERS,
+                              rate=DEFAULT_RATE, progress=None):
         """
         Destroy all instances and delete tenant networks for all users.
+        (See stop_all_instances)
+        """
+        return self.stop_all_instances(destroy=True, workers=workers,
+                                       rate=rate, progress=progress)
+
+    def _stop_instance(self, instance):
+        result = self.admin_driver.stop_instance(instance)
+        logger.debug('Stopped instance %s' % instance)
+        return result
+
+    def _destroy_instance(self, instance):
+        result = self.admin_driver.destroy_instance(instance)
+        logger.debug('Destroyed instance %s' % instance)
+        return result
+
+    def _delete_tenant_networks(self, workers, rate, progress):
+        """
+        Delete the tenant network of every usergroup, sharing one
+        account driver.
         """
-        for instance in self.all_instances():
-            self.admin_driver.destroy_instance(instance)
-            logger.debug('Destroyed instance %s' % instance)
         os_driver = OSAccountDriver()
-        for username in os_driver.list_usergroup_names():
+
+        def delete_network(username):
             tenant_name = username
-            os_driver.network_manager.delete_tenant_network(username,
-                                                            tenant_name)
-        return True
+            return os_driver.network_manager.delete_tenant_network(
+                username, tenant_name)
+        return run_bulk('delete_tenant_networks', delete_network,
+                        os_driver.list_usergroup_names(),
+                        workers, rate, progress)
 
     def all_instances(self, **kwargs):
         return self.provider.instanceCls.get_instances(
             self.admin_driver._connection.ex_list_all_instances(**kwargs),
             self.provider)
 
+    def iter_all_instances(self, **kwargs):
+        """
+        Like all_instances, but instances are yielded page by page.
+        NOTE: Don't destroy instances while iterating, a deleted instance
+        can not be used as the marker for the next page.
+        """
+        return self.admin_driver.iter_all_instances(**kwargs)
+
     def all_volumes(self):
         return self.provider.instanceCls.get_volumes(
             self.admin_driver._connection.ex_list_all_volumes())
@@ -2,8 +2,58 @@
 Rtwo mixins for drivers
 Mixin classes implement additional functionality for Drivers.
 """
+import re
+
 from threepio import logger
 
+#Compiled black lists kept (keyed by their words)
+MAX_BLACK_LISTS = 128
+
+_black_lists = {}
+
+
+def _trie_pattern(words):
+    """
+    One regex for 'words', built from a trie of them so words sharing a
+    prefix share the work (e.g. 'test-1', 'test-2' -> 'test\\-(?:1|2)').
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = None
+
+    def pattern(node):
+        if '' in node:
+            #A word ends here, no need to match the longer words it starts
+            return ''
+        alternatives = [re.escape(char) + pattern(child)
+                        for (char, child) in sorted(node.items())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:%s)' % '|'.join(alternatives)
+    return pattern(trie)
+
+
+def black_list_matcher(black_list):
+    """
+    Return a function that is true for names containing any word in
+    black_list (one compiled regex, cached per list of words), or None
+    for an empty black list.
+    """
+    if not black_list:
+        return None
+    key = tuple(black_list)
+    matcher = _black_lists.get(key)
+    if not matcher:
+        matcher = re.compile(_trie_pattern(black_list)).search
+        if len(_black_lists) >= MAX_BLACK_LISTS:
+            _black_lists.clear()
+        _black_lists[key] = matcher
+    return matcher
+
+
 class MetaMixin():
     def meta(self, *args, **kwargs):
         return self.provider.metaCls.create_meta(self, *args, **kwargs)
@@ -13,7 +63,27 @@ class APIFilterMixin():
     """
     APIFilterMixin provides filtering for libcloud and esh drivers.
     """
+    def _lookup_volume(self, alias):
+        """
+        Drivers that can find a single volume (size, instance, machine)
+        without listing them all override _lookup_*, returning the model
+        or None. NotImplemented falls back to listing.
+        """
+        return NotImplemented
+
+    def _lookup_size(self, alias):
+        return NotImplemented
+
+    def _lookup_instance(self, alias, all_tenants=False):
+        return NotImplemented
+
+    def _lookup_machine(self, alias):
+        return NotImplemented
+
     def get_volume(self, alias):
+        volume = self._lookup_volume(alias)
+        if volume is not NotImplemented:
+            return volume
         try:
             volume_list = self.list_volumes()
             volume = filter(lambda volume:
@@ -23,6 +93,9 @@ class APIFilterMixin():
             return None
 
     def get_size(self, alias):
+        size = self._lookup_size(alias)
+        if size is not NotImplemented:
+            return size
         try:
             size_list = self.list_sizes()
             size = filter(lambda size:
@@ -32,6 +105,9 @@ class APIFilterMixin():
             return None
 
     def get_instance(self, alias):
+        instance = self._lookup_instance(alias)
+        if instance is not NotImplemented:
+            return instance
         try:
             instance_list = self.list_instances()
             instance = filter(lambda instance:
@@ -41,6 +117,9 @@ class APIFilterMixin():
             return None
 
     def get_machine(self, alias):
+        machine = self._lookup_machine(alias)
+        if machine is not NotImplemented:
+            return machine
         try:
             machine_list = self.list_machines()
             machine = filter(lambda machine:
@@ -49,41 +128,43 @@ class APIFilterMixin():
         except IndexError:
             return None
 
+    def iter_filtered(self, items, black_list=[]):
+        """
+        Yield the items (volumes, sizes, instances or machines) whose name
+        does NOT match any word in the black_list, as they are read.
+        """
+        matches = black_list_matcher(black_list)
+        if not matches:
+            return iter(items)
+        return (item for item in items if not matches(item.name))
+
     def filter_volumes(self, volumes, black_list=[]):
         """
         Filtered volumes:
             Keep the volume if it does NOT match any word in the black_list
         """
-        filtered = [volume for volume in volumes
-                    if not any(word in volume.name for word in black_list)]
-        return filtered
+        return list(self.iter_filtered(volumes, black_list))
 
     def filter_sizes(self, sizes, black_list=[]):
         """
         Filtered sizes:
             Keep the size if it does NOT match any word in the black_list
         """
-        filtered = [size for size in sizes
-                    if not any(word in size.name for word in black_list)]
-        return filtered
+        return list(self.iter_filtered(sizes, black_list))
 
     def filter_instances(self, instances, black_list=[]):
         """
         Filtered instances:
             Keep the instance if it does NOT match any word in the black_list
         """
-        filtered = [instance for instance in instances
-                    if not any(word in instance.name for word in black_list)]
-        return filtered
+        return list(self.iter_filtered(instances, black_list))
 
     def filter_machines(self, machines, black_list=[]):
         """
         Filtered machines:
             Keep the machine if it does NOT match any word in the black_list
         """
-        filtered = [machine for machine in machines
-                    if not any(word in machine.name for word in black_list)]
-        return filtered
+        return list(self.iter_filtered(machines, black_list))
 
 
 class InstanceActionMixin():
@@ -0,0 +1,350 @@
+"""
+Incremental occupancy: what every compute node is running, kept up to date.
+
+OSMeta.new_occupancy() listed every instance, size and hypervisor on each
+call. OccupancyTracker does that once, indexes the instances by node and by
+size, and from then on applies the instances OSDriver creates, destroys,
+suspends and resumes (see instance_event). A full scan still runs every
+'reconcile_interval' seconds to pick up anything done outside rtwo.
+
+There is one tracker per cloud (See driver_pool.cloud_key), shared by the
+Metas of every user of that cloud.
+
+    tracker = meta.occupancy_tracker
+    tracker.occupancy()              # Like new_occupancy()
+    tracker.node_usage(hostname)     # One node, no API calls
+"""
+import threading
+import time
+
+from threepio import logger
+
+#Statuses whose instances don't use their node's resources
+INACTIVE_STATUSES = ('suspended', 'shutoff')
+
+#Events (from OSDriver) and the instance state they leave behind
+EVENTS = {
+    'created': True,
+    'resumed': True,
+    'started': True,
+    'suspended': False,
+    'stopped': False,
+    'destroyed': None,
+}
+
+#Seconds between full scans
+DEFAULT_RECONCILE_INTERVAL = 600
+
+#Seconds between checks for the host of instances still building
+DEFAULT_PLACEMENT_INTERVAL = 5
+
+
+class _Placement(object):
+    """
+    Where an instance runs, and what it uses there.
+    """
+    __slots__ = ('instance', 'node_key', 'size', 'active')
+
+    def __init__(self, instance, node_key, size, active):
+        self.instance = instance
+        self.node_key = node_key
+        self.size = size
+        self.active = active
+
+    def usage(self):
+        """
+        (cpu, ram, disk, ephemeral) of the instance's size.
+        """
+        if not self.size:
+            return (0, 0, 0, 0)
+        return (self.size.cpu, self.size.ram, self.size.disk,
+                self.size.ephemeral)
+
+
+class OccupancyTracker(object):
+    """
+    Instances by compute node and by size, for one OSMeta.
+    """
+
+    def __init__(self, meta, reconcile_interval=DEFAULT_RECONCILE_INTERVAL,
+                 placement_interval=DEFAULT_PLACEMENT_INTERVAL):
+        self.meta = meta
+        self.reconcile_interval = reconcile_interval
+        self.placement_interval = placement_interval
+        self.last_reconcile = None
+        self.last_placement = None
+        self._lock = threading.RLock()
+        self._reconcile_lock = threading.Lock()
+        #Events seen while a full scan runs, applied to its result
+        self._pending = None
+        self._reset({}, {})
+
+    def _reset(self, sizes, nodes):
+        """
+        NOTE: Must be called while holding the lock.
+        """
+        self.sizes = sizes
+        self.nodes = nodes
+        #instance id -> _Placement
+        self._placements = {}
+        #node key -> {instance id: _Placement}
+        self._by_node = {}
+        #size id -> {instance id: _Placement}
+        self._by_size = {}
+        #(node key, active) -> [cpu, ram, disk, ephemeral]
+        self._usage = {}
+        #instance id -> instance, building and not on a node yet
+        self._unplaced = {}
+
+    def _count(self, placement, sign):
+        key = (placement.node_key, placement.active)
+        usage = self._usage.setdefault(key, [0, 0, 0, 0])
+        for (idx, amount) in enumerate(placement.usage()):
+            usage[idx] += sign * amount
+
+    def _place(self, instance):
+        """
+        NOTE: Must be called while holding the lock.
+        """
+        node = self.meta._get_node(self.nodes, instance)
+        self._unplaced.pop(instance.id, None)
+        if node is None and instance.extra.get('status') == 'build':
+            #Counted once the scheduler has picked its node
+            self._remove(instance.id)
+            self._unplaced[instance.id] = instance
+            return
+        size = self.sizes.get(instance.size.id)
+        if not size:
+            logger.warn("Size %s NOT found in list of sizes. Instance %s"
+                        " won't be counted" % (instance.size.id, instance.id))
+        active = instance.extra.get('status') not in INACTIVE_STATUSES
+        self._remove(instance.id)
+        placement = _Placement(instance, self.meta._get_hashable_node(node),
+                               size, active)
+        self._placements[instance.id] = placement
+        self._by_node.setdefault(placement.node_key, {})[instance.id] =\
+            placement
+        size_id = size.id if size else None
+        self._by_size.setdefault(size_id, {})[instance.id] = placement
+        self._count(placement, 1)
+
+    def _remove(self, instance_id):
+        """
+        NOTE: Must be called while holding the lock.
+        """
+        self._unplaced.pop(instance_id, None)
+        placement = self._placements.pop(instance_id, None)
+        if not placement:
+            return
+        self._by_node[placement.node_key].pop(instance_id, None)
+        size_id = placement.size.id if placement.size else None
+        self._by_size[size_id].pop(instance_id, None)
+        self._count(placement, -1)
+
+    def _set_active(self, instance_id, active):
+        """
+        NOTE: Must be called while holding the lock.
+        """
+        placement = self._placements.get(instance_id)
+        if not placement or placement.active == active:
+            return
+        self._count(placement, -1)
+        placement.active = active
+        self._count(placement, 1)
+
+    def _apply(self, event, instance):
+        if event == 'created':
+            self._place(instance)
+        elif event == 'destroyed':
+            self._remove(instance.id)
+        else:
+            self._set_active(instance.id, EVENTS[event])
+
+    def instance_event(self, event, instance):
+        """
+        Apply what happened to instance (One of EVENTS).
+        """
+        if event not in EVENTS:
+            raise ValueError("Unknown instance event %s" % event)
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((event, instance))
+            if self.last_reconcile is not None:
+                self._apply(event, instance)
+
+    def reconcile(self):
+        """
+        Rebuild everything from a full scan of sizes, compute nodes and
+        instances. Events seen during the scan are applied after it.
+        """
+        with self._reconcile_lock:
+            with self._lock:
+                self._pending = []
+            started = time.time()
+            try:
+                sizes = dict((size.id, size)
+                             for size in self.meta.admin_driver.list_sizes())
+                nodes = self.meta._active_compute_nodes()
+                instances = list(self.meta.iter_all_instances())
+            except:
+                with self._lock:
+                    self._pending = None
+                raise
+            with self._lock:
+                old_count = len(self._placements)
+                self._reset(sizes, nodes)
+                for instance in instances:
+                    self._place(instance)
+                for (event, instance) in self._pending:
+                    self._apply(event, instance)
+                self._pending = None
+                if self.last_reconcile is not None\
+                        and old_count != len(self._placements):
+                    logger.info("Occupancy reconciled: %s instances"
+                                " tracked, full scan found %s"
+                                % (old_count, len(self._placements)))
+                self.last_reconcile = started
+
+    def _reconcile_due(self):
+        if self.last_reconcile is None:
+            return True
+        if self.reconcile_interval is None:
+            return False
+        return time.time() - self.last_reconcile >= self.reconcile_interval
+
+    def _placement_due(self):
+        if not self._unplaced:
+            return False
+        return self.last_placement is None\
+            or time.time() - self.last_placement >= self.placement_interval
+
+    def place_building(self):
+        """
+        Look up the instances that were still building, and count the ones
+        that have been given a node.
+        """
+        with self._lock:
+            self.last_placement = time.time()
+            instance_ids = list(self._unplaced)
+        connection = self.meta.admin_driver._connection
+        instanceCls = self.meta.provider.instanceCls
+        for instance_id in instance_ids:
+            try:
+                node = connection.ex_find_node(instance_id)
+            except Exception:
+                logger.exception("Could not look up building instance %s"
+                                 % instance_id)
+                continue
+            with self._lock:
+                if instance_id not in self._unplaced:
+                    #Placed or destroyed while we looked
+                    continue
+                if node is None:
+                    self._unplaced.pop(instance_id)
+                else:
+                    self._place(instanceCls(node, self.meta.provider))
+
+    def refresh(self):
+        """
+        Reconcile, if it is due (or if nothing has been loaded yet), and
+        place instances that were building.
+        """
+        if self._reconcile_due():
+            self.reconcile()
+        elif self._placement_due():
+            self.place_building()
+
+    def _node_dict(self, node_key, overcommited):
+        placements = self._by_node.get(node_key, {}).values()
+        if not overcommited:
+            placements = [p for p in placements if p.active]
+        usage = [0, 0, 0, 0]
+        for active in ((True, False) if overcommited else (True,)):
+            for (idx, amount) in enumerate(
+                    self._usage.get((node_key, active), ())):
+                usage[idx] += amount
+        #'disk' is the ephemeral disk (See OSMeta._add_occupancy)
+        return {"cpu": usage[0], "mem": usage[1], "disk": usage[3],
+                "instances": [p.instance for p in placements]}
+
+    def occupancy(self, overcommited=True):
+        """
+        {node key: {"cpu", "mem", "disk", "instances"}}, like
+        OSMeta.new_occupancy. overcommited=False leaves out suspended and
+        shut off instances.
+        """
+        self.refresh()
+        with self._lock:
+            return dict((node_key, self._node_dict(node_key, overcommited))
+                        for (node_key, placements) in self._by_node.items()
+                        if placements)
+
+    def node_usage(self, hostname, overcommited=True):
+        """
+        The occupancy of a single node (by scrubbed hostname).
+        """
+        self.refresh()
+        with self._lock:
+            return self._node_dict(hostname, overcommited)
+
+    def instances_of_size(self, size_id):
+        self.refresh()
+        with self._lock:
+            return [p.instance
+                    for p in self._by_size.get(size_id, {}).values()]
+
+    def size_counts(self):
+        """
+        {size id: number of instances}
+        """
+        self.refresh()
+        with self._lock:
+            return dict((size_id, len(placements))
+                        for (size_id, placements) in self._by_size.items()
+                        if placements)
+
+    def inactive_totals(self):
+        """
+        {'cpu', 'ram', 'disk'} used by suspended and shut off instances
+        """
+        self.refresh()
+        totals = {'cpu': 0, 'ram': 0, 'disk': 0}
+        with self._lock:
+            for ((node_key, active), usage) in self._usage.items():
+                if not active:
+                    totals['cpu'] += usage[0]
+                    totals['ram'] += usage[1]
+                    totals['disk'] += usage[2]
+        return totals
+
+
+#cloud (See driver_pool.cloud_key) -> OccupancyTracker
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def get_occupancy_tracker(meta):
+    """
+    Return the tracker of meta's cloud, created (for meta) on first use.
+    """
+    with _trackers_lock:
+        tracker = _trackers.get(meta.cloud)
+        if not tracker:
+            tracker = _trackers[meta.cloud] = OccupancyTracker(meta)
+        return tracker
+
+
+def instance_event(cloud, event, instance):
+    """
+    Tell the tracker of cloud what happened to instance.
+    Called by OSDriver, after the call succeeded.
+    """
+    with _trackers_lock:
+        tracker = _trackers.get(cloud)
+    if not tracker:
+        return
+    try:
+        tracker.instance_event(event, instance)
+    except Exception:
+        logger.exception("Occupancy tracker could not apply %s of %s"
+                         % (event, instance))
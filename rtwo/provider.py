@@ -31,6 +31,26 @@ def lc_provider_id(provider):
     return p
 
 
+class provider_attribute(object):
+    """
+    'provider' for models that use __slots__.
+    On the class it is the provider class (e.g. OSInstance.provider), on an
+    object it is the provider the object was built with (kept in the
+    '_provider' slot), falling back to the provider class.
+    """
+
+    def __init__(self, provider_cls):
+        self.provider_cls = provider_cls
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.provider_cls
+        return getattr(obj, '_provider', self.provider_cls)
+
+    def __set__(self, obj, value):
+        obj._provider = value
+
+
 class BaseProvider(object):
     __metaclass__ = ABCMeta
 
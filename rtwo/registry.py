@@ -0,0 +1,25 @@
+"""
+Objects shared by every driver, manager and model in this process.
+
+Each one is created on first use, from the settings at that time, and the
+same object is handed out from then on:
+
+    pool = get_shared('connection_pool', ConnectionPool)
+    catalog = get_shared(('catalog', name), lambda: Catalog(name))
+"""
+import threading
+
+#name -> object
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def get_shared(name, factory):
+    """
+    Return the object registered as 'name', calling factory() to create it
+    the first time.
+    """
+    with _shared_lock:
+        if name not in _shared:
+            _shared[name] = factory()
+        return _shared[name]
@@ -0,0 +1,187 @@
+"""
+Bulk JSON serialization of rtwo models.
+
+Produces the same documents as Instance.json(), Machine.json(), Size.json()
+and Volume.json(), with a fixed field order, encoded straight to JSON.
+Sizes and machines shared by many instances are only encoded once:
+
+    serialize.dumps(instances)           # One JSON array
+    for chunk in serialize.iter_json(driver.iter_all_instances()):
+        response.write(chunk)             # Streamed, a chunk at a time
+"""
+import json
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+
+from rtwo.instance import Instance
+from rtwo.machine import Machine, MockMachine
+from rtwo.size import Size, MockSize
+from rtwo.volume import Volume, MockVolume
+
+#Objects encoded per chunk yielded by iter_json
+DEFAULT_CHUNK_SIZE = 100
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, 'json'):
+        return value.json()
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+_encode = json.JSONEncoder(separators=(',', ':'), default=_default).encode
+
+
+def _value(value):
+    if isinstance(value, basestring):
+        return encode_basestring_ascii(value)
+    if value is None:
+        return 'null'
+    return _encode(value)
+
+
+def _nested(model, memo):
+    """
+    Instance.json() reports a missing size/source as "None"
+    (and an unresolved size as its id).
+    """
+    if not model:
+        return '"None"'
+    if isinstance(model, basestring):
+        return encode_basestring_ascii(model)
+    return _encode_model(model, memo)
+
+
+def _encode_instance(instance, memo):
+    return ('{"id":%s,"alias":%s,"name":%s,"ip":%s,"provider":%s,'
+            '"size":%s,"source":%s}'
+            % (_value(instance.id), _value(instance.alias),
+               _value(instance.name), _value(instance.ip),
+               _value(instance.provider.name),
+               _nested(instance.size, memo), _nested(instance.source, memo)))
+
+
+def _encode_mock_size(size, memo):
+    return ('{"id":%s,"provider":%s,"alias":%s,"name":%s,"cpu":%s,'
+            '"ram":"","root":"","disk":"","bandwidth":"","price":""}'
+            % (_value(size.id), _value(size.provider.identifier),
+               _value(size.id), _value('MockSize %s' % size.id),
+               _value(size.cpu)))
+
+
+def _encode_size(size, memo):
+    return ('{"id":%s,"provider":%s,"alias":%s,"name":%s,"cpu":%s,'
+            '"ram":%s,"root":%s,"disk":%s,"bandwidth":%s,"price":%s}'
+            % (_value(size.name), _value(size.provider.identifier),
+               _value(size.id), _value(size.name), _value(size.cpu),
+               _value(size.ram), _value(size.disk), _value(size.ephemeral),
+               _value(size.bandwidth), _value(size.price)))
+
+
+def _encode_machine(machine, memo):
+    return ('{"id":%s,"alias":%s,"name":%s,"provider":%s}'
+            % (_value(machine.id), _value(machine.alias),
+               _value(machine.name), _value(machine.provider.name)))
+
+
+def _encode_volume(volume, memo):
+    return ('{"id":%s,"alias":%s,"attachment_set":%s,"extra":%s,'
+            '"name":%s,"provider":%s,"size":%s}'
+            % (_value(volume.id), _value(volume.alias),
+               _value(volume.attachment_set), _value(volume.extra),
+               _value(volume.name), _value(volume.provider.name),
+               _value(volume.size)))
+
+
+def _encode_other(model, memo):
+    return _encode(model.json())
+
+
+#(class, encoder, shared) in the order classes are checked. Objects of
+#'shared' classes come from provider caches, and are only encoded once
+#per document.
+_ENCODERS = [
+    (Instance, _encode_instance, False),
+    (MockSize, _encode_mock_size, False),
+    (Size, _encode_size, True),
+    (MockMachine, _encode_machine, False),
+    (Machine, _encode_machine, True),
+    ((Volume, MockVolume), _encode_volume, False),
+]
+
+#class -> (encoder, shared), filled in on first use
+_class_encoders = {}
+
+
+def _encoder(cls):
+    encoder = _class_encoders.get(cls)
+    if encoder:
+        return encoder
+    for (model_cls, encode_model, shared) in _ENCODERS:
+        if issubclass(cls, model_cls):
+            encoder = (encode_model, shared)
+            break
+    else:
+        #Anything else with a json() method
+        encoder = (_encode_other, False)
+    _class_encoders[cls] = encoder
+    return encoder
+
+
+def _encode_model(model, memo):
+    (encode_model, shared) = _encoder(model.__class__)
+    if not shared:
+        return encode_model(model, memo)
+    #Keep the model in the memo, so its id can't be re-used
+    (memo_model, encoded) = memo.get(id(model), (None, None))
+    if memo_model is not model:
+        encoded = encode_model(model, memo)
+        memo[id(model)] = (model, encoded)
+    return encoded
+
+
+def encode(model):
+    """
+    Return one model as a JSON object.
+    """
+    return _encode_model(model, {})
+
+
+def iter_json(models, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield a JSON array of 'models' (a list or an iterator) in chunks of
+    up to 'chunk_size' objects, without holding the whole document.
+    """
+    memo = {}
+    chunk = ['[']
+    separator = ''
+    count = 0
+    for model in models:
+        chunk.append(separator)
+        chunk.append(_encode_model(model, memo))
+        separator = ','
+        count += 1
+        if count == chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            count = 0
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def dumps(models):
+    """
+    Return 'models' as a single JSON array.
+    """
+    memo = {}
+    return '[%s]' % ','.join([_encode_model(model, memo)
+                              for model in models])
+
+
+def dump(models, fp, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Stream 'models' to the file-like 'fp' as a JSON array.
+    """
+    for chunk in iter_json(models, chunk_size):
+        fp.write(chunk)
@@ -49,7 +49,10 @@ def set_settings(settings):
         OPENSTACK_ADMIN_TENANT, OPENSTACK_DEFAULT_REGION,\
         OPENSTACK_DEFAULT_ROUTER, EUCA_ADMIN_KEY,\
         EUCA_ADMIN_SECRET, SERVER_URL,\
-        INSTANCE_SERVICE_URL, ATMOSPHERE_VNC_LICENSE
+        INSTANCE_SERVICE_URL, ATMOSPHERE_VNC_LICENSE,\
+        OPENSTACK_TOKEN_CACHE_FILE, COMPACT_MODELS, CATALOG_SNAPSHOT_FILE,\
+        OPENSTACK_CPU_ALLOCATION_RATIO, OPENSTACK_RAM_ALLOCATION_RATIO,\
+        OPENSTACK_DISK_ALLOCATION_RATIO
     OPENSTACK_ADMIN_KEY = settings.OPENSTACK_ADMIN_KEY
     OPENSTACK_ADMIN_SECRET = settings.OPENSTACK_ADMIN_SECRET
     OPENSTACK_AUTH_URL = settings.OPENSTACK_AUTH_URL
@@ -62,6 +65,21 @@ def set_settings(settings):
     SERVER_URL = settings.SERVER_URL
     INSTANCE_SERVICE_URL = settings.INSTANCE_SERVICE_URL
     ATMOSPHERE_VNC_LICENSE = settings.ATMOSPHERE_VNC_LICENSE
+    #Optional: Share Keystone tokens between processes (See token_cache)
+    OPENSTACK_TOKEN_CACHE_FILE = getattr(
+        settings, 'OPENSTACK_TOKEN_CACHE_FILE', None)
+    #Optional: Leave raw API payloads out of nodes/images (See compact),
+    #and use __slots__ models (read when the models are imported)
+    COMPACT_MODELS = getattr(settings, 'COMPACT_MODELS', False)
+    #Optional: Keep machine/size catalogs on disk (See catalog_snapshot)
+    CATALOG_SNAPSHOT_FILE = getattr(settings, 'CATALOG_SNAPSHOT_FILE', None)
+    #Optional: Nova's overcommit ratios (See capacity)
+    OPENSTACK_CPU_ALLOCATION_RATIO = getattr(
+        settings, 'OPENSTACK_CPU_ALLOCATION_RATIO', 16.0)
+    OPENSTACK_RAM_ALLOCATION_RATIO = getattr(
+        settings, 'OPENSTACK_RAM_ALLOCATION_RATIO', 1.5)
+    OPENSTACK_DISK_ALLOCATION_RATIO = getattr(
+        settings, 'OPENSTACK_DISK_ALLOCATION_RATIO', 1.0)
 
 set_settings(settings)
 
@@ -4,21 +4,28 @@ Atmosphere service size.
 """
 from abc import ABCMeta
 
-from rtwo.provider import AWSProvider, EucaProvider, OSProvider
+from rtwo import settings
+from rtwo.catalog import CatalogEntry, get_catalog
+from rtwo.provider import AWSProvider, EucaProvider, OSProvider,\
+    provider_attribute
 from threepio import logger
 
 
 class BaseSize(object):
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
 
 class Size(BaseSize):
+    #Slotted (no __dict__) only with settings.COMPACT_MODELS
+    if settings.COMPACT_MODELS:
+        __slots__ = ('_size', 'id', 'name', 'price', 'ram', 'disk', 'extra',
+                     'cpu', 'ephemeral', 'bandwidth')
 
     provider = None
 
-    sizes = {}
-
-    lc_sizes = None
+    #Sizes per identifier, sorted by (cpu, ram), with an id index
+    catalog = get_catalog('sizes')
 
     def __init__(self, lc_size):
         self._size = lc_size
@@ -38,51 +45,48 @@ class Size(BaseSize):
     @classmethod
     def create_size(cls, provider, lc_size):
         size = provider.sizeCls(lc_size)
-        alias = size.id
-        cls.sizes[(provider.identifier, alias)] = size
+        cls.catalog.add(provider.identifier, size.id, size)
         return size
 
     @classmethod
     def lookup_size(cls, alias, provider):
-        if cls.sizes.get((provider.identifier, alias)):
-            return cls.sizes[
-                (provider.identifier, alias)
-            ]
-        else:
-            return None
+        return cls.catalog.lookup(provider.identifier, alias)
 
     @classmethod
     def get_size(cls, lc_size, provider):
-        alias = lc_size.id
-        if cls.sizes.get((provider.identifier, alias)):
-            return cls.sizes[
-                (provider.identifier, alias)
-            ]
-        else:
-            return cls.create_size(provider, lc_size)
+        size = cls.lookup_size(lc_size.id, provider)
+        if size:
+            return size
+        return cls.create_size(provider, lc_size)
 
     @classmethod
-    def get_sizes(cls, provider, lc_list_sizes_method):
-        identifier = provider.identifier
-        cached_sizes = cls.sizes.get(identifier)
-        if not cached_sizes or not cls.lc_sizes:
-            cls.lc_sizes = lc_list_sizes_method()
-            logger.debug("Caching %s sizes for identifier:%s" %
-                         (len(cls.lc_sizes), identifier))
-        return sorted(
-            [cls.get_size(size, provider) for size in cls.lc_sizes],
-            key=lambda s: (s.cpu, s.ram))
-
-    def reset(self):
-        Size.reset()
-        self._size = None
-        self.lc_sizes = None
-        self.sizes = {}
+    def get_sizes(cls, provider, lc_list_sizes_method, lc_driver=None):
+        """
+        lc_driver - Optional, the libcloud driver behind
+        lc_list_sizes_method (Sizes restored from a snapshot use it)
+        """
+        def build(lc_sizes):
+            sizes = sorted([provider.sizeCls(lc_size)
+                            for lc_size in lc_sizes],
+                           key=lambda s: (s.cpu, s.ram))
+            return CatalogEntry(
+                lc_sizes, sizes, dict((size.id, size) for size in sizes))
+
+        def load():
+            return build(lc_list_sizes_method())
+        return list(cls.catalog.get(provider.identifier, load,
+                                    restore=build, driver=lc_driver).items)
+
+    @classmethod
+    def invalidate_cache(cls, identifier=None):
+        """
+        List sizes again for identifier (default: every identifier).
+        """
+        cls.catalog.invalidate(identifier)
 
     @classmethod
     def reset(cls):
-        cls.lc_sizes = None
-        cls.sizes = {}
+        cls.catalog.clear()
 
     def __unicode__(self):
         return str(self)
@@ -109,6 +113,11 @@ class Size(BaseSize):
             'price': self.price}
 
 class MockSize(Size):
+    if settings.COMPACT_MODELS:
+        __slots__ = ('_provider', 'alias')
+
+    provider = provider_attribute(None)
+
     def __init__(self, size_id, provider):
         self.provider = provider
         self._size = None
@@ -136,15 +145,18 @@ class MockSize(Size):
             'price': ''}
 
 class EucaSize(Size):
+    __slots__ = ()
 
     provider = EucaProvider
 
 
 class AWSSize(Size):
+    __slots__ = ()
 
     provider = AWSProvider
 
 
 class OSSize(Size):
+    __slots__ = ()
 
     provider = OSProvider
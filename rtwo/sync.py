@@ -0,0 +1,125 @@
+"""
+Incremental instance sync.
+
+InstanceSync keeps an in-memory table of every instance a driver can see.
+The first sync lists every server, after that only servers updated since the
+last sync are requested (Nova's 'changes-since' filter) and a diff of
+added, changed and deleted instances is returned.
+"""
+import threading
+import time
+
+from threepio import logger
+
+#Statuses Nova reports (with changes-since) for servers that are gone
+DELETED_STATUSES = ('deleted', 'soft_deleted')
+
+#Re-list everything this often (in seconds) to catch anything missed
+DEFAULT_FULL_SYNC_INTERVAL = 3600
+
+
+class InstanceSync(object):
+    """
+    Table of driver.provider.instanceCls, keyed by instance id.
+
+    Libcloud nodes are cheap, instances are not: an instance is only
+    (re)built when its server was added or updated since the last sync.
+    """
+
+    def __init__(self, driver, full_sync_interval=DEFAULT_FULL_SYNC_INTERVAL,
+                 page_size=None):
+        self.driver = driver
+        self.full_sync_interval = full_sync_interval
+        self.page_size = page_size
+        self.instances = {}
+        #instance id -> 'updated' time of the server it was built from
+        #(Instances may drop their node, See Instance.reset)
+        self.updated = {}
+        #Most recent 'updated' time seen, used as the next changes-since
+        self.last_change = None
+        self.last_full_sync = None
+        self._lock = threading.Lock()
+
+    def _build_instance(self, node):
+        self.updated[node.id] = node.extra.get('updated')
+        provider = self.driver.provider
+        return provider.instanceCls(node, provider)
+
+    def _full_sync_due(self):
+        if self.last_change is None or self.last_full_sync is None:
+            return True
+        if self.full_sync_interval is None:
+            return False
+        return time.time() - self.last_full_sync >= self.full_sync_interval
+
+    def sync(self, full=False):
+        """
+        Bring the table up to date, returning a dict of the
+        'added', 'changed' and 'deleted' instances.
+        """
+        with self._lock:
+            if full or self._full_sync_due():
+                return self._full_sync()
+            return self._incremental_sync()
+
+    def _latest_change(self, last_change, node):
+        updated = node.extra.get('updated')
+        #ISO 8601 times in the same format sort like strings
+        if updated and (not last_change or updated > last_change):
+            return updated
+        return last_change
+
+    def _is_changed(self, node):
+        return self.updated.get(node.id) != node.extra.get('updated')
+
+    def _full_sync(self):
+        diff = {'added': [], 'changed': [], 'deleted': []}
+        started = time.time()
+        last_change = None
+        seen = {}
+        for node in self.driver._connection.iter_all_instances(
+                self.page_size):
+            last_change = self._latest_change(last_change, node)
+            if node.id not in self.instances:
+                instance = self._build_instance(node)
+                diff['added'].append(instance)
+            elif self._is_changed(node):
+                instance = self._build_instance(node)
+                diff['changed'].append(instance)
+            else:
+                instance = self.instances[node.id]
+            seen[node.id] = instance
+        diff['deleted'] = [instance for (instance_id, instance)
+                           in self.instances.items()
+                           if instance_id not in seen]
+        self.instances = seen
+        self.updated = dict((instance_id, self.updated.get(instance_id))
+                            for instance_id in seen)
+        self.last_change = last_change
+        self.last_full_sync = started
+        logger.debug("Full instance sync: %s instances (%s added, "
+                     "%s changed, %s deleted)"
+                     % (len(seen), len(diff['added']), len(diff['changed']),
+                        len(diff['deleted'])))
+        return diff
+
+    def _incremental_sync(self):
+        diff = {'added': [], 'changed': [], 'deleted': []}
+        last_change = self.last_change
+        for node in self.driver._connection.iter_all_instances(
+                self.page_size, changes_since=self.last_change):
+            last_change = self._latest_change(last_change, node)
+            if node.extra.get('status') in DELETED_STATUSES:
+                instance = self.instances.pop(node.id, None)
+                self.updated.pop(node.id, None)
+                if instance:
+                    diff['deleted'].append(instance)
+            elif node.id not in self.instances:
+                instance = self.instances[node.id] = self._build_instance(node)
+                diff['added'].append(instance)
+            elif self._is_changed(node):
+                instance = self.instances[node.id] = self._build_instance(node)
+                diff['changed'].append(instance)
+        #Only move forward once every change was seen
+        self.last_change = last_change
+        return diff
@@ -0,0 +1,520 @@
+"""
+Micro-benchmarks for rtwo's hot paths, run against synthetic payloads.
+
+Not collected by the test suite, run them by hand:
+    python -m rtwo.test.benchmarks            # Run every benchmark
+    python -m rtwo.test.benchmarks decode     # Run one benchmark
+"""
+import gc
+import gzip
+import json
+import os
+import subprocess
+import sys
+import time
+import types
+from StringIO import StringIO
+
+from libcloud.compute.base import NodeImage, NodeSize, StorageVolume
+from libcloud.utils.compression import decompress_data
+
+import rtwo
+from rtwo.drivers.openstack import OpenStack_Esh_NodeDriver, fast_json,\
+    read_response_body
+from rtwo.mixins.driver import APIFilterMixin
+from rtwo import capacity
+from rtwo.provider import OSProvider
+from rtwo import serialize
+
+try:
+    #Python 3.4+ (or pytracemalloc)
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def _fake_server(idx):
+    """
+    A server roughly the size of a real /servers/detail entry.
+    """
+    server_id = "%08x-1111-2222-3333-%012x" % (idx, idx)
+    return {
+        "id": server_id,
+        "name": "instance-%s" % idx,
+        "status": "ACTIVE",
+        "tenant_id": "%032x" % (idx % 250),
+        "user_id": "%032x" % (idx % 500),
+        "created": "2015-06-24T11:20:13Z",
+        "updated": "2015-06-24T11:21:%02dZ" % (idx % 60),
+        "hostId": "%056x" % (idx % 40),
+        "accessIPv4": "",
+        "accessIPv6": "",
+        "progress": 0,
+        "key_name": "atmo-key",
+        "config_drive": "",
+        "OS-EXT-STS:task_state": None,
+        "OS-EXT-STS:vm_state": "active",
+        "OS-EXT-STS:power_state": 1,
+        "OS-EXT-SRV-ATTR:host": "compute-%s" % (idx % 40),
+        "OS-EXT-SRV-ATTR:hypervisor_hostname": "compute-%s.local" % (idx % 40),
+        "OS-EXT-SRV-ATTR:instance_name": "instance-%08x" % idx,
+        "OS-EXT-AZ:availability_zone": "nova",
+        "OS-DCF:diskConfig": "MANUAL",
+        "os-extended-volumes:volumes_attached": [],
+        "security_groups": [{"name": "default"}],
+        "metadata": {"tmp_status": "", "iplant_suspend_fix": "True"},
+        "image": {"id": "%08x-aaaa-bbbb-cccc-%012x" % (idx % 30, idx % 30),
+                  "links": [{"href": "http://nova:8774/images/%s" % idx,
+                             "rel": "bookmark"}]},
+        "flavor": {"id": str(idx % 8 + 1),
+                   "links": [{"href": "http://nova:8774/flavors/%s"
+                              % (idx % 8 + 1), "rel": "bookmark"}]},
+        "addresses": {"%s-net" % (idx % 250): [
+            {"OS-EXT-IPS-MAC:mac_addr": "fa:16:3e:%02x:%02x:%02x"
+             % (idx % 256, idx / 256 % 256, 7),
+             "version": 4, "addr": "10.%s.%s.%s"
+             % (idx / 65536 % 256, idx / 256 % 256, idx % 256),
+             "OS-EXT-IPS:type": "fixed"},
+            {"version": 4, "addr": "128.196.%s.%s"
+             % (idx / 256 % 256, idx % 256),
+             "OS-EXT-IPS:type": "floating"}]},
+        "links": [{"href": "http://nova:8774/v2/servers/%s" % server_id,
+                   "rel": "self"}],
+    }
+
+
+def servers_detail_payload(count=10000):
+    return json.dumps({"servers": [_fake_server(idx)
+                                   for idx in xrange(count)]})
+
+
+class _FakeHTTPResponse(object):
+    def __init__(self, body, headers):
+        self._body = StringIO(body)
+        self._headers = headers
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name.lower(), default)
+
+    def read(self, amt=None):
+        return self._body.read() if amt is None else self._body.read(amt)
+
+
+def _gzip(data):
+    buf = StringIO()
+    gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    gzip_file.write(data)
+    gzip_file.close()
+    return buf.getvalue()
+
+
+def _fake_driver():
+    """
+    An Esh driver that is never connected, good for building nodes.
+    """
+    return OpenStack_Esh_NodeDriver(
+        'benchmark', 'secret', ex_tenant_name='benchmark',
+        ex_force_auth_url='http://keystone:5000/v2.0/tokens',
+        ex_force_auth_version='2.0_password')
+
+
+def _deep_size(roots, shared=()):
+    """
+    Bytes held by 'roots' and everything they reference, not counting
+    anything reachable from 'shared' (drivers, providers, ...).
+    Used to measure memory where tracemalloc isn't available.
+    """
+    skip_types = (type, types.ModuleType, types.FunctionType,
+                  types.BuiltinFunctionType, types.ClassType)
+    seen = set()
+
+    def walk(objects, count):
+        total = 0
+        while objects:
+            obj = objects.pop()
+            if id(obj) in seen or isinstance(obj, skip_types):
+                continue
+            seen.add(id(obj))
+            if count:
+                total += sys.getsizeof(obj)
+            objects.extend(gc.get_referents(obj))
+        return total
+    walk(list(shared), False)
+    return walk(list(roots), True)
+
+
+def fake_nodes(count=10000, boot_volume_every=10):
+    """
+    Libcloud nodes for 'count' servers, every 'boot_volume_every'th one is
+    booted from a volume. Returns (driver, nodes), driver.volume_requests
+    counts the calls made to driver.ex_get_volume and driver.list_volumes.
+    """
+    driver = _fake_driver()
+    driver.volume_requests = 0
+    volume_ids = []
+
+    def _volume(volume_id):
+        return StorageVolume(volume_id, 'boot-volume', 20, driver, extra={
+            'attachments': [{'device': '/dev/vda'}]})
+
+    def ex_get_volume(volume_id):
+        driver.volume_requests += 1
+        return _volume(volume_id)
+
+    def list_volumes():
+        driver.volume_requests += 1
+        return [_volume(volume_id) for volume_id in volume_ids]
+    driver.ex_get_volume = ex_get_volume
+    driver.list_volumes = list_volumes
+    #The nodes are all ours, no need to ask Keystone
+    driver._get_tenant_id = lambda: 'benchmark'
+    nodes = []
+    for idx in xrange(count):
+        server = _fake_server(idx)
+        #Keep every node in one tenant, like a user's own listing
+        server['tenant_id'] = 'benchmark'
+        if boot_volume_every and idx % boot_volume_every == 0:
+            volume_ids.append("%08x-dddd-eeee-ffff-%012x" % (idx, idx))
+            server['metadata']['bootable_volume'] = 'True'
+            server['os-extended-volumes:volumes_attached'] = [
+                {'id': volume_ids[-1]}]
+        nodes.append(driver._to_node(server))
+    return (driver, nodes)
+
+
+def _best_of(fn, repeat=3):
+    best = None
+    for _ in xrange(repeat):
+        #Don't bill this run for the garbage the last one left
+        gc.collect()
+        started = time.time()
+        fn()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_decode(count=10000):
+    """
+    Bytes on the wire and time to decode /servers/detail for 'count' servers.
+    """
+    payload = servers_detail_payload(count)
+    compressed = _gzip(payload)
+
+    def before_plain():
+        json.loads(_FakeHTTPResponse(payload, {}).read().strip())
+
+    def before_gzip():
+        json.loads(decompress_data('gzip', compressed))
+
+    def after():
+        response = _FakeHTTPResponse(compressed,
+                                     {'content-encoding': 'gzip'})
+        fast_json.loads(read_response_body(response))
+
+    print "decode: %s servers (JSON backend: %s)" % (count,
+                                                    fast_json.__name__)
+    print "  bytes transferred: %d plain, %d gzip (%.1f%%)"\
+        % (len(payload), len(compressed),
+           100.0 * len(compressed) / len(payload))
+    for (label, fn) in (
+            ("plain + json.loads", before_plain),
+            ("gzip (GzipFile) + json.loads", before_gzip),
+            ("gzip (stream) + %s.loads" % fast_json.__name__, after)):
+        print "  %-32s %.3fs" % (label + ':', _best_of(fn))
+
+
+def bench_instances(count=10000):
+    """
+    Cost per OSInstance built from 'count' nodes, when ip, source and size
+    are read (what construction used to cost) and when they are not.
+    """
+    OSProvider.set_meta()
+    provider = OSProvider()
+    (driver, nodes) = fake_nodes(count)
+
+    def before():
+        for node in nodes:
+            instance = provider.instanceCls(node, provider)
+            (instance.ip, instance.source, instance.size)
+
+    def after():
+        for node in nodes:
+            instance = provider.instanceCls(node, provider)
+            (instance.id, instance.get_status())
+
+    print "instances: %s nodes (1 in 10 booted from a volume)" % count
+    for (label, fn) in (("ip, source and size read", before),
+                        ("id and status only", after)):
+        driver.volume_requests = 0
+        elapsed = _best_of(fn)
+        print "  %-26s %6.2fus/instance, %s volume requests"\
+            % (label + ':', elapsed * 1000000 / count,
+               driver.volume_requests / 3)
+
+
+def bench_boot_volumes(count=10000):
+    """
+    Volume requests made resolving the source of 'count' instances,
+    looked up one node at a time and with get_instances' volume index.
+    """
+    OSProvider.set_meta()
+    provider = OSProvider()
+    (driver, nodes) = fake_nodes(count)
+
+    def before():
+        for node in nodes:
+            provider.instanceCls(node, provider).source
+
+    def after():
+        for instance in provider.instanceCls.get_instances(nodes, provider):
+            instance.source
+
+    print "boot_volumes: %s nodes (1 in 10 booted from a volume)" % count
+    for (label, fn) in (("one request per node", before),
+                        ("get_instances", after)):
+        driver.volume_requests = 0
+        elapsed = _best_of(fn)
+        print "  %-22s %.3fs, %s volume requests"\
+            % (label + ':', elapsed, driver.volume_requests / 3)
+
+
+def bench_convert(count=10000):
+    """
+    Servers per second converted from /servers/detail dicts to OSInstances.
+    """
+    OSProvider.set_meta()
+    provider = OSProvider()
+    driver = _fake_driver()
+    servers = json.loads(servers_detail_payload(count))['servers']
+
+    def before():
+        instances = provider.instanceCls.get_instances(
+            [driver._to_node(api_node) for api_node in servers], provider)
+        for instance in instances:
+            (instance.ip, instance.get_status())
+
+    def after():
+        instances = driver.ex_to_instances(servers, provider)
+        for instance in instances:
+            (instance.ip, instance.get_status())
+
+    print "convert: %s servers" % count
+    for (label, fn) in (("_to_node + OSInstance", before),
+                        ("ex_to_instances", after)):
+        print "  %-24s %8.0f servers/s" % (label + ':', count / _best_of(fn))
+
+
+#settings.COMPACT_MODELS fixes the models' __slots__ when rtwo is first
+#imported, so it is set (before rtwo imports the models) in a new process.
+COMPACT_MODELS_PRELUDE = """
+import importlib
+import sys
+
+
+class CompactModels(object):
+    def find_module(self, name, path=None):
+        return self if name == 'rtwo.settings' else None
+
+    def load_module(self, name):
+        sys.meta_path.remove(self)
+        module = importlib.import_module(name)
+        module.COMPACT_MODELS = %r
+        return module
+sys.meta_path.insert(0, CompactModels())
+"""
+
+
+def run_with_compact_models(compact, code):
+    """
+    Run 'code' in a new Python process where settings.COMPACT_MODELS is
+    'compact', returning its output.
+    """
+    env = dict(os.environ)
+    #The child has to find this rtwo, wherever it is run from
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(rtwo.__file__)))]
+        + [path for path in [env.get('PYTHONPATH')] if path])
+    return subprocess.check_output(
+        [sys.executable, '-c', COMPACT_MODELS_PRELUDE % compact + code],
+        env=env)
+
+
+def measure_memory(count, label):
+    """
+    Print the memory held by 'count' OSInstances (with their nodes, sources
+    and sizes) built from a /servers/detail response, in this process'
+    settings.COMPACT_MODELS mode.
+    """
+    OSProvider.set_meta()
+    provider = OSProvider()
+    driver = _fake_driver()
+    payload = servers_detail_payload(count)
+
+    def build():
+        nodes = driver._to_nodes(fast_json.loads(payload))
+        instances = provider.instanceCls.get_instances(nodes, provider)
+        for instance in instances:
+            (instance.ip, instance.source, instance.size)
+        return instances
+
+    if tracemalloc:
+        gc.collect()
+        tracemalloc.start()
+        instances = build()
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    else:
+        instances = build()
+        held = _deep_size([instances], shared=[driver, provider])
+    print "  %-16s %6.1f MB, %5d bytes/instance"\
+        % (label + ':', held / 1024.0 / 1024, held / count)
+
+
+def bench_memory(count=10000):
+    """
+    Memory held by 'count' OSInstances, with raw payloads and plain models
+    and with compact payloads and slotted models (each in its own process).
+    """
+    print "memory: %s instances (%s)"\
+        % (count, "tracemalloc" if tracemalloc else "deep getsizeof")
+    for (label, compact) in (("raw payloads", False),
+                             ("compact models", True)):
+        sys.stdout.write(run_with_compact_models(compact, (
+            "from rtwo.test import benchmarks\n"
+            "benchmarks.measure_memory(%d, %r)\n" % (count, label))))
+
+
+def bench_serialize(count=10000):
+    """
+    Time to turn 'count' OSInstances (with sizes and sources) in to JSON.
+    """
+    OSProvider.set_meta()
+    provider = OSProvider()
+    (driver, nodes) = fake_nodes(count)
+    #Sizes and machines come from the provider caches, like in production
+    for idx in xrange(8):
+        provider.sizeCls.create_size(provider, NodeSize(
+            str(idx + 1), 'm1.size%s' % idx, 1024 * (idx + 1), 20, None,
+            None, driver, extra={'cpu': idx + 1}))
+    for node in nodes:
+        image_id = node.extra['imageId']
+        if not provider.machineCls.lookup_cached_machine(
+                image_id, provider.identifier):
+            provider.machineCls.create_machine(
+                provider, NodeImage(image_id, 'image', driver),
+                provider.identifier)
+    instances = provider.instanceCls.get_instances(nodes, provider)
+    for instance in instances:
+        (instance.ip, instance.source, instance.size)
+
+    def before_json():
+        json.dumps([instance.json() for instance in instances])
+
+    def before_str():
+        [str(instance) for instance in instances]
+
+    def after():
+        serialize.dumps(instances)
+
+    def after_stream():
+        for chunk in serialize.iter_json(iter(instances)):
+            pass
+
+    print "serialize: %s instances" % count
+    for (label, fn) in (("json.dumps(json())", before_json),
+                        ("str()", before_str),
+                        ("serialize.dumps", after),
+                        ("serialize.iter_json", after_stream)):
+        print "  %-22s %.3fs" % (label + ':', _best_of(fn))
+
+
+def bench_black_list(count=5000, words=300):
+    """
+    Time to filter 'count' machines through a black list of 'words' words.
+    """
+    prefixes = ['centos', 'ubuntu', 'test', 'old', 'deprecated', 'broken']
+    names = ['CentOS 6', 'Ubuntu 14.04', 'Fedora 20', 'Windows 2012']
+    black_list = ['%s-%s' % (prefixes[idx % len(prefixes)], idx)
+                  for idx in xrange(words)]
+    machines = [NodeImage(str(idx), '%s image %s%s'
+                          % (names[idx % len(names)], idx,
+                             ' test-%s' % idx if idx % 7 == 0 else ''),
+                          None)
+                for idx in xrange(count)]
+    driver = APIFilterMixin()
+
+    def before():
+        [machine for machine in machines
+         if not any(word in machine.name for word in black_list)]
+
+    def after():
+        driver.filter_machines(machines, black_list)
+
+    def after_lazy():
+        for machine in driver.iter_filtered(iter(machines), black_list):
+            pass
+
+    print "black_list: %s machines, %s words" % (count, words)
+    for (label, fn) in (("any(word in name)", before),
+                        ("filter_machines", after),
+                        ("iter_filtered", after_lazy)):
+        print "  %-20s %.4fs" % (label + ':', _best_of(fn))
+
+
+def bench_capacity(nodes=3000, sizes=300):
+    """
+    Time to work out how many instances of 'sizes' sizes fit on each of
+    'nodes' hypervisors.
+    """
+    OSProvider.set_meta()
+    hypervisors = dict(('compute-%s' % idx, {
+        'vcpus': 32, 'vcpus_used': idx % 48,
+        'memory_mb': 131072, 'memory_mb_used': idx * 97 % 131072,
+        'local_gb': 2000, 'local_gb_used': idx * 13 % 2000})
+        for idx in xrange(nodes))
+    flavors = [OSProvider.sizeCls(NodeSize(
+        str(idx), 'flavor-%s' % idx, 512 * (idx % 64 + 1), 10 * (idx % 8),
+        None, None, None, extra={'cpu': idx % 16 + 1}))
+        for idx in xrange(sizes)]
+    numpy = capacity.numpy
+
+    def matrix():
+        capacity.CapacityMatrix(hypervisors, flavors).remaining_by_size()
+
+    def python():
+        capacity.numpy = None
+        try:
+            matrix()
+        finally:
+            capacity.numpy = numpy
+
+    print "capacity: %s hypervisors x %s sizes" % (nodes, sizes)
+    runs = [("plain Python", python)]
+    if numpy:
+        runs.append(("NumPy", matrix))
+    for (label, fn) in runs:
+        print "  %-14s %.4fs" % (label + ':', _best_of(fn))
+
+
+BENCHMARKS = [
+    ('decode', bench_decode),
+    ('instances', bench_instances),
+    ('boot_volumes', bench_boot_volumes),
+    ('convert', bench_convert),
+    ('memory', bench_memory),
+    ('serialize', bench_serialize),
+    ('black_list', bench_black_list),
+    ('capacity', bench_capacity),
+]
+
+
+def main(names):
+    for (name, benchmark) in BENCHMARKS:
+        if not names or name in names:
+            benchmark()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,7 +3,21 @@ Create a mock driver and attempt to call each mock method that RTwo adds data
 to!
 """
 
+import copy
+import gzip
+import json
+import os
+import pickle
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from datetime import datetime, timedelta
+from StringIO import StringIO
 from mock import Mock, patch
 
 from rtwo.test.secrets import OPENSTACK_PARAMS
@@ -16,11 +30,12 @@ from libcloud.compute.types import Provider, KeyPairDoesNotExistError
 
 from libcloud.compute.providers import get_driver
 from libcloud.compute.drivers.openstack import (
-    OpenStackSecurityGroup, OpenStackSecurityGroupRule,
+    OpenStack_1_1_Connection, OpenStackSecurityGroup, OpenStackSecurityGroupRule,
     OpenStack_1_1_FloatingIpPool, OpenStack_1_1_FloatingIpAddress,
     OpenStackKeyPair
 )
-from libcloud.compute.base import Node, NodeImage, NodeSize
+from libcloud.compute.base import Node, NodeImage, NodeSize,\
+    StorageVolume
 from libcloud.pricing import set_pricing, clear_pricing_data
 
 from libcloud.test import MockResponse, MockHttpTestCase, XML_HEADERS
@@ -30,6 +45,38 @@ from libcloud.test.compute.test_openstack import OpenStack_1_1_MockHttp, \
                                                  OpenStackMockHttp
 from libcloud.test.compute.test_openstack import OpenStack_1_1_Tests
 from rtwo.drivers.openstack import OpenStack_Esh_Connection,OpenStack_Esh_NodeDriver
+from rtwo.drivers.connection_pool import ConnectionPool, get_connection_pool
+from rtwo.drivers.retry import RetryPolicy, parse_retry_after
+from rtwo.drivers.token_cache import TokenCache
+from rtwo.drivers.instrumentation import Instrumentation, RequestEvent,\
+    RequestHistogram, get_instrumentation, normalize_path
+from rtwo.exceptions import ConnectionFailure, NotFoundException,\
+    OverLimitException
+from rtwo.sync import InstanceSync
+from rtwo.drivers.single_flight import SingleFlight
+from rtwo.drivers.openstack import read_response_body
+from rtwo.drivers.compact import CompactExtra
+from rtwo.drivers.common import parse_timestamp
+from rtwo.bulk import RateLimiter, run_bulk
+from rtwo.test.benchmarks import run_with_compact_models
+from rtwo import catalog_snapshot
+from rtwo.catalog import Catalog, CatalogEntry, get_catalog
+from rtwo.catalog_snapshot import dump_raw, restore_raw
+from rtwo.driver_pool import AdminDriverPool, admin_driver_key, cloud_key
+from rtwo import capacity
+from rtwo.capacity import CapacityMatrix
+from rtwo import occupancy
+from rtwo.occupancy import get_occupancy_tracker, instance_event
+from rtwo.driver import OSDriver
+from rtwo.mixins.driver import APIFilterMixin
+from rtwo.instance import EucaInstance, OSInstance
+from rtwo.machine import OSMachine
+from rtwo.meta import OSMeta
+from rtwo.size import OSSize, Size
+from rtwo.volume import OSVolume
+from rtwo import serialize, settings
+from rtwo.registry import get_shared
+from rtwo.provider import EucaProvider, OSProvider
 
 ######
 
@@ -50,6 +97,1170 @@ class OpenStackEshConnectionTest(unittest.TestCase):
                                                            port=443,
                                                            timeout=10)
 
+    def test_coalesce_key_includes_forced_endpoint(self):
+        def key(base_url):
+            return OpenStack_Esh_Connection(
+                'foo', 'bar', ex_force_auth_url='https://127.0.0.1',
+                ex_force_base_url=base_url)._coalesce_key('/flavors', None,
+                                                          None)
+        self.assertNotEqual(key('https://nova-1.example.com/v2/slug'),
+                            key('https://nova-2.example.com/v2/slug'))
+
+    def test_stale_connection_retry_is_idempotent_only(self):
+        base_cls = next(cls for cls in OpenStack_Esh_Connection.__mro__[
+            OpenStack_Esh_Connection.__mro__.index(
+                OpenStack_1_1_Connection) + 1:]
+            if 'request' in cls.__dict__)
+        methods = []
+
+        def request(connection, **kwargs):
+            methods.append(kwargs['method'])
+            connection.connection = Mock(_rtwo_pool_reused=True)
+            raise socket.error()
+        self.connection.connection_pool = Mock()
+        with patch.object(base_cls, 'request', request):
+            self.assertRaises(socket.error, self.connection._pooled_request,
+                              action='/servers', method='POST')
+            self.assertEqual(methods, ['POST'])
+            self.assertRaises(socket.error, self.connection._pooled_request,
+                              action='/servers', method='GET')
+            self.assertEqual(methods, ['POST', 'GET', 'GET'])
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool(max_per_host=2, wait_timeout=0.01)
+        self.conn_cls = Mock(side_effect=lambda **kwargs: Mock())
+
+    def test_reuse_released_connection(self):
+        conn = self.pool.checkout(self.conn_cls, 'nova.example.com', 8774)
+        self.pool.release(conn)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        reused = self.pool.checkout(self.conn_cls, 'nova.example.com', 8774)
+        self.assertTrue(reused is conn)
+        self.assertEqual(self.conn_cls.call_count, 1)
+        self.assertEqual(self.pool.stats()['active'], 1)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_discarded_connection_is_closed(self):
+        conn = self.pool.checkout(self.conn_cls, 'nova.example.com', 8774)
+        self.pool.release(conn, discard=True)
+        conn.close.assert_called_with()
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_max_per_host(self):
+        self.pool.checkout(self.conn_cls, 'nova.example.com', 8774)
+        self.pool.checkout(self.conn_cls, 'nova.example.com', 8774)
+        self.assertRaises(ConnectionFailure, self.pool.checkout,
+                          self.conn_cls, 'nova.example.com', 8774)
+        #Other hosts have a limit of their own
+        self.pool.checkout(self.conn_cls, 'cinder.example.com', 8776)
+
+
+class RegistryTest(unittest.TestCase):
+    def test_created_once_per_name(self):
+        factory = Mock(side_effect=lambda: object())
+        shared = get_shared(('test', 'registry'), factory)
+        self.assertTrue(get_shared(('test', 'registry'), factory) is shared)
+        self.assertEqual(factory.call_count, 1)
+        self.assertTrue(get_connection_pool() is get_connection_pool())
+        self.assertTrue(get_catalog('machines') is get_catalog('machines'))
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(max_attempts=3, deadline=10,
+                                  base_delay=0.5, max_delay=4)
+
+    def test_post_is_not_retried(self):
+        retry = self.policy.begin('POST')
+        retry.next_attempt()
+        self.assertEqual(retry.backoff(socket.error()), None)
+
+    def test_get_is_retried_with_jitter(self):
+        retry = self.policy.begin('GET')
+        retry.next_attempt()
+        delay = retry.backoff(socket.error())
+        self.assertTrue(0.5 <= delay <= 1.5)
+        retry.next_attempt()
+        self.assertTrue(retry.backoff(socket.error()) <= 4)
+        retry.next_attempt()
+        self.assertEqual(retry.backoff(socket.error()), None)
+
+    def test_over_limit_honors_retry_after(self):
+        retry = self.policy.begin('POST')
+        retry.next_attempt()
+        self.assertEqual(
+            retry.backoff(OverLimitException('429', retry_after=2)), 2)
+        #Waiting past the deadline is pointless, give up instead.
+        self.assertEqual(
+            retry.backoff(OverLimitException('429', retry_after=60)), None)
+
+    def test_attempt_timeout_fits_deadline(self):
+        retry = self.policy.begin('GET')
+        self.assertEqual(retry.next_attempt(8), 8)
+        retry.started -= 9
+        self.assertTrue(retry.next_attempt(8) <= 1)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('30'), 30)
+        self.assertEqual(parse_retry_after(None), None)
+        self.assertEqual(parse_retry_after('soon'), None)
+        self.assertEqual(
+            parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
+
+def _access(token_id='aaaa', expires_in=3600):
+    expires = datetime.utcnow() + timedelta(seconds=expires_in)
+    return {'token': {'id': token_id,
+                      'expires': expires.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                      'tenant': {'id': 'slug', 'name': 'admin'}},
+            'serviceCatalog': [{'type': 'compute', 'name': 'nova',
+                                'endpoints': [{
+                                    'region': 'RegionOne',
+                                    'publicURL':
+                                    'https://nova.example.com:8774/v2/slug'}]
+                                }],
+            'user': {'id': 'admin-id', 'name': 'admin'}}
+
+
+class TokenCacheTest(unittest.TestCase):
+    auth = ('https://keystone.example.com:5000/v2.0/tokens', 'admin')
+
+    def setUp(self):
+        self.cache = TokenCache()
+
+    def test_token_is_shared_between_auth_url_styles(self):
+        self.cache.store(_access(), *self.auth + ('secret', 'admin'))
+        access = self.cache.get('https://keystone.example.com:5000/v2.0',
+                                'admin', 'secret', 'admin')
+        self.assertEqual(access['token']['id'], 'aaaa')
+        self.assertEqual(self.cache.get(*self.auth + ('secret', 'other')),
+                         None)
+
+    def test_wrong_password_misses(self):
+        self.cache.store(_access(), *self.auth + ('secret', 'admin'))
+        self.assertEqual(self.cache.get(*self.auth + ('wrong', 'admin')),
+                         None)
+
+    def test_token_refreshed_before_expiry(self):
+        self.cache.store(_access(expires_in=60),
+                         *self.auth + ('secret', 'admin'))
+        self.assertEqual(self.cache.get(*self.auth + ('secret', 'admin')),
+                         None)
+
+    def test_file_shared_between_processes(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'tokens')
+            TokenCache(path=path).store(_access(),
+                                        *self.auth + ('secret', 'admin'))
+            self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+            other = TokenCache(path=path)
+            access = other.get(*self.auth + ('secret', 'admin'))
+            self.assertEqual(access['token']['id'], 'aaaa')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_connection_uses_cached_token(self):
+        connection = OpenStack_Esh_Connection(
+            'admin', 'secret', ex_tenant_name='admin',
+            ex_force_auth_url=self.auth[0],
+            ex_force_auth_version='2.0_password',
+            ex_force_service_region='RegionOne')
+        connection.token_cache = self.cache
+        self.cache.store(_access(), *self.auth + ('secret', 'admin',
+                                                  'RegionOne'))
+        osa = connection.get_auth_class()
+        osa.authenticate = Mock()
+        connection._populate_hosts_and_request_paths()
+        self.assertFalse(osa.authenticate.called)
+        self.assertEqual(connection.auth_token, 'aaaa')
+        self.assertEqual(connection.host, 'nova.example.com')
+        self.assertEqual(connection.request_path, '/v2/slug')
+
+
+    def test_managers_use_the_cached_token_region(self):
+        from rtwo.drivers.openstack_network import NetworkManager
+        connection = OpenStack_Esh_Connection(
+            'admin', 'secret', ex_tenant_name='admin',
+            ex_force_auth_url=self.auth[0],
+            ex_force_auth_version='2.0_password')
+        lc_driver = Mock(key='admin', secret='secret', _ex_tenant_name='admin',
+                         _ex_force_auth_url=self.auth[0],
+                         _ex_force_service_region=None, connection=connection)
+        with patch.object(NetworkManager, '__init__',
+                          return_value=None) as manager_init:
+            NetworkManager.lc_driver_init(lc_driver)
+        #No forced region, both fall back to the connection's region
+        self.assertEqual(manager_init.call_args[1]['region_name'],
+                         connection._token_identity()['region_name'])
+        self.assertEqual(manager_init.call_args[1]['region_name'],
+                         'RegionOne')
+
+class InstrumentationTest(unittest.TestCase):
+    def test_normalize_path(self):
+        self.assertEqual(
+            normalize_path('/servers/12065/action'), '/servers/{id}/action')
+        self.assertEqual(
+            normalize_path('http://neutron:9696/v2.0/ports/'
+                           '0d8c2e5d-2a61-4d6a-9cc6-1bd9a0c81d44.json?a=b'),
+            '/v2.0/ports/{id}')
+        self.assertEqual(normalize_path('/os-quota-sets/'
+                                        '2e1c6e1a0f3b4d6f8a5e2b7c9d0e1f2a'),
+                         '/os-quota-sets/{id}')
+
+    def test_histogram(self):
+        histogram = RequestHistogram(buckets=(0.1, 1))
+        histogram(RequestEvent('compute', 'GET', '/servers/detail',
+                               status=200, duration=0.05, attempts=2,
+                               response_size=10))
+        histogram(RequestEvent('compute', 'GET', '/servers/detail',
+                               status=200, duration=0.5))
+        series = histogram.to_dict()['compute']['GET /servers/detail'][200]
+        self.assertEqual(series['count'], 2)
+        self.assertEqual(series['retries'], 1)
+        self.assertEqual(series['response_bytes'], 10)
+        self.assertEqual(series['buckets'], {0.1: 1, 1: 2})
+        text = histogram.to_prometheus()
+        self.assertTrue('rtwo_openstack_request_seconds_bucket{service='
+                        '"compute",method="GET",path="/servers/detail",'
+                        'status="200",le="+Inf"} 2' in text)
+
+    def test_instrument_client(self):
+        instrumentation = Instrumentation()
+        events = instrumentation.add_hook(Mock())
+        client = Mock()
+        client.request.return_value = (Mock(status_code=204, content=''),
+                                       None)
+        instrumentation.instrument_client(client, 'network')
+        client.request('/v2.0/ports/1234.json', 'DELETE')
+        event = events.call_args[0][0]
+        self.assertEqual((event.service, event.method, event.path,
+                          event.status), ('network', 'DELETE',
+                                          '/v2.0/ports/{id}', 204))
+
+
+class InstanceSyncTest(unittest.TestCase):
+    class FakeInstance(object):
+        def __init__(self, node, provider):
+            self._node = node
+            self.id = node.id
+
+    def _node(self, node_id, updated, status='active'):
+        return Mock(id=node_id, extra={'updated': updated, 'status': status})
+
+    def setUp(self):
+        self.driver = Mock()
+        self.driver.provider.instanceCls = self.FakeInstance
+        self.sync = InstanceSync(self.driver)
+
+    def test_incremental_sync(self):
+        listing = self.driver._connection.iter_all_instances
+        listing.return_value = [self._node('a', '2015-01-01T00:00:00Z'),
+                                self._node('b', '2015-01-02T00:00:00Z')]
+        diff = self.sync.sync()
+        self.assertEqual(sorted(i.id for i in diff['added']), ['a', 'b'])
+        listing.return_value = [
+            self._node('b', '2015-01-02T00:00:00Z'),
+            self._node('a', '2015-01-03T00:00:00Z', status='deleted'),
+            self._node('c', '2015-01-04T00:00:00Z')]
+        diff = self.sync.sync()
+        listing.assert_called_with(None,
+                                   changes_since='2015-01-02T00:00:00Z')
+        self.assertEqual([i.id for i in diff['added']], ['c'])
+        self.assertEqual(diff['changed'], [])
+        self.assertEqual([i.id for i in diff['deleted']], ['a'])
+        self.assertEqual(sorted(self.sync.instances.keys()), ['b', 'c'])
+        self.assertEqual(self.sync.last_change, '2015-01-04T00:00:00Z')
+
+    def test_full_sync_keeps_unchanged_instances(self):
+        listing = self.driver._connection.iter_all_instances
+        listing.return_value = [self._node('a', '2015-01-01T00:00:00Z'),
+                                self._node('b', '2015-01-01T00:00:00Z')]
+        self.sync.sync()
+        instance_a = self.sync.instances['a']
+        listing.return_value = [self._node('a', '2015-01-01T00:00:00Z')]
+        diff = self.sync.sync(full=True)
+        self.assertTrue(self.sync.instances['a'] is instance_a)
+        self.assertEqual([i.id for i in diff['deleted']], ['b'])
+
+    def test_reset_instances_are_compared(self):
+        listing = self.driver._connection.iter_all_instances
+        listing.return_value = [self._node('a', '2015-01-01T00:00:00Z'),
+                                self._node('b', '2015-01-01T00:00:00Z')]
+        self.sync.sync()
+        #Instance.reset drops the node
+        for instance in self.sync.instances.values():
+            instance._node = None
+        listing.return_value = [self._node('a', '2015-01-02T00:00:00Z'),
+                                self._node('b', '2015-01-01T00:00:00Z')]
+        diff = self.sync.sync()
+        self.assertEqual([i.id for i in diff['changed']], ['a'])
+
+
+class SingleFlightTest(unittest.TestCase):
+    def _call_in_thread(self, fn):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(fn()))
+        thread.start()
+        return (thread, results)
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        work = Mock(side_effect=lambda: release.wait(5) and ['flavor'])
+        (leader, leader_results) = self._call_in_thread(
+            lambda: flight.do('sizes', work))
+        while not flight.stats()['in_flight']:
+            time.sleep(0.001)
+        (follower, follower_results) = self._call_in_thread(
+            lambda: flight.do('sizes', work, share=list))
+        while not flight.stats()['coalesced']:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(work.call_count, 1)
+        self.assertEqual(follower_results, [['flavor']])
+        self.assertFalse(follower_results[0] is leader_results[0])
+        self.assertEqual(flight.stats(), {'in_flight': 0, 'leaders': 1,
+                                          'coalesced': 1})
+
+    def test_followers_copy_before_the_leader_returns(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        result = {'flavors': ['m1.small']}
+        work = Mock(side_effect=lambda: release.wait(5) and result)
+
+        def leader_call():
+            flavors = flight.do('sizes', work)
+            #The leader's caller changes its result straight away
+            flavors['flavors'].append('changed')
+            flavors.clear()
+            return flavors
+        (leader, _) = self._call_in_thread(leader_call)
+        while not flight.stats()['in_flight']:
+            time.sleep(0.001)
+        followers = [self._call_in_thread(
+            lambda: flight.do('sizes', work, share=copy.deepcopy))
+            for _ in range(3)]
+        while flight.stats()['coalesced'] < 3:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        for (follower, results) in followers:
+            follower.join()
+            self.assertEqual(results, [{'flavors': ['m1.small']}])
+
+    def test_errors_are_shared(self):
+        flight = SingleFlight()
+        self.assertRaises(ValueError, flight.do, 'sizes',
+                          Mock(side_effect=ValueError()))
+        #Nothing is left in flight (or cached) after a failure
+        self.assertEqual(flight.do('sizes', lambda: 1), 1)
+
+
+class OSInstanceTest(unittest.TestCase):
+    def setUp(self):
+        OSProvider.set_meta()
+        self.provider = OSProvider()
+        self.node = Mock(id='1234', public_ips=['128.196.0.1'], extra={
+            'tenantId': 'tenant', 'imageId': 'image', 'flavorId': '2',
+            'metadata': {}})
+
+    def test_attributes_are_lazy(self):
+        with patch.object(OSInstance, '_get_source_for_instance') as source:
+            instance = OSInstance(self.node, self.provider)
+            self.assertFalse(source.called)
+            self.assertEqual(instance.source, source.return_value)
+            instance.source
+            self.assertEqual(source.call_count, 1)
+        self.assertEqual(instance.ip, '128.196.0.1')
+        self.assertEqual(instance.size.id, '2')
+
+    def test_reset_keeps_lazy_attributes(self):
+        with patch.object(OSInstance, '_get_source_for_instance') as source:
+            instance = OSInstance(self.node, self.provider)
+            instance.reset()
+            self.assertEqual(source.call_count, 1)
+            self.assertEqual(instance.source, source.return_value)
+        self.assertEqual(instance.ip, '128.196.0.1')
+        self.assertEqual(instance.size.id, '2')
+
+    def test_boot_volumes_are_listed_once(self):
+        driver = Mock()
+        volumes = dict((volume_id, Mock(id=volume_id, extra={
+            'attachments': [{'device': '/dev/vda'}]}))
+            for volume_id in ('vol-1', 'vol-2'))
+        driver.ex_volume_index.return_value = volumes
+        nodes = [Mock(id=volume_id, driver=driver, extra={
+            'tenantId': 'tenant', 'metadata': {'bootable_volume': 'True'},
+            'object': {'os-extended-volumes:volumes_attached': [
+                {'id': volume_id}]}})
+            for volume_id in ('vol-1', 'vol-2', 'vol-3')]
+        instances = OSInstance.get_instances(nodes, self.provider)
+        self.assertEqual([i.source.id for i in instances[:2]],
+                         ['vol-1', 'vol-2'])
+        driver.ex_volume_index.assert_called_once_with(all_tenants=False,
+                                                       project_id='tenant')
+        self.assertFalse(driver.ex_get_volume.called)
+        #Volumes missing from the listing are still looked up
+        driver.ex_get_volume.return_value = None
+        self.assertEqual(instances[2].source, None)
+        driver.ex_get_volume.assert_called_once_with('vol-3')
+
+    def test_same_tenant_boot_volumes_need_no_login(self):
+        driver = OpenStack_Esh_NodeDriver(
+            'user', 'secret', ex_tenant_name='tenant',
+            ex_force_auth_url='http://keystone:5000/v2.0/tokens',
+            ex_force_auth_version='2.0_password')
+        driver._establish_connection = Mock(
+            side_effect=ConnectionFailure('Not connected'))
+        driver.list_volumes = Mock(return_value=[
+            StorageVolume(volume_id, 'boot', 20, driver, extra={
+                'attachments': [{'device': '/dev/vda'}]})
+            for volume_id in ('vol-1', 'vol-2')])
+        driver.ex_get_volume = Mock()
+        nodes = [Mock(id=volume_id, driver=driver, extra={
+            'tenantId': 'tenant', 'metadata': {'bootable_volume': 'True'},
+            'object': {'os-extended-volumes:volumes_attached': [
+                {'id': volume_id}]}})
+            for volume_id in ('vol-1', 'vol-2')]
+        instances = OSInstance.get_instances(nodes, self.provider)
+        self.assertEqual([i.source.id for i in instances],
+                         ['vol-1', 'vol-2'])
+        self.assertEqual(driver.list_volumes.call_count, 1)
+        self.assertFalse(driver.ex_get_volume.called)
+        self.assertFalse(driver._establish_connection.called)
+
+    def test_volume_index_of_another_tenant(self):
+        driver = Mock()
+        driver._get_tenant_id.return_value = 'admin'
+        driver._iter_pages.return_value = [{'id': 'vol-1'}]
+        driver._to_volume.side_effect = lambda api_volume, cinder:\
+            Mock(id=api_volume['id'])
+        index = OpenStack_Esh_NodeDriver.ex_volume_index.im_func
+        self.assertEqual(list(index(driver, project_id='tenant')), ['vol-1'])
+        self.assertEqual(driver._iter_pages.call_args[1]['params'],
+                         {'project_id': 'tenant'})
+        self.assertFalse(driver.list_volumes.called)
+        #Our own tenant is a plain listing
+        driver.list_volumes.return_value = []
+        index(driver, project_id='admin')
+        self.assertTrue(driver.list_volumes.called)
+
+    def test_attributes_can_be_set(self):
+        instance = OSInstance(self.node, self.provider)
+        instance.ip = '128.196.0.2'
+        self.assertEqual(instance.ip, '128.196.0.2')
+        self.assertEqual(instance.get_public_ip(), '128.196.0.2')
+
+
+class CompactExtraTest(unittest.TestCase):
+    def test_payload_is_fetched_once(self):
+        fetch = Mock(return_value={'id': '1234'})
+        extra = CompactExtra({'status': 'active', 'object': {'id': '1234'}},
+                             'object', fetch)
+        self.assertFalse('object' in extra)
+        self.assertEqual(extra.get('status'), 'active')
+        self.assertFalse(fetch.called)
+        self.assertEqual(extra.get('object'), {'id': '1234'})
+        self.assertEqual(extra['object'], {'id': '1234'})
+        self.assertEqual(fetch.call_count, 1)
+        self.assertRaises(KeyError, lambda: extra['missing'])
+
+    def test_compact_node_keeps_hypervisor_hostname(self):
+        driver = Mock()
+        node = Node('1234', 'vm', None, [], [], driver, extra={
+            'object': {}})
+        OpenStack_Esh_NodeDriver._compact_node.im_func(driver, node, {
+            'OS-EXT-SRV-ATTR:hypervisor_hostname': 'compute-1.local'})
+        meta = Mock()
+        meta._scrub_hostname.side_effect = lambda hostname:\
+            OSMeta._scrub_hostname.im_func(meta, hostname)
+        self.assertEqual(OSMeta._get_node.im_func(
+            meta, {'compute-1': 'node'}, Mock(extra=node.extra)), 'node')
+        #The 'object' wasn't fetched again
+        self.assertFalse(driver._payload_fetcher.return_value.called)
+
+    def test_models_are_slotted_only_in_compact_mode(self):
+        node = Mock(id='1234', public_ips=[], extra={'tenantId': 'tenant'})
+        instance = OSInstance(node, OSProvider())
+        self.assertEqual(hasattr(instance, '__dict__'),
+                         not settings.COMPACT_MODELS)
+        self.assertEqual(OSInstance.provider, OSProvider)
+        if not settings.COMPACT_MODELS:
+            machine = OSMachine(NodeImage('image-1', 'Ubuntu', None))
+            machine.note = 'ad-hoc'
+            self.assertEqual(pickle.loads(pickle.dumps(machine, 0)).note,
+                             'ad-hoc')
+
+    def test_slotted_models_pickle_with_protocol_2_only(self):
+        output = run_with_compact_models(True, (
+            "import pickle\n"
+            "from libcloud.compute.base import NodeImage, NodeSize\n"
+            "from rtwo.machine import OSMachine\n"
+            "from rtwo.size import OSSize\n"
+            "models = [OSMachine(NodeImage('image-1', 'Ubuntu', None)),\n"
+            "          OSSize(NodeSize('1', 'm1.small', 2048, 20, None,\n"
+            "                          None, None, extra={'cpu': 2}))]\n"
+            "for model in models:\n"
+            "    for protocol in (0, 1):\n"
+            "        try:\n"
+            "            pickle.dumps(model, protocol)\n"
+            "            print 'pickled'\n"
+            "        except TypeError:\n"
+            "            print 'TypeError'\n"
+            "    print pickle.loads(pickle.dumps(model, 2)).id\n"))
+        self.assertEqual(output.split(), ['TypeError', 'TypeError', 'image-1',
+                                          'TypeError', 'TypeError', '1'])
+
+    def test_cinder_payload_is_fetched_from_cinder(self):
+        volume_connection = Mock()
+        volume_connection.request.return_value.object = {
+            'volume': {'display_name': 'data'}}
+        convert = Mock(side_effect=lambda payload: {'displayName': 'data'})
+        fetch = OpenStack_Esh_NodeDriver._payload_fetcher.im_func(
+            Mock(), '/volumes/1', 'volume', volume_connection, convert)
+        self.assertEqual(fetch(), {'displayName': 'data'})
+        volume_connection.request.assert_called_with('/volumes/1')
+
+
+class ToNodeFastTest(unittest.TestCase):
+    """
+    _to_node_fast must build the same nodes (and instances) as _to_node.
+    """
+    def setUp(self):
+        self.driver = OpenStack_Esh_NodeDriver(
+            'user', 'secret', ex_tenant_name='tenant',
+            ex_force_auth_url='http://keystone:5000/v2.0/tokens',
+            ex_force_auth_version='2.0_password')
+        OSProvider.set_meta()
+        self.provider = OSProvider()
+
+    def _server(self, addresses, metadata=None, **kwargs):
+        server = {
+            'id': '1234', 'name': 'test', 'status': 'ACTIVE',
+            'tenant_id': 'tenant', 'hostId': 'host', 'created': '2015-01-01',
+            'updated': '2015-01-02', 'metadata': metadata or {},
+            'image': {'id': 'image-1'}, 'flavor': {'id': '2'},
+            'addresses': addresses, 'OS-EXT-STS:task_state': None,
+            'OS-EXT-STS:power_state': 1,
+            'links': [{'rel': 'self', 'href': 'http://nova/servers/1234'}]}
+        server.update(kwargs)
+        return server
+
+    def _address(self, addr, ip_type=None):
+        address = {'addr': addr, 'version': 6 if ':' in addr else 4}
+        if ip_type:
+            address['OS-EXT-IPS:type'] = ip_type
+        return address
+
+    def assertSameNode(self, api_node):
+        expected = self.driver._to_node(api_node)
+        node = self.driver._to_node_fast(api_node)
+        for field in ('id', 'name', 'state', 'public_ips', 'private_ips',
+                      'extra'):
+            self.assertEqual(getattr(node, field), getattr(expected, field),
+                             "%s differs" % field)
+        (expected, instance) = [
+            OSInstance(n, self.provider) for n in (expected, node)]
+        self.assertEqual(instance.json(), expected.json())
+        self.assertEqual(instance.get_status(), expected.get_status())
+
+    def test_fixture_servers(self):
+        fixtures = ComputeFileFixtures('openstack_v1.1')
+        for server in json.loads(
+                fixtures.load('_servers_detail.json'))['servers']:
+            self.assertSameNode(server)
+
+    def test_ip_types(self):
+        self.assertSameNode(self._server({'private': [
+            self._address('10.0.0.2', 'fixed'),
+            self._address('128.196.1.2', 'floating'),
+            self._address('172.16.0.3'),
+            self._address('2001:db8::1')]}))
+
+    def test_fixed_public_address(self):
+        #Provider networks hand out routable addresses typed 'fixed'
+        self.assertSameNode(self._server({'provider-net': [
+            self._address('10.0.0.2', 'fixed'),
+            self._address('128.196.1.2', 'fixed')]}))
+
+    def test_floating_private_range_address(self):
+        self.assertSameNode(self._server({'tenant-net': [
+            self._address('10.0.0.2', 'fixed'),
+            self._address('172.24.4.5', 'floating'),
+            self._address('128.196.1.9', 'floating')]}))
+
+    def test_ipv6_addresses(self):
+        self.assertSameNode(self._server({
+            'public': [self._address('2001:db8::1'),
+                       self._address('172.24.4.5', 'fixed')],
+            'tenant-net': [self._address('2001:db8::2', 'floating'),
+                           self._address('2001:db8::3')]}))
+
+    def test_untyped_public_addresses(self):
+        self.assertSameNode(self._server({
+            'public': [self._address('10.0.0.2')],
+            'tenant-net': [self._address('128.196.1.2'),
+                           self._address('10.0.0.2')]}))
+
+    def test_public_ip_hint(self):
+        self.assertSameNode(self._server(
+            {'private': [self._address('10.0.0.2', 'fixed')]},
+            metadata={'public-ip': '128.196.1.9'}))
+
+    def test_error_state_without_image(self):
+        self.assertSameNode(self._server(
+            {}, status='ERROR', image='', fault={'message': 'No valid host'},
+            **{'OS-EXT-STS:task_state': 'spawning'}))
+
+    def test_to_instances(self):
+        instances = self.driver.ex_to_instances(
+            [self._server({'private': [
+                self._address('128.196.1.2', 'floating')]})], self.provider)
+        self.assertEqual([(i.id, i.ip, i.size.id, i.source.id)
+                          for i in instances],
+                         [('1234', '128.196.1.2', '2', 'image-1')])
+
+
+class ParseTimestampTest(unittest.TestCase):
+    def test_matches_strptime(self):
+        for (timestamp, time_format) in (
+                ('2013-06-24T11:20:13.000000', '%Y-%m-%dT%H:%M:%S.%f'),
+                ('2013-06-24T11:20:13.5', '%Y-%m-%dT%H:%M:%S.%f'),
+                ('2013-06-24T11:20:13.123Z', '%Y-%m-%dT%H:%M:%S.%fZ'),
+                ('2013-06-24T11:20:13Z', '%Y-%m-%dT%H:%M:%SZ')):
+            self.assertEqual(parse_timestamp(timestamp),
+                             datetime.strptime(timestamp, time_format))
+
+    def test_offsets_are_converted_to_utc(self):
+        self.assertEqual(parse_timestamp('2013-06-24T11:20:13+02:00'),
+                         datetime(2013, 6, 24, 9, 20, 13))
+        self.assertEqual(parse_timestamp('2013-06-24T23:20:13-0100'),
+                         datetime(2013, 6, 25, 0, 20, 13))
+
+    def test_invalid_timestamps(self):
+        self.assertRaises(ValueError, parse_timestamp, '24/06/2013')
+        self.assertRaises(ValueError, parse_timestamp, '2013-13-24T11:20:13')
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.catalog = Catalog('test', ttl=60, max_entries=2)
+        self.loads = []
+
+    def _load(self, identifier):
+        def load():
+            self.loads.append(identifier)
+            return CatalogEntry(['raw'], ['item'], {'1': 'item'})
+        return self.catalog.get(identifier, load)
+
+    def test_hits_misses_and_invalidate(self):
+        self._load('a')
+        self._load('a')
+        self._load('b')
+        self.assertEqual(self.loads, ['a', 'b'])
+        self.catalog.invalidate('a')
+        #Stale entries are still used by lookup, until they are loaded
+        self.assertEqual(self.catalog.lookup('a', '1'), 'item')
+        self._load('a')
+        self._load('b')
+        self.assertEqual(self.loads, ['a', 'b', 'a'])
+        stats = self.catalog.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['loads']),
+                         (2, 3, 3))
+
+    def test_invalidate_item(self):
+        self._load('a')
+        self.catalog.get('b', lambda: CatalogEntry([], [], {'2': 'other'}))
+        self.catalog.invalidate_item('1')
+        self._load('a')
+        self._load('b')
+        self.assertEqual(self.loads, ['a', 'a'])
+
+    def test_machines_are_kept_between_loads(self):
+        OSProvider.set_meta()
+        OSMachine.reset()
+        self.addCleanup(OSMachine.reset)
+        images = [NodeImage('image-1', 'Ubuntu', None)]
+        machines = OSMachine.get_cached_machines('tenant', lambda: images)
+        OSMachine.invalidate_cache('tenant')
+        images = [NodeImage('image-1', 'Ubuntu 14.04', None)]
+        reloaded = OSMachine.get_cached_machines('tenant', lambda: images)
+        self.assertTrue(reloaded[0] is machines[0])
+        self.assertEqual(reloaded[0].name, 'Ubuntu 14.04')
+
+    def test_ttl_per_identifier(self):
+        self.catalog.set_ttl('a', 0)
+        self._load('a')
+        self._load('a')
+        self._load('b')
+        self._load('b')
+        self.assertEqual(self.loads, ['a', 'a', 'b'])
+
+    def test_least_recently_used_are_evicted(self):
+        self._load('a')
+        self._load('b')
+        self._load('a')
+        self._load('c')
+        self.assertEqual(self.catalog.lookup('b', '1'), None)
+        self.assertEqual(self.catalog.lookup('a', '1'), 'item')
+        self.assertEqual(self.catalog.stats()['evictions'], 1)
+
+    def test_sizes_are_sorted_and_indexed(self):
+        OSProvider.set_meta()
+        provider = OSProvider()
+        list_sizes = Mock(return_value=[
+            NodeSize('2', 'm1.medium', 4096, 40, None, None, None,
+                     extra={'cpu': 2}),
+            NodeSize('1', 'm1.small', 2048, 20, None, None, None,
+                     extra={'cpu': 1})])
+        OSSize.reset()
+        self.addCleanup(OSSize.reset)
+        sizes = OSSize.get_sizes(provider, list_sizes)
+        self.assertEqual([size.id for size in sizes], ['1', '2'])
+        self.assertTrue(OSSize.get_sizes(provider, list_sizes)[0] is sizes[0])
+        self.assertTrue(OSSize.lookup_size('2', provider) is sizes[1])
+        self.assertEqual(list_sizes.call_count, 1)
+
+    def test_snapshot_restore_and_revalidate(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        images = [NodeImage('image-1', 'Ubuntu', None, extra={'a': 1})]
+        loaded = threading.Event()
+
+        def build(raw):
+            return CatalogEntry(raw, [image.name for image in raw],
+                                dict((image.id, image.name) for image in raw))
+
+        def load():
+            loaded.set()
+            return build(images)
+        with patch('rtwo.settings.CATALOG_SNAPSHOT_FILE',
+                   os.path.join(tmpdir, 'catalog.db')):
+            self.catalog.get('a', load, restore=build)
+            #A new worker reads it from disk, then lists it again
+            catalog = Catalog('test')
+            loaded.clear()
+            entry = catalog.get('a', Mock(side_effect=load), restore=build)
+            self.assertEqual(entry.items, ['Ubuntu'])
+            self.assertEqual(entry.raw[0].extra, {'a': 1})
+            self.assertTrue(loaded.wait(5))
+            for thread in threading.enumerate():
+                if thread.name == 'catalog-test-revalidate':
+                    thread.join(5)
+        self.assertEqual(catalog.stats()['restores'], 1)
+        self.assertEqual(catalog.stats()['loads'], 1)
+
+    def test_snapshot_is_restored_after_add(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        images = [NodeImage('image-1', 'Ubuntu', None)]
+
+        def build(raw):
+            return CatalogEntry(raw, [image.name for image in raw],
+                                dict((image.id, image.name) for image in raw))
+        with patch('rtwo.settings.CATALOG_SNAPSHOT_FILE',
+                   os.path.join(tmpdir, 'catalog.db')):
+            self.catalog.get('a', lambda: build(images), restore=build)
+            #A new worker adds an image before anything was listed
+            catalog = Catalog('test')
+            catalog.add('a', 'image-2', 'CentOS')
+            load = Mock(side_effect=lambda: build(images))
+            entry = catalog.get('a', load, restore=build)
+            self.assertEqual(entry.items, ['Ubuntu'])
+            self.assertEqual(catalog.lookup('a', 'image-2'), 'CentOS')
+            for thread in threading.enumerate():
+                if thread.name == 'catalog-test-revalidate':
+                    thread.join(5)
+        self.assertEqual(catalog.stats()['restores'], 1)
+
+    def test_snapshot_records_round_trip(self):
+        created = datetime(2015, 1, 1, 12, 30)
+        full = NodeImage('image-1', 'Ubuntu', None,
+                         extra={'api': {'id': 'image-1'}, 'created': created})
+        compact = NodeImage('image-2', 'CentOS', None, extra=CompactExtra(
+            {'state': 'active'}, 'api', Mock()))
+        records = json.loads(json.dumps(dump_raw([full, compact]),
+                                        default=catalog_snapshot._default),
+                             object_hook=catalog_snapshot._object_hook)
+        self.assertEqual(records[0]['extra'], {'created': created})
+        driver = Mock(spec=['_to_image', '_payload_fetcher'])
+        driver._payload_fetcher.return_value = lambda: {'id': 'image-2'}
+        (rebuilt, restored) = restore_raw(records, driver)
+        #Payloads are built by the driver again, like a listing
+        driver._to_image.assert_called_with({'id': 'image-1'})
+        self.assertTrue(rebuilt is driver._to_image.return_value)
+        self.assertTrue(restored.driver is driver)
+        self.assertEqual(restored.extra['api'], {'id': 'image-2'})
+        driver._payload_fetcher.assert_called_with('/images/image-2',
+                                                   'image')
+
+
+
+class LookupInstanceTest(unittest.TestCase):
+    def test_other_tenants_are_out_of_scope(self):
+        driver = Mock()
+        driver._connection.ex_find_node.return_value = Mock(
+            extra={'tenantId': 'other'})
+        driver._connection._get_tenant_id.return_value = 'mine'
+        lookup = OSDriver._lookup_instance.im_func
+        self.assertEqual(lookup(driver, '1'), None)
+        self.assertTrue(lookup(driver, '1', all_tenants=True)
+                        is driver.provider.instanceCls.return_value)
+        driver._connection._get_tenant_id.return_value = 'other'
+        self.assertTrue(lookup(driver, '1')
+                        is driver.provider.instanceCls.return_value)
+
+
+    def test_other_tenants_volumes_are_out_of_scope(self):
+        driver = Mock()
+        driver._connection.ex_find_volume.return_value = Mock(
+            extra={'tenantId': 'other'})
+        driver._connection._get_tenant_id.return_value = 'mine'
+        lookup = OSDriver._lookup_volume.im_func
+        self.assertEqual(lookup(driver, 'vol-1'), None)
+        driver._connection._get_tenant_id.return_value = 'other'
+        self.assertTrue(lookup(driver, 'vol-1')
+                        is driver.provider.volumeCls.return_value)
+        #Only cinder's view has the tenant
+        esh_driver = Mock()
+        OpenStack_Esh_NodeDriver.ex_find_volume.im_func(esh_driver, 'vol-1')
+        self.assertEqual(esh_driver._find_resource.call_args[0][3],
+                         esh_driver.volume_connection)
+        #Without the (admin only) tenant attribute it is the caller's
+        driver._connection.ex_find_volume.return_value = Mock(extra={})
+        driver._connection._get_tenant_id.return_value = 'mine'
+        self.assertTrue(lookup(driver, 'vol-1')
+                        is driver.provider.volumeCls.return_value)
+
+class BlackListTest(unittest.TestCase):
+    def test_matches_any_word_in_name(self):
+        machines = [NodeImage(str(idx), name, None) for (idx, name) in
+                    enumerate(['test-1 image', 'test image', 'c++ (beta)',
+                               'ubuntu', 'Ubuntu 14.04', 'centos.old'])]
+        driver = APIFilterMixin()
+        for black_list in ([], ['test-1', 'test'], ['test-1', 'c++'],
+                           ['(beta', 'ubu', '.old', 'x'], ['']):
+            expected = [machine for machine in machines
+                        if not any(word in machine.name
+                                   for word in black_list)]
+            self.assertEqual(driver.filter_machines(machines, black_list),
+                             expected)
+            self.assertEqual(
+                list(driver.iter_filtered(iter(machines), black_list)),
+                expected)
+
+
+class CapacityMatrixTest(unittest.TestCase):
+    def setUp(self):
+        def hypervisor(vcpus, vcpus_used, memory_mb, memory_mb_used):
+            return {'vcpus': vcpus, 'vcpus_used': vcpus_used,
+                    'memory_mb': memory_mb, 'memory_mb_used': memory_mb_used,
+                    'local_gb': 1000, 'local_gb_used': 0}
+        #Half of 'b' and all of 'a' are free, but neither has 8 vCPUs
+        self.nodes = {'a': hypervisor(4, 0, 16384, 0),
+                      'b': hypervisor(8, 4, 32768, 2048),
+                      'c': hypervisor(8, 9, 32768, 0)}
+        self.sizes = [OSSize(NodeSize(str(cpu), 'm1.%s' % cpu, cpu * 2048,
+                                      20, None, None, None,
+                                      extra={'cpu': cpu}))
+                      for cpu in (1, 4, 8)]
+        self.sizes.append(OSSize(NodeSize('0', 'm1.none', 0, 0, None, None,
+                                          None, extra={'cpu': 0})))
+
+    def _check(self, matrix):
+        self.assertEqual(matrix.remaining_on_node('a'),
+                         {'1': 4, '4': 1, '8': 0, '0': sys.maxint})
+        self.assertEqual(matrix.remaining_on_node('c'),
+                         {'1': 0, '4': 0, '8': 0, '0': sys.maxint})
+        remaining = matrix.remaining_by_size()
+        self.assertEqual((remaining['1'], remaining['4'], remaining['8']),
+                         (8, 2, 0))
+        total = matrix.total_by_size()
+        self.assertEqual((total['1'], total['4'], total['8']), (20, 5, 2))
+        #2x CPU overcommit: 'a' fits 1 m1.8, 'b' fits 1 (12 free)
+        overcommit = CapacityMatrix(self.nodes, self.sizes, (2.0, 1.0, 1.0))
+        self.assertEqual(overcommit.remaining_by_size()['8'], 2)
+
+    def test_capacity_per_node(self):
+        self._check(CapacityMatrix(self.nodes, self.sizes, (1.0, 1.0, 1.0)))
+
+    def test_without_numpy(self):
+        with patch('rtwo.capacity.numpy', None):
+            self._check(CapacityMatrix(self.nodes, self.sizes,
+                                       (1.0, 1.0, 1.0)))
+            self.assertEqual(CapacityMatrix({}, self.sizes).total_by_size(),
+                             {'0': 0, '1': 0, '4': 0, '8': 0})
+
+
+    @unittest.skipUnless(capacity.numpy, "NumPy is not installed")
+    def test_numpy_exact_fits(self):
+        nodes = dict(('node-%s' % disk, {
+            'vcpus': 64, 'vcpus_used': 0, 'memory_mb': 262144,
+            'memory_mb_used': 0, 'local_gb': disk, 'local_gb_used': 0})
+            for disk in (49, 98, 103, 161, 187, 206))
+        #root + ephemeral disks that divide the nodes' disks exactly
+        sizes = [OSSize(NodeSize(str(disk), 'disk.%s' % disk, 2048, disk - 9,
+                                 None, None, None,
+                                 extra={'cpu': 1, 'ephemeral': 9}))
+                 for disk in (49, 98, 103, 161, 187)]
+        matrix = CapacityMatrix(nodes, sizes, (1.0, 1.0, 1.0))
+        self.assertEqual(matrix._numpy_fits(False).tolist(),
+                         matrix._python_fits(False))
+        self.assertEqual(matrix.remaining_on_node('node-98')['49'], 2)
+        self.assertEqual(matrix.remaining_on_node('node-49')['49'], 1)
+
+class OccupancyTrackerTest(unittest.TestCase):
+    def setUp(self):
+        OSProvider.set_meta()
+        self.provider = OSProvider()
+        self.size = OSSize(NodeSize('1', 'm1.small', 2048, 20, None, None,
+                                    None, extra={'cpu': 2, 'ephemeral': 5}))
+        self.instances = [self._instance('1', 'a'), self._instance('2', 'b'),
+                          self._instance('3', 'a', 'suspended')]
+        meta = Mock(provider=self.provider, cloud='cloud-1')
+        meta.admin_driver.list_sizes.return_value = [self.size]
+        meta._active_compute_nodes.return_value = {'a': 'a', 'b': 'b'}
+        meta.iter_all_instances.side_effect = lambda: iter(self.instances)
+        meta._get_node.side_effect = lambda nodes, instance:\
+            nodes.get(instance.extra['host'])
+        meta._get_hashable_node.side_effect = lambda node: node
+        self.meta = meta
+        self.tracker = get_occupancy_tracker(meta)
+        self.tracker.reconcile_interval = None
+        self.tracker.placement_interval = 0
+
+    def tearDown(self):
+        occupancy._trackers.clear()
+
+    def _instance(self, instance_id, host, status='active'):
+        return Mock(id=instance_id, size=Mock(id='1'),
+                    extra={'host': host, 'status': status})
+
+    def test_full_scan_then_events(self):
+        occupancy = self.tracker.occupancy()
+        self.assertEqual(occupancy['a']['cpu'], 4)
+        self.assertEqual(occupancy['a']['disk'], 10)
+        self.assertEqual(self.tracker.node_usage('a', overcommited=False)
+                         ['instances'], [self.instances[0]])
+        self.assertEqual(self.tracker.inactive_totals(),
+                         {'cpu': 2, 'ram': 2048, 'disk': 20})
+        instance_event('cloud-1', 'resumed', self.instances[2])
+        instance_event('cloud-1', 'destroyed', self.instances[1])
+        instance_event('cloud-1', 'created', self._instance('4', 'b'))
+        self.assertEqual(self.tracker.inactive_totals()['cpu'], 0)
+        self.assertEqual(self.tracker.size_counts(), {'1': 3})
+        self.assertEqual([i.id for i in self.tracker.node_usage('b')
+                          ['instances']], ['4'])
+        #Events don't list anything again
+        self.assertEqual(self.meta.iter_all_instances.call_count, 1)
+
+    def test_one_tracker_per_cloud(self):
+        self.tracker.occupancy()
+        self.assertTrue(get_occupancy_tracker(
+            Mock(cloud='cloud-1')) is self.tracker)
+        #Events on another cloud are not applied here
+        instance_event('cloud-2', 'destroyed', self.instances[0])
+        self.assertEqual(self.tracker.size_counts(), {'1': 3})
+
+    def test_building_instance_is_placed_once_scheduled(self):
+        self.tracker.occupancy()
+        self.meta.provider = Mock()
+        self.meta.provider.instanceCls.side_effect = lambda node, provider:\
+            node
+        find_node = self.meta.admin_driver._connection.ex_find_node
+        building = self._instance('4', None, 'build')
+        find_node.return_value = building
+        instance_event('cloud-1', 'created', building)
+        #Not counted (on node None) while it builds
+        self.assertEqual(self.tracker.size_counts(), {'1': 3})
+        find_node.return_value = self._instance('4', 'b')
+        self.assertEqual([i.id for i in self.tracker.node_usage('b')
+                          ['instances']], ['2', '4'])
+        find_node.assert_called_with('4')
+
+    def test_failed_calls_send_no_event(self):
+        driver = Mock()
+        with patch('rtwo.driver.instance_event') as event:
+            OSDriver._instance_event.im_func(
+                driver, 'stopped', (self.instances[0],), {}, False)
+            self.assertFalse(event.called)
+            OSDriver._instance_event.im_func(
+                driver, 'stopped', (self.instances[0],), {}, True)
+            event.assert_called_with(driver._cloud(), 'stopped',
+                                     self.instances[0])
+
+    def test_reconcile_replaces_state(self):
+        self.tracker.occupancy()
+        self.instances.pop()
+        self.tracker.reconcile()
+        self.assertEqual(self.tracker.size_counts(), {'1': 2})
+        self.assertEqual(self.tracker.inactive_totals()['cpu'], 0)
+
+
+class BulkTest(unittest.TestCase):
+    def test_failures_are_collected(self):
+        def operation(item):
+            if item % 3 == 0:
+                raise ValueError(item)
+            return item * 2
+        reports = []
+        summary = run_bulk('double', operation, range(10), workers=4,
+                           rate=None,
+                           progress=lambda *args: reports.append(args))
+        self.assertEqual([r.item for r in summary.results], range(10))
+        self.assertEqual([r.result for r in summary.succeeded],
+                         [2, 4, 8, 10, 14, 16])
+        self.assertEqual([r.item for r in summary.failed], [0, 3, 6, 9])
+        self.assertEqual([done for (_, done, _, _) in reports], range(1, 11))
+        self.assertEqual(summary.json()['succeeded'], 6)
+
+    def test_workers_are_bounded(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def operation(item):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+        run_bulk('sleep', operation, range(12), workers=3, rate=None)
+        self.assertEqual(running[1], 3)
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(100)
+        started = time.time()
+        for _ in xrange(11):
+            limiter.acquire()
+        self.assertTrue(time.time() - started >= 0.09)
+
+
+
+class AdminDriverPoolTest(unittest.TestCase):
+    def _key(self, region, secret='secret', user='user1'):
+        cloud = cloud_key(OSProvider, {'region_name': region, 'key': user,
+                                       'secret': 'pw', 'ex_tenant_name': user},
+                          {'key': user, 'secret': 'pw'})
+        return admin_driver_key(cloud, 'admin', secret, 'admin')
+
+    def test_drivers_are_shared_per_key(self):
+        pool = AdminDriverPool(max_drivers=2)
+        create = Mock(side_effect=lambda: object())
+        key = self._key('r1')
+        driver = pool.get(key, create)
+        #Every user of the cloud borrows the same driver
+        self.assertTrue(pool.get(self._key('r1', user='user2'), create)
+                        is driver)
+        self.assertEqual(create.call_count, 1)
+        #Another region (or password) is another driver
+        self.assertFalse(pool.get(self._key('r2'), create) is driver)
+        self.assertNotEqual(key, self._key('r1', secret='new'))
+        self.assertFalse('secret' in key)
+        pool.get(self._key('r3'), create)
+        self.assertEqual(pool.stats()['evictions'], 1)
+        self.assertFalse(pool.get(key, create) is driver)
+
+
+class EucaInstanceTest(unittest.TestCase):
+    def setUp(self):
+        EucaProvider.set_meta()
+        self.provider = EucaProvider()
+
+    def tearDown(self):
+        Size.reset()
+
+    def _node(self):
+        return Mock(id='i-1', extra={'instancetype': 'm1.small',
+                                     'dns_name': '128.196.0.1',
+                                     'status': 'running'})
+
+    def test_size_alias_without_cached_size(self):
+        instance = EucaInstance(self._node(), self.provider)
+        self.assertEqual(instance.size, 'm1.small')
+        self.assertEqual(instance.get_status(), 'running')
+
+    def test_size_from_catalog(self):
+        size = Size.create_size(self.provider, NodeSize(
+            'm1.small', 'm1.small', 512, 10, None, None, None))
+        instance = EucaInstance(self._node(), self.provider)
+        self.assertTrue(instance.size is size)
+
+
+class SerializeTest(unittest.TestCase):
+    def setUp(self):
+        OSProvider.set_meta()
+        self.provider = OSProvider()
+        self.size = OSSize(NodeSize('2', 'm1.small', 2048, 20, None, None,
+                                    None, extra={'cpu': 1}))
+        self.machine = OSMachine(NodeImage('image-1', 'Ubuntu', None))
+        self.volume = OSVolume(Mock(id='vol-1', size=20, extra={
+            'attachments': [], 'createTime': datetime(2015, 1, 1)}))
+        self.volume.name = 'data'
+
+    def _instance(self, instance_id, size=None, source=None):
+        node = Mock(id=instance_id, public_ips=['128.196.0.1'], extra={
+            'tenantId': 'tenant', 'flavorId': '3', 'metadata': {}})
+        node.name = 'test'
+        instance = OSInstance(node, self.provider)
+        instance.size = size or instance.size
+        instance.source = source
+        return instance
+
+    def test_matches_json(self):
+        models = [self._instance('1', self.size, self.machine),
+                  self._instance('2', source=self.volume),
+                  self.size, self.machine]
+        expected = json.loads(json.dumps(
+            [model.json() for model in models],
+            default=lambda value: value.isoformat()))
+        self.assertEqual(json.loads(serialize.dumps(models)), expected)
+        self.assertEqual(json.loads(serialize.encode(models[0])),
+                         expected[0])
+
+    def test_streams_chunks(self):
+        instances = [self._instance(str(idx), self.size, self.machine)
+                     for idx in range(5)]
+        chunks = list(serialize.iter_json(iter(instances), chunk_size=2))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(json.loads(''.join(chunks)),
+                         [instance.json() for instance in instances])
+        self.assertEqual(list(serialize.iter_json([])), ['[]'])
+
+
+class ResponseBodyTest(unittest.TestCase):
+    def _response(self, body, encoding=None):
+        response = Mock()
+        response.getheader.return_value = encoding
+        response.read.side_effect = StringIO(body).read
+        return response
+
+    def test_gzip_body_is_decompressed(self):
+        body = '{"servers": []}' * 10000
+        buf = StringIO()
+        gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+        gzip_file.write(body)
+        gzip_file.close()
+        self.assertEqual(
+            read_response_body(self._response(buf.getvalue(), 'gzip')), body)
+        self.assertEqual(
+            read_response_body(self._response(zlib.compress(body),
+                                              'deflate')), body)
+
+    def test_plain_body(self):
+        self.assertEqual(read_response_body(self._response(' {} \n')), '{}')
+
+    def test_compressed_body_is_stripped(self):
+        self.assertEqual(read_response_body(
+            self._response(zlib.compress(' {} \n'), 'deflate')), '{}')
+        self.assertEqual(read_response_body(
+            self._response(zlib.compress('\n'), 'deflate')), '')
+
+
 class OpenStackEshDriverTest(OpenStack_1_1_Tests):
     driver_args = OPENSTACK_PARAMS
     driver_klass = OpenStack_Esh_NodeDriver
@@ -58,4 +1269,105 @@ class OpenStackEshDriverTest(OpenStack_1_1_Tests):
     def setUp(self):
         super(OpenStackEshDriverTest, self).setUp()
 
+    def test_requests_reuse_pooled_connections(self):
+        self.driver.list_nodes()
+        before = self.driver.connection.pool_stats()
+        self.driver.list_nodes()
+        after = self.driver.connection.pool_stats()
+        self.assertEqual(after['reused'], before['reused'] + 1)
+        self.assertEqual(after['created'], before['created'])
+        self.assertEqual(after['active'], before['active'])
+
+    def test_requests_are_instrumented(self):
+        hook = get_instrumentation().add_hook(Mock())
+        try:
+            self.driver.list_nodes()
+        finally:
+            get_instrumentation().remove_hook(hook)
+        event = hook.call_args[0][0]
+        self.assertEqual((event.service, event.method, event.path,
+                          event.status, event.attempts),
+                         ('compute', 'GET', '/servers/detail', 200, 1))
+        self.assertTrue(event.response_size > 0)
+
+    def test_iter_pages_uses_limit_and_marker(self):
+        pages = [[{'id': 'a'}, {'id': 'b'}], [{'id': 'c'}, {'id': 'd'}],
+                 [{'id': 'e'}]]
+        lc_conn = Mock()
+        lc_conn.request.side_effect = [Mock(object={'servers': page})
+                                       for page in pages]
+        items = self.driver._iter_pages(lc_conn, '/servers/detail',
+                                        'servers', page_size=2)
+        self.assertEqual([item['id'] for item in items],
+                         ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(
+            [call[1]['params'].get('marker')
+             for call in lc_conn.request.call_args_list],
+            [None, 'b', 'd'])
+
+    def test_iter_pages_stops_when_marker_is_ignored(self):
+        page = [{'id': 'a'}, {'id': 'b'}]
+        lc_conn = Mock()
+        lc_conn.request.return_value = Mock(object={'servers': page})
+        items = self.driver._iter_pages(lc_conn, '/servers/detail',
+                                        'servers', page_size=2)
+        self.assertEqual([item['id'] for item in items], ['a', 'b'])
+        self.assertEqual(lc_conn.request.call_count, 2)
+
+    def test_iter_all_instances_matches_list(self):
+        #The mock API ignores limit, paging must still stop.
+        nodes = list(self.driver.iter_all_instances(page_size=1))
+        self.assertEqual([node.id for node in nodes],
+                         [node.id for node in self.driver.list_nodes()])
+
+    def test_find_single_resources(self):
+        self.assertEqual(self.driver.ex_find_node('12064').id, '12064')
+        self.assertEqual(self.driver.ex_find_size('7').id, '7')
+        self.assertEqual(self.driver.ex_find_image('13').id, '13')
+
+        def not_found(mock_http, method, url, body, headers):
+            return (httplib.NOT_FOUND, '{"itemNotFound": {"code": 404,'
+                    ' "message": "Instance could not be found"}}',
+                    {'content-type': 'application/json'},
+                    httplib.responses[httplib.NOT_FOUND])
+        mock_http = self.driver.connection.conn_classes[1]
+        with patch.object(mock_http, '_v2_1337_servers_missing', not_found,
+                          create=True):
+            self.assertEqual(self.driver.ex_find_node('missing'), None)
+            #Outside of lookups a 404 is libcloud's error, as it was
+            try:
+                self.driver.connection.request('/servers/missing')
+            except Exception as error:
+                self.assertFalse(isinstance(error, NotFoundException))
+            else:
+                self.fail('404 did not raise')
+
+    def test_managers_are_cached_per_credentials(self):
+        with patch('rtwo.drivers.openstack.NetworkManager') as manager_cls:
+            manager_cls.lc_driver_init.side_effect = lambda driver: Mock()
+            manager = self.driver.get_network_manager()
+            self.assertTrue(self.driver.get_network_manager() is manager)
+            self.assertEqual(manager_cls.lc_driver_init.call_count, 1)
+            self.driver.secret = 'new-secret'
+            self.assertFalse(self.driver.get_network_manager() is manager)
+            self.assertEqual(manager_cls.lc_driver_init.call_count, 2)
+
+    def test_service_connections_leave_compute_endpoint_alone(self):
+        compute_conn = self.driver.connection
+        compute_host = compute_conn.host
+        volume_conn = self.driver.volume_connection
+        volume_conn.get_endpoint = Mock(
+            return_value='https://cinder.example.com:8776/v1/slug')
+        volume_conn._populate_hosts_and_request_paths()
+        volume_conn._populate_hosts_and_request_paths()
+        #Resolved once per token
+        self.assertEqual(volume_conn.get_endpoint.call_count, 1)
+        self.assertEqual(volume_conn.host, 'cinder.example.com')
+        self.assertEqual(volume_conn.request_path, '/v1/slug')
+        self.assertEqual(volume_conn.auth_token, compute_conn.auth_token)
+        self.assertTrue(volume_conn is self.driver.volume_connection)
+        self.assertFalse(volume_conn is self.driver.identity_connection)
+        self.assertEqual(compute_conn.host, compute_host)
+        self.assertEqual(compute_conn._ex_force_base_url, None)
+
 
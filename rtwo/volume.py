@@ -6,14 +6,23 @@ from abc import ABCMeta
 
 from threepio import logger
 
-from rtwo.provider import AWSProvider, EucaProvider, OSProvider
+from rtwo import settings
+from rtwo.provider import AWSProvider, EucaProvider, OSProvider,\
+    provider_attribute
 
 
 class BaseVolume(object):
     __metaclass__ = ABCMeta
+    __slots__ = ()
 
 
 class MockVolume(BaseVolume):
+    #Slotted (no __dict__) only with settings.COMPACT_MODELS
+    if settings.COMPACT_MODELS:
+        __slots__ = ('_volume', 'id', 'alias', 'size', 'attachment_set', 'extra',
+                     'name', '_provider')
+
+    provider = provider_attribute(None)
 
     def __init__(self, volume_id, provider):
         self._volume = None
@@ -27,8 +36,11 @@ class MockVolume(BaseVolume):
 
 
 class Volume(BaseVolume):
+    if settings.COMPACT_MODELS:
+        __slots__ = ('_volume', 'id', 'alias', 'attachment_set', 'extra', 'name',
+                     '_provider', 'size')
 
-    provider = None
+    provider = provider_attribute(None)
 
     machine = None
 
@@ -55,7 +67,6 @@ class Volume(BaseVolume):
     # again order matters... /sigh
     @classmethod
     def reset(cls):
-        cls._volume = None
         cls.machine = None
 
     def __unicode__(self):
@@ -79,15 +90,18 @@ class Volume(BaseVolume):
 
 
 class AWSVolume(Volume):
+    __slots__ = ()
 
-    provider = AWSProvider
+    provider = provider_attribute(AWSProvider)
 
 
 class EucaVolume(Volume):
+    __slots__ = ()
 
-    provider = EucaProvider
+    provider = provider_attribute(EucaProvider)
 
 
 class OSVolume(Volume):
+    __slots__ = ()
 
-    provider = OSProvider
+    provider = provider_attribute(OSProvider)